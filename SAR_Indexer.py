@@ -27,15 +27,36 @@ if __name__ == "__main__":
     parser.add_argument('-O', '--positional', dest='positional', action='store_true', default=False, 
                     help='compute positional index.')
 
+    parser.add_argument('-W', '--workers', dest='workers', type=int, default=1,
+                    help='number of processes used to index the files.')
+
+    parser.add_argument('-B', '--memory', dest='memory', type=float, default=None,
+                    help='memory budget (MB) for the inverted index, partial indexes are flushed to disk when exceeded '
+                         'and merged straight into the index file, computing stems and permuterm on the way, so only the '
+                         'vocabulary is kept in memory. With -A the new files are merged in memory.')
+
+    parser.add_argument('-A', '--append', dest='append', action='store_true', default=False,
+                    help='add the files not yet indexed to an existing index, with the options it was built with.')
+
+    parser.add_argument('--spelling', dest='spelling', action='store_true', default=False,
+                    help='store the data used by the spelling correction in the index.')
+
+    parser.add_argument('--stats', dest='stats', type=str, default=None,
+                    help='write a JSON report with the time and memory of each indexing phase.')
+
     args = parser.parse_args()
 
     indexer = SAR_Indexer()
+    if args.append:
+        indexer.load_info(args.index)
     t0 = time.time()
     indexer.index_dir(args.dir, **vars(args))
     t1 = time.time()
     indexer.save_info(args.index)
     t2 = time.time()
     indexer.show_stats()
+    if args.stats is not None:
+        indexer.build_stats.save(args.stats)
     print("Time indexing: %2.2fs." % (t1 - t0))
     print("Time saving: %2.2fs." % (t2 - t1))
     print()
@@ -40,12 +40,25 @@ if __name__ == "__main__":
     group1.add_argument('-T', '--test', dest='test', metavar= 'test', type=str, action='store',
                     help='file with queries and results, for testing.')
 
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+                    help='number of processes used to solve the queries of -L and -T (default 1). '
+                         'Each process has its own query cache, results are not shared between them.')
+
+    parser.add_argument('--cache', dest='cache', type=int, default=SAR_Indexer.CACHE_SIZE,
+                    help=f'number of query and sub-query results kept in the LRU cache, 0 disables it (default {SAR_Indexer.CACHE_SIZE}).')
+    parser.add_argument('--cache-stats', dest='cache_stats', action='store_true', default=False,
+                    help='print the cache hits and misses to stderr at the end.')
+    parser.add_argument('--batch-stats', dest='batch_stats', action='store_true', default=False,
+                    help='print to stderr how many sub-expressions the queries of -L and -T share.')
+
     args = parser.parse_args()
     searcher = SAR_Indexer()
     searcher.load_info(args.index)
     searcher.set_stemming(args.stem)
     searcher.set_showall(args.all)
     searcher.set_snippet(args.snippet)
+    searcher.set_cache(args.cache)
+    searcher.set_jobs(args.jobs)
 
     # se debe contar o mostrar resultados?
     if args.count is True:
@@ -89,3 +102,8 @@ if __name__ == "__main__":
             else:
                 searcher.solve_and_show(query)
             query = input("query: ")
+
+    if args.cache_stats:
+        print('cache:', ', '.join(f'{k} {v}' for k, v in searcher.cache.stats().items()), file=sys.stderr)
+    if args.batch_stats and searcher.batch_stats is not None:
+        print('batch:', ', '.join(f'{k} {v}' for k, v in searcher.batch_stats.items()), file=sys.stderr)
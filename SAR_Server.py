@@ -0,0 +1,244 @@
+"""
+Servidor de consultas: carga el índice una sola vez y resuelve las consultas que recibe por
+un socket Unix (--socket) o TCP en localhost (--port).
+
+Protocolo: una petición JSON por línea y una respuesta JSON por línea, en el mismo orden
+que las peticiones. Se pueden enviar varias peticiones seguidas sin esperar las respuestas
+(pipelining), se resuelven a la vez en el pool de workers.
+
+    {"id": 1, "op": "count", "q": "precisión AND exhaustividad"}
+    {"id": 2, "op": "query", "queries": ["python", "NOT python"]}
+    {"id": 3, "op": "show", "q": "salton", "all": false, "snippet": true}
+    {"id": 4, "op": "stats"}
+
+    "op":   "query" devuelve los artIds, "count" el número de resultados, "show" la posición,
+            artId, url y título de los primeros SAR_Indexer.SHOW_MAX resultados (todos con
+            "all") y, con "snippet", su snippet; "stats" las latencias del servidor
+    "q" / "queries": una consulta o una lista de consultas (batch), con una lista se
+            devuelve una lista de resultados
+
+    respuesta: {"id": 1, "ok": true, "result": 3, "latency_ms": 0.41}
+               {"id": 5, "ok": false, "error": "...", "latency_ms": 0.02}
+
+La latencia se mide desde que se lee la petición hasta que su respuesta está lista.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from SAR_lib_plantilla import SAR_Indexer
+
+OPS = ('query', 'count', 'show')
+# los percentiles de "stats" se calculan con las latencias de las últimas LATENCY_WINDOW peticiones
+LATENCY_WINDOW = 10000
+
+# buscador de cada proceso del pool, ver init_worker()
+searcher = None
+
+
+def init_worker(index:str, stem:bool, spell:bool, distance:str, threshold:int, cache:int):
+    """
+    Carga el índice en el proceso (o en el hilo) que resuelve las consultas.
+
+    """
+    global searcher
+    searcher = SAR_Indexer()
+    searcher.load_info(index)
+    searcher.set_stemming(stem)
+    searcher.set_spelling(spell, distance, threshold)
+    searcher.set_cache(cache)
+
+
+def show(query:str, res, show_all:bool, snippet:bool) -> list:
+    """
+    Devuelve los resultados que mostraría SAR_Indexer.solve_and_show() como diccionarios.
+
+    """
+    get = None if show_all else searcher.SHOW_MAX
+    shown = []
+    # los resultados se generan a medida que se recorren, ver SAR_Indexer.iter_query()
+    for i, artId in enumerate(itertools.islice(res, get)):
+        url, title = searcher.articles[artId]
+        item = {'rank': i + 1, 'artId': artId, 'url': url, 'title': title}
+        if snippet:
+            item['snippet'] = searcher.make_snippet(artId, searcher.get_article(artId)['all'], query)
+        shown.append(item)
+    return shown
+
+
+def solve(op:str, queries:list, show_all:bool=False, snippet:bool=False) -> list:
+    """
+    Resuelve un batch de consultas en el worker.
+
+    """
+    results = []
+    for query in queries:
+        if op == 'count':
+            results.append(searcher.count_results(query))
+        elif op == 'query':
+            results.append(list(searcher.solve_query(query)))
+        else:
+            results.append(show(query, searcher.iter_query(query), show_all, snippet))
+    return results
+
+
+class Server:
+    """
+    Servidor asyncio: lee las peticiones de cada conexión, las manda al pool y escribe las
+    respuestas en orden.
+    """
+
+    def __init__(self, pool, workers:int):
+        self.pool = pool
+        self.workers = workers
+        self.latencies = deque(maxlen=LATENCY_WINDOW) # latencia (ms) de las últimas peticiones resueltas
+        self.requests = 0
+        self.total_ms = 0.0
+        self.errors = 0
+
+    async def handle(self, line:bytes, received:float) -> dict:
+        """
+        Resuelve una petición y devuelve su respuesta.
+
+        """
+        request = {}
+        try:
+            request = json.loads(line)
+            op = request.get('op')
+            if op == 'stats':
+                response = {'ok': True, 'result': self.stats()}
+            elif op in OPS:
+                batch = 'queries' in request
+                queries = request['queries'] if batch else [request['q']]
+                results = await asyncio.get_running_loop().run_in_executor(
+                    self.pool, solve, op, queries, request.get('all', False), request.get('snippet', False))
+                response = {'ok': True, 'result': results if batch else results[0]}
+            else:
+                raise ValueError(f'unknown op: {op!r}')
+        except Exception as e:
+            self.errors += 1
+            response = {'ok': False, 'error': f'{type(e).__name__}: {e}'}
+        latency = (time.perf_counter() - received) * 1000
+        self.latencies.append(latency)
+        self.requests += 1
+        self.total_ms += latency
+        if isinstance(request, dict) and 'id' in request:
+            response['id'] = request['id']
+        response['latency_ms'] = round(latency, 3)
+        return response
+
+    def stats(self) -> dict:
+        """
+        Número de peticiones, su latencia media y los percentiles de la latencia de las
+        últimas LATENCY_WINDOW.
+
+        """
+        lat = sorted(self.latencies)
+        stats = {'requests': self.requests, 'errors': self.errors, 'workers': self.workers}
+        if lat:
+            for name, p in (('p50_ms', 0.5), ('p90_ms', 0.9), ('p99_ms', 0.99)):
+                stats[name] = round(lat[min(len(lat) - 1, int(p * len(lat)))], 3)
+            stats['mean_ms'] = round(self.total_ms / self.requests, 3)
+        return stats
+
+    async def connection(self, reader, writer):
+        """
+        Atiende una conexión: cada línea leída se resuelve en una tarea y otra tarea
+        escribe las respuestas en el orden de las peticiones.
+
+        """
+        pending = asyncio.Queue()
+
+        async def respond():
+            while True:
+                task = await pending.get()
+                if task is None:
+                    break
+                writer.write(json.dumps(await task, ensure_ascii=False).encode('utf-8') + b'\n')
+                await writer.drain()
+
+        responder = asyncio.create_task(respond())
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if line.strip():
+                    await pending.put(asyncio.create_task(self.handle(line, time.perf_counter())))
+        finally:
+            await pending.put(None)
+            try:
+                await responder
+            except ConnectionError:
+                pass
+            writer.close()
+
+
+async def serve(args, pool):
+    server = Server(pool, args.workers)
+    if args.socket is not None:
+        listener = await asyncio.start_unix_server(server.connection, path=args.socket)
+        where = args.socket
+    else:
+        listener = await asyncio.start_server(server.connection, host=args.host, port=args.port)
+        where = f'{args.host}:{args.port}'
+    print(f'Serving {args.index} on {where}', file=sys.stderr, flush=True)
+    async with listener:
+        await listener.serve_forever()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Serve queries over a local socket.')
+
+    parser.add_argument('index', metavar='index', type=str,
+                        help='name of the index.')
+
+    parser.add_argument('-S', '--stem', dest='stem', action='store_true', default=False,
+                    help='use stem index by default.')
+
+    parser.add_argument('-s', '--spell', dest='spell', action='store_true', default=False,
+                    help='activate spelling correction.')
+    parser.add_argument('-t', '--threshold', dest='threshold', action='store', type=int, default=None,
+                    help='threshold for the spelling correction.')
+    parser.add_argument('-d', '--distance', dest='distance', action='store', default=None, choices=['levenshtein', 'damerau_r', 'damerau_i'],
+                    help='distance function for the spelling correction.')
+
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--socket', dest='socket', type=str, default=None,
+                    help='path of the Unix socket to listen on.')
+    group.add_argument('--port', dest='port', type=int, default=8765,
+                    help='TCP port to listen on (localhost only).')
+    parser.add_argument('--host', dest='host', type=str, default='127.0.0.1',
+                    help='address to listen on with --port.')
+
+    parser.add_argument('--cache', dest='cache', type=int, default=SAR_Indexer.CACHE_SIZE,
+                    help=f'number of query and sub-query results kept in the LRU cache of each worker, 0 disables it (default {SAR_Indexer.CACHE_SIZE}).')
+
+    parser.add_argument('-W', '--workers', dest='workers', type=int, default=0,
+                    help='number of worker processes, each with the index open. With 0 the queries are solved in a thread of the server process.')
+
+    args = parser.parse_args()
+
+    spell = args.spell or (args.distance is not None) or (args.threshold is not None)
+    initargs = (args.index, args.stem, spell, args.distance, args.threshold, args.cache)
+    if args.workers > 0:
+        pool = ProcessPoolExecutor(args.workers, initializer=init_worker, initargs=initargs)
+    else:
+        # el buscador no es thread-safe, un solo hilo resuelve todas las consultas
+        pool = ThreadPoolExecutor(1, initializer=init_worker, initargs=initargs)
+
+    try:
+        asyncio.run(serve(args, pool))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pool.shutdown(cancel_futures=True)
+        if args.socket is not None and os.path.exists(args.socket):
+            os.remove(args.socket)
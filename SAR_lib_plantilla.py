@@ -1,14 +1,23 @@
 import json
-from nltk.stem.snowball import SnowballStemmer
 import os
 import re
 import sys
 import math
-from pathlib import Path
 from typing import Optional, List, Union, Dict
 import pickle
-from distancias import opcionesSpell
-from spellsuggester import SpellSuggester
+import heapq
+import itertools
+import bisect
+# nltk, numpy (distancias) y los módulos que solo se usan al indexar (multiprocessing,
+# tempfile, shutil, pathlib) se importan en los métodos que los usan, así arrancar el
+# buscador es rápido, ver bench_startup.py
+from functools import partial
+from postings import CompressedPosting, BitmapPosting, Complement, FieldIndex, doc_ids, union_postings, iter_docs, iter_and, iter_or, iter_minus, iter_complement, raw_size, compress_postings, gallop_intersect, gallop_difference, gallop_remove, offset_intersect, bitmap_and, bitmap_minus, bitmap_union, bitmap_count_and, bitmap_count_union
+import diskindex
+from queryparser import BatchPlan, QuerySyntaxError, normalize, parse_query
+from querycache import QueryCache
+from buildstats import BuildStats
+from array import array
 
 class SAR_Indexer:
     """
@@ -31,9 +40,43 @@ class SAR_Indexer:
     PAR_MARK = '%'
     # numero maximo de documento a mostrar cuando self.show_all es False
     SHOW_MAX = 10
-
+    # a partir de esta proporción entre las longitudes de dos posting lists, and_posting() y
+    # minus_posting() buscan los artIds de la corta en la larga en vez de recorrer las dos
+    GALLOP_RATIO = 8
+    # las posting lists con al menos DENSE_MIN artIds que están en al menos 1 de cada DENSE_RATIO
+    # artículos se guardan como bitmaps (ver postings.BitmapPosting), ver self.compress_posting()
+    DENSE_RATIO = 8
+    DENSE_MIN = 64
+    # tamaño de los trozos en los que se reparten los ficheros al indexar en paralelo
+    CHUNK_BYTES = 1 << 20
+    # coste aproximado en memoria de cada término y de cada posting, ver memory_estimate()
+    TERM_BYTES = 200
+    POSTING_BYTES = 40
+    # postings que se comprimen juntas con postings.compress_postings(), ver self.compress_postings()
+    COMPRESS_BATCH = 1024
+    # snippets: tokens de cada ventana, tokens de contexto antes de la ventana y ventanas por artículo
+    SNIPPET_WINDOW = 20
+    SNIPPET_CONTEXT = 5
+    SNIPPET_MAX = 2
+    # queries de las que se guardan los términos de los snippets, ver self.snippet_terms()
+    SNIPPET_CACHE_SIZE = 128
+    # tokens de un texto en minúsculas, son los mismos que devuelve self.tokenize()
+    WORD_RE = re.compile(r"\w+")
+    # tokens como WORD_RE y además el carácter PIECE_SEP, que separa los trozos de un
+    # artículo en self.tokenize_article()
+    PIECE_SEP = '\x00'
+    PIECE_RE = re.compile(r"\w+|\x00")
+    # número de resultados (de consultas y subconsultas) que se guardan en la cache, ver self.set_cache()
+    CACHE_SIZE = 1024
+
+    # el tokenizador y el stemmer no se guardan, se crean al cargar (ver self.stemmer)
     all_atribs = ['urls', 'index', 'sindex', 'ptindex', 'docs', 'weight', 'articles',
-                  'tokenizer', 'stemmer', 'show_all', 'use_stemming']
+                  'show_all', 'use_stemming',
+                  'multifield', 'positional', 'stemming', 'permuterm', 'spelling', 'terms', 'term_list',
+                  'artpos', 'spell_buckets']
+    # atributos que se guardan en secciones propias del índice binario, ver self.save_info()
+    disk_atribs = ['index', 'sindex', 'ptindex', 'terms', 'term_list', 'urls', 'articles', 'artpos',
+                   'spell_buckets']
 
     def __init__(self):
         """
@@ -45,24 +88,72 @@ class SAR_Indexer:
 
         """
         self.urls = set() # hash para las urls procesadas,
-        self.index = {} # hash para el indice invertido de terminos --> clave: termino, valor: posting list
+        self.index = {} # hash para el indice invertido de terminos --> clave: id del termino, valor: posting list
+        self.terms = {} # diccionario global de terminos, compartido por todos los campos --> clave: termino, valor: id
+        self.term_list = [] # lista de terminos --> posicion: id, valor: termino
         self.sindex = {} # hash para el indice invertido de stems --> clave: stem, valor: lista con los terminos que tienen ese stem
-        self.ptindex = {} # hash para el indice permuterm.
+        self.ptindex = {} # hash para el indice permuterm --> par (lista ordenada de permuterms, array con el id del termino de cada permuterm)
         self.docs = {} # diccionario de terminos --> clave: entero(docid),  valor: ruta del fichero.
         self.weight = {} # hash de terminos para el pesado, ranking de resultados.
         self.articles = {} # hash de articulos --> clave entero (artid), valor: la info necesaria para diferencia los artículos dentro de su fichero
+        self.artpos = array('Q') # posicion de cada articulo en su fichero: (docid, byte inicial, longitud) del artid en artpos[3*(artid-1):3*artid]
+        self.doc_handles = {} # ficheros abiertos por self.get_article() --> clave: docid, valor: fichero
+        self.disk = None # diskindex.Reader del índice binario cargado, ver self.load_info()
+        self.lazy = {} # atributos del índice binario que todavía no se han cargado --> clave: nombre, valor: función que lo carga
         self.tokenizer = re.compile("\W+") # expresion regular para hacer la tokenizacion
-        self.stemmer = SnowballStemmer('spanish') # stemmer en castellano
+        self._stemmer = None # stemmer en castellano, se crea al usarlo por primera vez (ver self.stemmer)
         self.show_all = False # valor por defecto, se cambia con self.set_showall()
         self.show_snippet = False # valor por defecto, se cambia con self.set_snippet()
         self.use_stemming = False # valor por defecto, se cambia con self.set_stemming()
         self.use_ranking = False  # valor por defecto, se cambia con self.set_ranking()
-        self.parpos={}
+        self.multifield = False # opciones con las que se ha construido el indice, ver self.index_dir()
+        self.positional = False
+        self.stemming = False
+        self.permuterm = False
+        self.spelling = False
+        self.spell_buckets = {} # terminos de 'all' por longitud para el corrector --> clave: longitud, valor: array con los ids
         self.use_spelling = False
         self.speller = None
+        self.memory_budget = None # limite (bytes) del indice en memoria durante la construccion, ver self.check_memory()
+        self.runs = [] # ficheros temporales con los indices parciales volcados a disco
+        self.run_dir = None # directorio temporal de self.runs
+        self.merged = None # fichero de self.run_dir en el que self.write_runs() ha escrito el indice, lo completa self.save_info()
+        self.tokens_in_memory = 0 # tokens indexados desde el ultimo volcado
+        self.posting_bytes = [0, 0] # bytes de las postings [sin comprimir, comprimidas], ver self.compress_posting()
+        self.build_stats = BuildStats() # tiempos y memoria de cada fase de la construccion del indice
+        self.snippet_cache = QueryCache(self.SNIPPET_CACHE_SIZE) # cache LRU de los terminos de cada query para los snippets --> clave: query, valor: ver self.snippet_terms()
+        self.cache = QueryCache(self.CACHE_SIZE) # cache LRU de resultados --> clave: (use_stemming, nodo de la query), valor: posting list
+        self.jobs = 1 # procesos con los que se resuelven las listas de queries (-L, -T), se cambia con self.set_jobs()
+        self.batch = None # queryparser.BatchPlan de la lista de queries que se está resolviendo, ver self.start_batch()
+        self.batch_stats = None # estadísticas de la última lista de queries, ver BatchPlan.stats()
 
         # ALT ANADIR 
 
+    @property
+    def stemmer(self):
+        """
+        Stemmer en castellano. nltk tarda en importarse, así que solo se importa la primera
+        vez que se usa el stemmer (al indexar con stemming o al buscar con -S).
+
+        """
+        if self._stemmer is None:
+            from nltk.stem.snowball import SnowballStemmer
+            self._stemmer = SnowballStemmer('spanish')
+        return self._stemmer
+
+    def __getattr__(self, name:str):
+        """
+        Solo se llama si el atributo no existe: carga las secciones del índice binario
+        pendientes (self.lazy) la primera vez que se usan, ver self.load_disk().
+
+        """
+        lazy = self.__dict__.get('lazy')
+        if lazy and name in lazy:
+            value = lazy.pop(name)()
+            setattr(self, name, value)
+            return value
+        raise AttributeError(name)
+
     ###############################
     ###                         ###
     ###      CONFIGURACION      ###
@@ -82,8 +173,19 @@ class SAR_Indexer:
         """
 
         self.use_spelling = use_spelling
-        vocabulary = self.index['all'].keys()
-        self.speller = SpellSuggester(opcionesSpell, list(vocabulary), distance, threshold)
+        # las correcciones guardadas en la cache dependen del corrector
+        self.cache.clear()
+        if not use_spelling:
+            # sin corrector no se hace ningún trabajo con el vocabulario
+            self.speller = None
+            return
+        # el vocabulario es el diccionario global de términos, pero solo se buscan los
+        # términos de 'all', agrupados por longitud al indexar si se construyó con 'spelling'
+        # numpy (distancias) solo se importa si se usa el corrector
+        from distancias import opcionesSpell
+        from spellsuggester import SpellSuggester, length_buckets
+        buckets = self.spell_buckets or length_buckets(self.term_list, self.index['all'])
+        self.speller = SpellSuggester(opcionesSpell, self.term_list, distance, threshold, buckets)
 
     def set_showall(self, v:bool):
         """
@@ -115,6 +217,29 @@ class SAR_Indexer:
         self.show_snippet = v
 
 
+    def set_jobs(self, n:int):
+        """
+
+        Cambia el número de procesos con los que se resuelven las listas de queries de
+        self.solve_and_count() y self.solve_and_test(), ver self.count_queries().
+
+        input: "n" entero.
+
+        """
+        self.jobs = max(1, n)
+
+
+    def set_cache(self, size:int):
+        """
+
+        Cambia el número máximo de resultados guardados en la cache (0 la desactiva).
+
+        input: "size" entero.
+
+        """
+        self.cache.resize(size)
+
+
     def set_stemming(self, v:bool):
         """
 
@@ -140,24 +265,211 @@ class SAR_Indexer:
 
     def save_info(self, filename:str):
         """
-        Guarda la información del índice en un fichero en formato binario
-        
+        Guarda la información del índice en un fichero en formato binario, ver diskindex.
+
+        El diccionario de términos se guarda ordenado y el id de cada término pasa a ser su
+        posición en ese orden. Las posting lists de self.index y self.sindex y el permuterm
+        van en secciones que se leen con mmap, el resto de atributos en la cabecera.
+
+        El fichero se escribe con otro nombre y se renombra al terminar, así los procesos
+        que tienen abierto el índice anterior (o el propio índice si se ha cargado para
+        añadirle artículos) siguen leyendo un fichero completo. Si el índice se ha mezclado
+        en disco (ver self.write_runs()) ese fichero ya tiene los términos y las postings,
+        se le añade el resto y es el que se renombra.
+
         """
-        info = [self.all_atribs] + [getattr(self, atr) for atr in self.all_atribs]
-        with open(filename, 'wb') as fh:
-            pickle.dump(info, fh)
+        with self.build_stats.phase('save'):
+            if self.merged is None:
+                tmp = filename + '.tmp'
+                fh = open(tmp, 'wb')
+                out = diskindex.Writer(fh)
+                header, new_id = self.write_index(out)
+            else:
+                # self.write_runs() ya ha escrito el diccionario de términos y los índices,
+                # con los ids definitivos: solo falta el resto de secciones
+                tmp = self.merged
+                fh = open(tmp, 'r+b')
+                out = diskindex.Writer.resume(fh)
+                header = dict(self.disk.header)
+                new_id = range(len(self.term_list))
+            with fh:
+                header['attrs'] = {atr: getattr(self, atr) for atr in self.all_atribs
+                                   if atr not in self.disk_atribs}
+                # los artId son consecutivos desde 1
+                arts = range(1, len(self.articles) + 1)
+                header['articles'] = (out.strings(self.articles[a][0] for a in arts),
+                                      out.strings(self.articles[a][1] for a in arts))
+                header['urls'] = out.section(pickle.dumps(self.urls))
+                header['spell_buckets'] = out.groups({n: sorted(new_id[t] for t in bucket)
+                                                      for n, bucket in self.spell_buckets.items()})
+                header['artpos'] = out.section(self.artpos)
+                out.close(header)
+            if self.merged is None:
+                os.replace(tmp, filename)
+            else:
+                self.move_merged(filename)
+
+    def move_merged(self, filename:str):
+        """
+        Mueve a "filename" el índice que ha escrito self.write_runs() (ya completo, ver
+        self.save_info()) y borra el directorio temporal de los runs.
+
+        """
+        import errno
+        import shutil
+        try:
+            os.replace(self.merged, filename)
+        except OSError as e:
+            # el directorio temporal está en otro sistema de ficheros: se copia con otro
+            # nombre junto a "filename" y se renombra, como en self.save_info()
+            if e.errno != errno.EXDEV:
+                raise
+            shutil.copyfile(self.merged, filename + '.tmp')
+            os.replace(filename + '.tmp', filename)
+        shutil.rmtree(self.run_dir, ignore_errors=True)
+        self.run_dir = None
+        self.merged = None
+
+    def sorted_ids(self) -> tuple:
+        """
+        Ids de los términos en el índice guardado, que son su posición en orden alfabético.
+
+        return: par (lista con el id actual de cada término en orden alfabético, array con
+                el id en el índice guardado de cada id actual)
+        """
+        order = sorted(range(len(self.term_list)), key=self.term_list.__getitem__)
+        new_id = array('I', bytes(4 * len(order)))
+        for tid, old in enumerate(order):
+            new_id[old] = tid
+        return order, new_id
+
+    def write_index(self, out:diskindex.Writer) -> tuple:
+        """
+        Escribe con "out" el diccionario de términos ordenado y las posting lists de
+        self.index, self.sindex y self.ptindex con los ids de los términos en ese orden.
+
+        return: par (cabecera con las secciones escritas, array con el id en el índice
+                guardado de cada id actual)
+        """
+        order, new_id = self.sorted_ids()
+        header = {'terms': out.strings(self.term_list[old] for old in order), 'index': {}}
+        for field, findex in self.index.items():
+            postings = [None] * len(order)
+            # las postings que no han cambiado desde load_info() se copian sin decodificar
+            items = findex.raw_items() if isinstance(findex, diskindex.Overlay) else findex.items()
+            for old, posting in items:
+                postings[new_id[old]] = posting
+            header['index'][field] = out.postings(postings)
+        header['sindex'] = {}
+        for field, sfield in self.sindex.items():
+            items = sfield.raw_items() if isinstance(sfield, diskindex.Overlay) else sfield.items()
+            stems = sorted(items, key=lambda item: item[0])
+            header['sindex'][field] = (out.strings(stem for stem, _ in stems),
+                                       out.postings([posting for _, posting in stems]))
+        header['ptindex'] = {}
+        for field, (rots, ids) in self.ptindex.items():
+            header['ptindex'][field] = (out.strings(rots), out.section(array('I', (new_id[t] for t in ids))))
+        return header, new_id
 
     def load_info(self, filename:str):
         """
-        Carga la información del índice desde un fichero en formato binario
-        
+        Carga la información del índice desde un fichero en formato binario.
+
+        Los índices binarios (diskindex) se abren con mmap y solo se lee su cabecera, los
+        guardados con pickle por versiones anteriores se cargan enteros.
+
         """
+        # los ficheros abiertos por get_article() y los resultados de la cache pueden ser de otro índice
+        for fh in self.doc_handles.values():
+            fh.close()
+        self.doc_handles = {}
+        self.cache.clear()
+        if diskindex.is_disk_index(filename):
+            self.load_disk(filename)
+            return
+        self.disk = None
+        self.lazy = {}
         #info = [self.all_atribs] + [getattr(self, atr) for atr in self.all_atribs]
         with open(filename, 'rb') as fh:
             info = pickle.load(fh)
         atrs = info[0]
         for name, val in zip(atrs, info[1:]):
-            setattr(self, name, val)
+            # los índices antiguos guardaban también el tokenizador y el stemmer
+            if name in self.all_atribs:
+                setattr(self, name, val)
+        if 'terms' not in atrs:
+            self.upgrade_index()
+
+    def load_disk(self, filename:str):
+        """
+        Abre un índice binario. self.index, self.sindex, self.ptindex y el diccionario de
+        términos quedan como vistas de solo lectura sobre el mmap, ver diskindex.
+
+        Cada sección se abre la primera vez que se usa: el índice de un campo, su índice
+        de stems y su permuterm al pedirlos (diskindex.LazyMap), y self.urls, self.articles
+        y self.artpos al acceder al atributo (ver self.__getattr__()). Una consulta sin
+        comodines no abre el permuterm y una que solo usa 'title:' no abre 'all'.
+
+        """
+        self.disk = disk = diskindex.Reader(filename)
+        header = disk.header
+        for name, val in header['attrs'].items():
+            if name in self.all_atribs:
+                setattr(self, name, val)
+        self.open_index(disk)
+        self.lazy = {'articles': partial(disk.articles, header['articles']),
+                     'urls': partial(disk.pickled, header['urls']),
+                     'artpos': lambda: disk.block(header['artpos']).cast('Q'),
+                     'spell_buckets': partial(disk.groups, header['spell_buckets'])}
+        for name in self.lazy:
+            self.__dict__.pop(name, None)
+
+    def open_index(self, disk:diskindex.Reader):
+        """
+        Abre el diccionario de términos, self.index, self.sindex y self.ptindex del índice
+        binario "disk" (los índices de cada campo, al pedirlos por primera vez).
+
+        """
+        header = disk.header
+        self.term_list = disk.open(header['terms'])
+        self.terms = diskindex.SortedDict(self.term_list)
+        self.index = diskindex.LazyMap({field: partial(disk.open, desc)
+                                        for field, desc in header['index'].items()})
+        self.sindex = diskindex.LazyMap({field: partial(disk.stems, desc)
+                                         for field, desc in header['sindex'].items()})
+        self.ptindex = diskindex.LazyMap({field: partial(disk.permuterm, desc)
+                                          for field, desc in header['ptindex'].items()})
+
+    def make_writable(self):
+        """
+        Prepara un índice binario abierto con self.load_disk() para añadirle artículos (ver
+        self.append_index()). Las postings y los artículos siguen en el mmap, los que se
+        añaden o cambian se guardan encima (diskindex.Overlay). Solo se copian a memoria el
+        diccionario de términos, el permuterm, self.artpos y los datos del corrector, a los
+        que se añaden elementos. No hace nada si el índice ya está en memoria.
+
+        """
+        if self.disk is None or isinstance(self.terms, dict):
+            return
+        self.term_list = list(self.term_list)
+        self.terms = {term: tid for tid, term in enumerate(self.term_list)}
+        self.index = {field: diskindex.Overlay(findex) for field, findex in self.index.items()}
+        self.sindex = {field: diskindex.Overlay(sfield) for field, sfield in self.sindex.items()}
+        self.ptindex = {field: (list(rots), array('I', ids)) for field, (rots, ids) in self.ptindex.items()}
+        self.articles = diskindex.Overlay(self.articles)
+        self.artpos = array('Q', self.artpos)
+        self.spell_buckets = {n: array('I', bucket) for n, bucket in self.spell_buckets.items()}
+
+    def upgrade_index(self):
+        """
+        Adapta un índice guardado por una versión anterior, con los términos como claves de
+        self.index y pares (permuterm, término) en self.ptindex, al diccionario global de términos.
+
+        """
+        for field, findex in self.index.items():
+            self.index[field] = FieldIndex((self.term_id(t), p) for t, p in findex.items())
+        for field, ptfield in self.ptindex.items():
+            self.ptindex[field] = self.split_permuterms([(p, self.term_id(t)) for p, t in ptfield])
 
     ###############################
     ###                         ###
@@ -186,42 +498,115 @@ class SAR_Indexer:
         Recorre recursivamente el directorio "root" e indexa su contenido
         los argumentos adicionales "**args" solo son necesarios para las funcionalidades ampliadas
 
-        """
-        self.multifield = args['multifield']
-        self.positional = args['positional']
-        self.stemming = args['stem']
-        self.permuterm = args['permuterm']
-
+        si "workers" es mayor que 1 los ficheros (y los trozos de los ficheros grandes) se
+        reparten entre un pool de procesos, ver self.index_parallel()
+
+        si "append" es True se añade al índice cargado con self.load_info() el contenido de
+        los ficheros que todavía no se han indexado, con las mismas opciones con las que se
+        construyó, ver self.append_index()
+
+        """
+        self.build_stats.start('index_dir')
+        append = args.get('append', False)
+        # los resultados guardados dejan de ser válidos al cambiar el índice
+        self.cache.clear()
+        if not append:
+            self.multifield = args['multifield']
+            self.positional = args['positional']
+            self.stemming = args['stem']
+            self.permuterm = args['permuterm']
+            self.spelling = args.get('spelling', False)
+        workers = args.get('workers') or 1
+        if args.get('memory'):
+            self.memory_budget = int(args['memory'] * 2**20)
+
+        from pathlib import Path
         file_or_dir = Path(root)
         
+        # lista de ficheros a indexar, en el mismo orden en el que se recorren
+        filenames = []
+        indexed = set(self.docs.values())
         if file_or_dir.is_file():
             # is a file
-            self.index_file(root)
+            if root not in indexed:
+                self.docs[len(self.docs) + 1] = root
+                filenames.append((len(self.docs), root))
         elif file_or_dir.is_dir():
             # is a directory
             for d, _, files in os.walk(root):
                 for filename in sorted(files):
                     if filename.endswith('.json'):
                         fullname = os.path.join(d, filename)
+                        # los ficheros ya indexados no se vuelven a leer
+                        if fullname in indexed:
+                            continue
                         # anade el documento al self.docs para su uso posterior
                         self.docs[len(self.docs) + 1] = fullname
-                        # indexa un documento
-                        self.index_file(fullname)
+                        filenames.append((len(self.docs), fullname))
         else:
             print(f"ERROR:{root} is not a file nor directory!", file=sys.stderr)
             sys.exit(-1)
 
+        # al añadir, los ficheros nuevos se indexan aparte y luego se mezclan con el índice existente
+        if append:
+            # el índice binario se lee del mmap, solo se copia lo que cambia
+            self.make_writable()
+            old_index = self.index
+            self.index = {}
+
+        if workers > 1:
+            self.index_parallel(filenames, workers, append)
+        else:
+            for docid, fullname in filenames:
+                # indexa un documento
+                self.index_file(fullname, docid)
+
+        # si se ha volcado algún índice parcial a disco hay que mezclarlos: al añadir, en
+        # memoria; si no, directamente en el fichero del índice, con los stems y el permuterm
+        if self.runs:
+            with self.build_stats.phase('merge_runs'):
+                if append:
+                    self.merge_runs()
+                else:
+                    self.write_runs(stems=self.stemming and workers == 1, permuterm=self.permuterm and workers == 1)
+
+        if append:
+            with self.build_stats.phase('append_index'):
+                self.append_index(old_index)
+            self.build_stats.stop()
+            return
+
         ##########################################
         ## COMPLETAR PARA FUNCIONALIDADES EXTRA ##
         ##########################################
 
         # si se quiere usar stemming, se llama a la función para crear el stemming
-        if(self.stemming):
-            self.make_stemming()
+        # (al indexar en paralelo ya lo han hecho los procesos, ver self.index_parallel(),
+        # y al mezclar los runs en disco self.write_runs())
+        if(self.stemming and workers == 1 and self.merged is None):
+            with self.build_stats.phase('make_stemming'):
+                self.make_stemming()
 
         # si se quiere usar permuterm, se llama a la función para crear permuterm
-        if(self.permuterm):
-            self.make_permuterm()
+        if(self.permuterm and workers == 1 and self.merged is None):
+            with self.build_stats.phase('make_permuterm'):
+                self.make_permuterm()
+
+        # las posting lists se guardan comprimidas (las mezcladas en disco ya lo están)
+        if self.merged is None:
+            with self.build_stats.phase('compress'):
+                self.compress_index()
+        if workers > 1 and self.merged is None:
+            # las postings llegan ya comprimidas de los procesos, su tamaño se mide al final
+            self.posting_bytes[1] = sum(posting.nbytes() for findex in [*self.index.values(), *self.sindex.values()]
+                                        for _, posting in findex.items())
+
+        # si se quiere, se guardan en el índice los datos del corrector ortográfico
+        if self.spelling:
+            with self.build_stats.phase('make_spelling'):
+                self.make_spelling()
+
+        self.build_stats.stop()
         
         
         
@@ -249,19 +634,61 @@ class SAR_Indexer:
         article['section-name'] = '\n'.join(sec_names)
 
         return article
-                
-    
-    def index_file(self, filename:str):
+
+
+    def tokenize_article(self, raw_line:str) -> Dict:
         """
+        Parsea un artículo del crawler tokenizando UNA sola vez su texto.
 
-        Indexa el contenido de un fichero.
-        
-        input: "filename" es el nombre de un fichero generado por el Crawler cada línea es un objeto json
-            con la información de un artículo de la Wikipedia
+        Los trozos del artículo (título, resumen y nombre y texto de cada sección y
+        subsección) se juntan en el mismo orden en el que self.parse_article() construye
+        'all', separados por self.PIECE_SEP, que self.PIECE_RE devuelve como un token más.
+        La posición de los separadores en la lista de tokens marca dónde empieza cada trozo
+        y los tokens de cada campo se sacan con slices. Los tokens (y sus posiciones) de
+        'all' son los mismos que los de self.tokenize(article['all']).
 
-        NECESARIO PARA TODAS LAS VERSIONES
+        Args:
+            raw_line: una linea del fichero generado por el crawler
 
-        dependiendo del valor de self.multifield y self.positional se debe ampliar el indexado
+        Returns:
+            Dict: claves: 'url', 'title' y 'tokens' (campo -> lista de tokens)
+        """
+        self.build_stats.start('parse_article')
+        with self.build_stats.phase('json_decode'):
+            article = json.loads(raw_line)
+        pieces = [article['title'], article['summary']]
+        for sec in article['sections']:
+            pieces += (sec['name'], sec['text'])
+            for subsec in sec['subsections']:
+                pieces += (subsec['name'], subsec['text'])
+        sep = self.PIECE_SEP
+        text = sep.join(pieces)
+        if text.count(sep) >= len(pieces):
+            # el separador aparece en el texto, donde no forma parte de ningún token
+            text = sep.join(piece.replace(sep, ' ') for piece in pieces)
+        with self.build_stats.phase('tokenize'):
+            tokens = self.PIECE_RE.findall(text.lower())
+            # bounds[k] es la posición del separador que precede al trozo k-ésimo
+            bounds = [-1]
+            for _ in range(len(pieces) - 1):
+                bounds.append(tokens.index(sep, bounds[-1] + 1))
+            bounds.append(len(tokens))
+            # después del título y el resumen los trozos son parejas (nombre, texto)
+            sec_names = []
+            for k in range(2, len(pieces), 2):
+                sec_names += tokens[bounds[k] + 1:bounds[k + 1]]
+            all_tokens = [token for token in tokens if token != sep]
+        self.build_stats.stop()
+
+        return {'url': article['url'], 'title': article['title'],
+                'tokens': {'all': all_tokens, 'title': tokens[:bounds[1]],
+                           'summary': tokens[bounds[1] + 1:bounds[2]], 'section-name': sec_names}}
+                
+    
+    def fields_to_index(self) -> List[str]:
+        """
+        Devuelve la lista de campos que se tokenizan, dependiendo de self.multifield.
+        El campo 'url' no se tokeniza, se indexa aparte en self.index_article()
 
         """
         fields_to_tokenize = []
@@ -273,122 +700,760 @@ class SAR_Indexer:
         else:
             fields_to_tokenize.append(self.def_field)
 
+        return fields_to_tokenize
+
+
+    def index_file(self, filename:str, docid:Optional[int]=None):
+        """
+
+        Indexa el contenido de un fichero.
+        
+        input: "filename" es el nombre de un fichero generado por el Crawler cada línea es un objeto json
+            con la información de un artículo de la Wikipedia
+               "docid" es el id del fichero en self.docs, si es None se añade a self.docs
+
+        NECESARIO PARA TODAS LAS VERSIONES
+
+        dependiendo del valor de self.multifield y self.positional se debe ampliar el indexado
+
+        """
+        fields_to_tokenize = self.fields_to_index()
+        if docid is None:
+            self.docs[len(self.docs) + 1] = filename
+            docid = len(self.docs)
 
         """
             para cada artículo del file
+            se lee en binario para saber el byte en el que empieza cada línea
         """
-        for i, line in enumerate(open(filename)):
-            """
-                consigue el artículo separando sus fields
-            """
-            j = self.parse_article(line)
+        with open(filename, 'rb') as fh:
+            offset = 0
+            for line in fh:
+                """
+                    consigue el artículo separando sus fields
+                """
+                j = self.tokenize_article(line)
+                j['docpos'] = (docid, offset, len(line))
+                offset += len(line)
+                with self.build_stats.phase('posting_insertion'):
+                    self.index_article(j, fields_to_tokenize)
+                self.check_memory()
 
 
+    def index_article(self, j:Dict, fields_to_tokenize:List[str]):
+        """
+
+        Indexa un artículo ya tokenizado con self.tokenize_article().
+
+        param:  "j": diccionario con la url, el título y los tokens de cada campo del artículo,
+                     y su posición (docid, byte inicial, longitud) en 'docpos'
+                "fields_to_tokenize": campos que se deben tokenizar, ver self.fields_to_index()
+
+        """
+
         #################
         ### COMPLETAR ###
         #################
+        """
+            inicia la id de los artículos a cero
+        """
+        artId = 0;
+        
+        """
+            si el artículo todavía no se ha analizado, se añade a los artículos ya vistos
+            sumando uno a la longitud de los artículos analizados (artId)
+            se guarda en su posición de self.articles su url y título para identificación
+            y posterior uso
+            también se añade su url a self.urls para podes comprobar que ya se ha analizado
+        """
+        if(not self.already_in_index(j)):
+            artId = len(self.articles) + 1
+            self.articles[artId] = [j['url'], j['title']]
+            self.urls.add(j['url'])
+            self.artpos.extend(j['docpos'])
+            self.build_stats.count('articles')
+
+            """ 
+                si no se quiere usar el índice posicional:
+                    1. recorre los fields indicados menos 'url' que no debe tokenizarse
+                    2. toma los tokens del field y los deja en tk
+                    3. si el field no está en el índice, añade el diccionario
+                    4. por cada token en tk:
+                        4.1 si no está el término en el índice del field, añade la lista y el artId
+                        4.2 si está en el índice, añade el artId a la lista del término
+                    5. si hace falta se crea el índice para el field url
+                    6. si no comprueba si está el url en el índica, si no está crea su lista
+                    7. añade el artId a la lista de la url
             """
-                inicia la id de los artículos a cero
-            """
-            artId = 0;
-            
-            """
-                si el artículo todavía no se ha analizado, se añade a los artículos ya vistos
-                sumando uno a la longitud de los artículos analizados (artId)
-                se guarda en su posición de self.articles su url y título para identificación
-                y posterior uso
-                también se añade su url a self.urls para podes comprobar que ya se ha analizado
-            """
-            if(j['url'] not in self.urls):
-                artId = len(self.articles) + 1
-                self.articles[artId] = [j['url'], j['title']]
-                self.urls.add(j['url'])
-
-                """ 
-                    si no se quiere usar el índice posicional:
-                        1. recorre los fields indicados menos 'url' que no debe tokenizarse
-                        2. tokeniza y field y deja el resultado en tk
-                        3. si el field no está en el índice, añade el diccionario
-                        4. por cada token en tk:
-                            4.1 si no está el término en el índice del field, añade la lista y el artId
-                            4.2 si está en el índice, añade el artId a la lista del término
-                        5. si hace falta se crea el índice para el field url
-                        6. si no comprueba si está el url en el índica, si no está crea su lista
-                        7. añade el artId a la lista de la url
-                """
 
-                # si no se quiere usar el índice posicional 
-                if(self.positional == False):
-                    # para cada field
-                    for field in fields_to_tokenize:
-                        tk = self.tokenize(j[field])
-                        if(field not in self.index):
-                            self.index[field] = {}
-                         # para cada token
-                        for t in tk:
-                           if(t not in self.index[field]):
-                                self.index[field][t] = []
-                                self.index[field][t].append(artId)
-                           else:
-                               if(artId not in self.index[field][t]):
-                                self.index[field][t].append(artId)   
-                    
-                    # field url
-                    if('url' not in self.index):
-                        self.index['url'] = {}
-                    if(j['url'] not in self.index['url']):
-                        self.index['url'][j['url']] = []
-                    self.index['url'][j['url']].append(artId)
-                    
-                """ 
-                    si se quiere usar el índice posicional:
-                        1. recorre los fields indicados menos 'url' que no debe tokenizarse
-                        2. tokeniza y field y deja el resultado en tk
-                        3. si el field no está en el índice, añade el diccionario
-                        4. por cada token en tk:
-                            4.1 si no está el término en el índice del field, añade su diccionario,
-                                añade la lista del artId y la posición correspondiente dentro del artículo.
-                            4.2 si está en el índice:
-                                4.2.1 si no está el artículo en el término, se añade su lista y la posición
-                                4.2.2 si está el artículo en el término, se añade la posición a su lista.
-                        5. si hace falta se crea el índice para el field url
-                        6. comprueba:
-                            6.1 si el término no está en 'url' crea el diccionario
-                            6.2 si el término está en 'url':
-                                6.2.1 si no está el artículo en el término, crea su lista 
-                        7. añade la posición cero a la lista del artículo
-                """
+            # si no se quiere usar el índice posicional 
+            if(self.positional == False):
+                # para cada field
+                for field in fields_to_tokenize:
+                    tk = self.term_ids(j['tokens'][field])
+                    self.tokens_in_memory += len(tk)
+                    self.build_stats.count('tokens', len(tk))
+                    if(field not in self.index):
+                        self.index[field] = {}
+                     # para cada token
+                    for t in tk:
+                       if(t not in self.index[field]):
+                            self.index[field][t] = []
+                            self.index[field][t].append(artId)
+                       else:
+                           if(artId not in self.index[field][t]):
+                            self.index[field][t].append(artId)   
+                
+                # field url
+                t = self.term_id(j['url'])
+                if('url' not in self.index):
+                    self.index['url'] = {}
+                if(t not in self.index['url']):
+                    self.index['url'][t] = []
+                self.index['url'][t].append(artId)
+                
+            """ 
+                si se quiere usar el índice posicional:
+                    1. recorre los fields indicados menos 'url' que no debe tokenizarse
+                    2. toma los tokens del field y los deja en tk
+                    3. si el field no está en el índice, añade el diccionario
+                    4. por cada token en tk:
+                        4.1 si no está el término en el índice del field, añade su diccionario,
+                            añade la lista del artId y la posición correspondiente dentro del artículo.
+                        4.2 si está en el índice:
+                            4.2.1 si no está el artículo en el término, se añade su lista y la posición
+                            4.2.2 si está el artículo en el término, se añade la posición a su lista.
+                    5. si hace falta se crea el índice para el field url
+                    6. comprueba:
+                        6.1 si el término no está en 'url' crea el diccionario
+                        6.2 si el término está en 'url':
+                            6.2.1 si no está el artículo en el término, crea su lista 
+                    7. añade la posición cero a la lista del artículo
+            """
 
-                if self.positional:
-
-                    # recorre los fields
-                    for field in fields_to_tokenize:
-                        tk = self.tokenize(j[field])
-                        if field not in self.index:
-                            self.index[field] = {}
-                        # recorre los tokens consiguiendo sus posiciones
-                        for i, t in enumerate(tk):
-                            if(t not in self.index[field]):
-                                self.index[field][t] = {}
+            if self.positional:
+
+                # recorre los fields
+                for field in fields_to_tokenize:
+                    tk = self.term_ids(j['tokens'][field])
+                    self.tokens_in_memory += len(tk)
+                    self.build_stats.count('tokens', len(tk))
+                    if field not in self.index:
+                        self.index[field] = {}
+                    # recorre los tokens consiguiendo sus posiciones
+                    for i, t in enumerate(tk):
+                        if(t not in self.index[field]):
+                            self.index[field][t] = {}
+                            self.index[field][t][artId] = []
+                            self.index[field][t][artId].append(i)
+                        else:
+                            if artId not in self.index[field][t]:
                                 self.index[field][t][artId] = []
                                 self.index[field][t][artId].append(i)
                             else:
-                                if artId not in self.index[field][t]:
-                                    self.index[field][t][artId] = []
-                                    self.index[field][t][artId].append(i)
-                                else:
-                                    self.index[field][t][artId].append(i)
-
-                    # field url
-                    t = j['url']
-                    if 'url' not in self.index:
-                        self.index['url'] = {}
-                    if t not in self.index['url']:
-                        self.index['url'][t] = {}
-                    if artId not in self.index['url'][t]:
-                        self.index['url'][t][artId] = []
-                    self.index['url'][t][artId].append(0)
-        
+                                self.index[field][t][artId].append(i)
+
+                # field url
+                t = self.term_id(j['url'])
+                if 'url' not in self.index:
+                    self.index['url'] = {}
+                if t not in self.index['url']:
+                    self.index['url'][t] = {}
+                if artId not in self.index['url'][t]:
+                    self.index['url'][t][artId] = []
+                self.index['url'][t][artId].append(0)
+
+
+    def term_id(self, term:str) -> int:
+        """
+        Devuelve el id de "term" en el diccionario global de términos, si no está se le
+        asigna el siguiente id libre.
+
+        """
+        tid = self.terms.get(term)
+        if tid is None:
+            tid = len(self.term_list)
+            self.terms[term] = tid
+            self.term_list.append(term)
+        return tid
+
+
+    def term_ids(self, tokens:List[str]) -> List[int]:
+        """
+        Traduce una lista de tokens a sus ids, ver self.term_id()
+
+        """
+        terms = self.terms
+        return [terms[t] if t in terms else self.term_id(t) for t in tokens]
+
+
+    def term_posting(self, field:str, term:str):
+        """
+        Devuelve la posting list (sin decodificar) de "term" en el índice de "field".
+        Lanza KeyError si el término no está en el índice.
+
+        """
+        return self.index[field][self.terms[term]]
+
+
+    def index_parallel(self, filenames:List[str], workers:int, append:bool=False):
+        """
+
+        Indexa los ficheros "filenames" repartiéndolos entre "workers" procesos.
+
+        Los ficheros grandes se dividen en trozos de self.CHUNK_BYTES bytes (cortando siempre
+        en un salto de línea). Cada proceso construye un índice parcial de su trozo con ids
+        locales, con sus stems, su permuterm y las postings ya comprimidas (ver index_chunk()),
+        y el proceso principal los mezcla EN ORDEN con self.merge_partial(), de forma que los
+        artId quedan asignados igual que en la indexación secuencial.
+
+        param:  "filenames": pares (docid, fichero) a indexar, en orden
+                "workers": número de procesos
+                "append": si es True los procesos no calculan los stems ni el permuterm, los
+                          actualiza self.append_index() solo con los términos afectados
+
+        """
+        stemming = self.stemming and not append
+        permuterm = self.permuterm and not append
+        tasks = []
+        for docid, filename in filenames:
+            size = os.path.getsize(filename)
+            for start in range(0, max(size, 1), self.CHUNK_BYTES):
+                tasks.append((filename, docid, start, start + self.CHUNK_BYTES,
+                              self.multifield, self.positional, stemming, permuterm))
+
+        import multiprocessing
+        with multiprocessing.Pool(workers) as pool:
+            # imap devuelve los resultados en el orden de las tareas
+            for *partial_index, raw, stats in pool.imap(index_chunk, tasks):
+                self.build_stats.merge(stats)
+                self.posting_bytes[0] += raw
+                with self.build_stats.phase('merge_partial'):
+                    self.merge_partial(*partial_index)
+                self.check_memory()
+
+        # el permuterm de cada campo (permuterm -> id del término) se ordena una sola vez al final
+        if permuterm:
+            for field, ptfield in self.ptindex.items():
+                rots = sorted(ptfield)
+                self.ptindex[field] = rots, array('I', map(ptfield.__getitem__, rots))
+
+
+    def memory_estimate(self) -> int:
+        """
+        Estimación (en bytes) de la memoria ocupada por el índice en construcción.
+        Se cuenta un coste fijo por cada término y por cada token indexado desde el último volcado.
+
+        """
+        terms = sum(len(terms) for terms in self.index.values())
+        return terms * self.TERM_BYTES + self.tokens_in_memory * self.POSTING_BYTES
+
+
+    def check_memory(self):
+        """
+        Si se ha fijado un presupuesto de memoria (self.memory_budget) y el índice en
+        construcción lo supera, se vuelca a disco con self.flush_run().
+
+        """
+        if self.memory_budget is not None and self.memory_estimate() > self.memory_budget:
+            with self.build_stats.phase('flush_run'):
+                self.flush_run()
+
+
+    def flush_run(self):
+        """
+        Vuelca el índice en construcción a un fichero temporal (run) ordenado por campo y
+        término y vacía self.index. Los términos van en orden alfabético, que es el de sus
+        ids en el índice guardado (ver self.sorted_ids()), así self.write_runs() puede
+        escribir las postings mezcladas directamente en el fichero del índice.
+        Cada entrada del run es un pickle independiente (campo, id del término, posting) para
+        poder leerlo de forma secuencial en self.merged_postings().
+
+        """
+        if not self.index:
+            return
+        filename = self.run_file(f'run_{len(self.runs)}.bin')
+        with open(filename, 'wb') as fh:
+            for field in sorted(self.index):
+                findex = self.index[field]
+                for t in sorted(findex, key=self.term_list.__getitem__):
+                    pickle.dump((field, t, findex[t]), fh, pickle.HIGHEST_PROTOCOL)
+        self.runs.append(filename)
+        self.index = {}
+        self.tokens_in_memory = 0
+
+
+    def run_file(self, name:str) -> str:
+        """
+        Devuelve la ruta de un fichero temporal dentro de self.run_dir, que se crea si no existe.
+
+        """
+        if self.run_dir is None:
+            import tempfile
+            self.run_dir = tempfile.mkdtemp(prefix='sar_runs_')
+        return os.path.join(self.run_dir, name)
+
+
+    def read_run(self, filename:str):
+        """
+        Generador con las entradas de un run en orden.
+
+        """
+        with open(filename, 'rb') as fh:
+            while True:
+                try:
+                    yield pickle.load(fh)
+                except EOFError:
+                    return
+
+
+    def merged_postings(self):
+        """
+        Mezcla (k-way merge) todos los runs volcados a disco. Generador con las entradas
+        (campo, id del término, posting) ordenadas por campo y término (ver
+        self.flush_run()), con la posting completa de cada término, comprimida si viene de
+        self.index_parallel() y sin comprimir si no. Al terminar se borran los runs.
+
+        Los runs se generan en orden de artId, así que las posting lists de un mismo término
+        en runs sucesivos se pueden concatenar directamente.
+
+        """
+        # lo que quede en memoria se vuelca también para mezclarlo en el mismo paso
+        self.flush_run()
+        term_list = self.term_list
+        # la posición del run en la clave de mezcla mantiene el orden de los artId
+        streams = [((field, t, n, posting) for field, t, posting in self.read_run(run))
+                   for n, run in enumerate(self.runs)]
+        entry = None
+        for field, t, _, posting in heapq.merge(*streams, key=lambda e: (e[0], term_list[e[1]], e[2])):
+            if entry is None or entry[:2] != (field, t):
+                # la posting del término anterior ya está completa
+                if entry is not None:
+                    yield entry
+                entry = (field, t, posting)
+            elif isinstance(posting, CompressedPosting):
+                # runs de un índice construido en paralelo, ver self.merge_partial()
+                entry[2].concat(posting)
+            elif self.positional:
+                entry[2].update(posting)
+            else:
+                entry[2].extend(posting)
+        if entry is not None:
+            yield entry
+        for run in self.runs:
+            os.remove(run)
+        self.runs = []
+
+
+    def merge_runs(self):
+        """
+        Mezcla los runs volcados a disco en self.index, con las postings comprimidas.
+
+        Solo se usa al añadir artículos a un índice (ver self.append_index(), que necesita en
+        memoria el índice de los artículos nuevos); al construir un índice los runs se
+        mezclan directamente en el fichero con self.write_runs().
+
+        """
+        index = {}
+        for field, t, posting in self.merged_postings():
+            index.setdefault(field, {})[t] = self.compress_posting(posting)
+        self.index = index
+
+        import shutil
+        shutil.rmtree(self.run_dir, ignore_errors=True)
+        self.run_dir = None
+
+
+    def write_runs(self, stems:bool, permuterm:bool):
+        """
+        Mezcla los runs volcados a disco escribiendo el índice en un fichero binario
+        (self.merged) sin tenerlo entero en memoria: la posting de cada término se comprime
+        (de self.COMPRESS_BATCH en self.COMPRESS_BATCH, ver self.write_postings()) y se escribe en
+        cuanto está completa, y los términos llegan ya en el orden de sus ids en el fichero.
+
+        Al terminar, el diccionario de términos, self.index, self.sindex y self.ptindex son
+        vistas sobre el fichero, como en self.load_disk(), y self.save_info() solo le añade
+        el resto de secciones. En memoria solo quedan el vocabulario y sus rotaciones.
+
+        param:  "stems": si es True los stems de cada campo se calculan durante la mezcla,
+                         ver self.write_stems(); si no, se escriben los de self.sindex (los
+                         que ya han calculado los procesos de self.index_parallel())
+                "permuterm": si es True las rotaciones de cada término se generan durante
+                             la mezcla y se ordenan al terminar su campo; si no, se escriben
+                             las de self.ptindex
+        """
+        order, new_id = self.sorted_ids()
+        term_list = self.term_list
+        self.merged = self.run_file('index.bin')
+        with open(self.merged, 'wb') as fh:
+            out = diskindex.Writer(fh)
+            header = {'terms': out.strings(term_list[old] for old in order),
+                      'index': {}, 'sindex': {}, 'ptindex': {}}
+            stem_of = {}
+            for field, entries in itertools.groupby(self.merged_postings(), key=lambda e: e[0]):
+                table = out.posting_table()
+                batch = []
+                stem_docs = []
+                stem_runs = []
+                ndocs = 0
+                rots = []
+                for _, t, posting in entries:
+                    batch.append((new_id[t], posting))
+                    if len(batch) == self.COMPRESS_BATCH:
+                        self.write_postings(table, batch)
+                        batch = []
+                    if stems:
+                        term = term_list[t]
+                        stem = stem_of.get(term)
+                        if stem is None:
+                            stem = stem_of[term] = self.stemmer.stem(term)
+                        docs = doc_ids(posting)
+                        stem_docs.append((stem, docs))
+                        ndocs += len(docs)
+                        # los pares (stem, artIds) que no caben en memoria se vuelcan ordenados
+                        if (self.memory_budget is not None and
+                                len(stem_docs) * self.TERM_BYTES + ndocs * self.POSTING_BYTES > self.memory_budget):
+                            stem_runs.append(self.dump_stems(stem_docs, field, len(stem_runs)))
+                            stem_docs = []
+                            ndocs = 0
+                    if permuterm:
+                        rots.extend(self.permuterms(term_list[t], new_id[t]))
+                self.write_postings(table, batch)
+                header['index'][field] = table.close()
+                if stems:
+                    header['sindex'][field] = self.write_stems(out, stem_docs, stem_runs)
+                if permuterm:
+                    rots.sort()
+                    header['ptindex'][field] = (out.strings(rot for rot, _ in rots),
+                                                out.section(array('I', (tid for _, tid in rots))))
+            if not stems:
+                for field, sfield in self.sindex.items():
+                    stem_list = sorted(sfield.items(), key=lambda item: item[0])
+                    table = out.posting_table()
+                    self.write_postings(table, [(i, posting) for i, (_, posting) in enumerate(stem_list)])
+                    postings = table.close()
+                    header['sindex'][field] = (out.strings(stem for stem, _ in stem_list), postings)
+            if not permuterm:
+                for field, (rots, ids) in self.ptindex.items():
+                    header['ptindex'][field] = (out.strings(rots), out.section(array('I', (new_id[t] for t in ids))))
+        self.disk = diskindex.Reader(self.merged, header)
+        self.open_index(self.disk)
+
+
+    def write_postings(self, table:diskindex.PostingWriter, batch:List):
+        """
+        Comprime juntas (ver self.compress_postings()) las postings de los pares (id, posting)
+        de "batch" y las añade a "table" en ese orden.
+
+        """
+        for (tid, posting), compressed in zip(batch, self.compress_postings([posting for _, posting in batch])):
+            if isinstance(posting, CompressedPosting):
+                # las de los procesos de self.index_parallel() todavía no se han medido
+                self.posting_bytes[1] += compressed.nbytes()
+            table.add(tid, compressed)
+
+
+    def dump_stems(self, stem_docs:List, field:str, n:int) -> str:
+        """
+        Vuelca a un run los pares (stem, artIds) ordenados por stem, ver self.write_runs().
+
+        return: nombre del run
+        """
+        filename = self.run_file(f'stems_{field}_{n}.bin')
+        with open(filename, 'wb') as fh:
+            for pair in sorted(stem_docs, key=lambda pair: pair[0]):
+                pickle.dump(pair, fh, pickle.HIGHEST_PROTOCOL)
+        return filename
+
+
+    def write_stems(self, out:diskindex.Writer, stem_docs:List, stem_runs:List) -> tuple:
+        """
+        Escribe el índice de stems de un campo a partir de los pares (stem, artIds de un
+        término) de "stem_docs" y de los runs "stem_runs" (ver self.dump_stems()), que se
+        mezclan por stem. La posting de cada stem es la unión de las de sus términos, como
+        en self.make_stemming().
+
+        return: descripción del índice de stems para la cabecera, ver diskindex.Reader.stems()
+        """
+        stem_docs.sort(key=lambda pair: pair[0])
+        pairs = heapq.merge(stem_docs, *map(self.read_run, stem_runs), key=lambda pair: pair[0])
+        stem_list = []
+        table = out.posting_table()
+        batch = []
+        for stem, group in itertools.groupby(pairs, key=lambda pair: pair[0]):
+            batch.append((len(stem_list), sorted(set().union(*(docs for _, docs in group)))))
+            stem_list.append(stem)
+            if len(batch) == self.COMPRESS_BATCH:
+                self.write_postings(table, batch)
+                batch = []
+        self.write_postings(table, batch)
+        postings = table.close()
+        for run in stem_runs:
+            os.remove(run)
+        return out.strings(stem_list), postings
+
+
+    def is_dense(self, n:int) -> bool:
+        """
+        True si una posting de "n" artIds se guarda como BitmapPosting, ver self.DENSE_RATIO.
+
+        """
+        return n >= self.DENSE_MIN and n * self.DENSE_RATIO >= len(self.articles)
+
+
+    def compress_posting(self, posting):
+        """
+        Devuelve la versión comprimida (CompressedPosting) de una posting list y acumula
+        en self.posting_bytes los bytes antes y después de comprimirla.
+
+        Las de los términos que aparecen en muchos artículos (ver self.DENSE_RATIO) se
+        guardan como BitmapPosting, que ocupan menos y se operan con numpy. Las que ya están
+        comprimidas (las de self.index_parallel()) solo se pasan a bitmap si son densas.
+
+        """
+        dense = self.is_dense(len(posting))
+        if isinstance(posting, CompressedPosting):
+            if dense and not isinstance(posting, BitmapPosting):
+                return BitmapPosting.from_compressed(posting)
+            return posting
+        compressed = (BitmapPosting if dense else CompressedPosting).from_posting(posting)
+        self.posting_bytes[0] += raw_size(posting)
+        self.posting_bytes[1] += compressed.nbytes()
+        return compressed
+
+
+    def compress_postings(self, postings:list) -> list:
+        """
+        Devuelve self.compress_posting() de cada posting de la lista, pero las que no están
+        comprimidas se comprimen todas juntas con postings.compress_postings(), que codifica
+        sus gaps con numpy en vez de uno a uno. Las densas se pasan después a bitmap.
+
+        """
+        compressed, raw = compress_postings([posting for posting in postings
+                                             if not isinstance(posting, CompressedPosting)])
+        self.posting_bytes[0] += raw
+        compressed = iter(compressed)
+        res = []
+        for posting in postings:
+            if not isinstance(posting, CompressedPosting):
+                posting = next(compressed)
+                if self.is_dense(len(posting)):
+                    posting = BitmapPosting.from_compressed(posting)
+                self.posting_bytes[1] += posting.nbytes()
+            else:
+                posting = self.compress_posting(posting)
+            res.append(posting)
+        return res
+
+
+    def compress_index(self):
+        """
+        Sustituye todas las posting lists de self.index y self.sindex por su versión comprimida.
+        Los índices de cada campo pasan a ser FieldIndex (listas indexadas por el id del término).
+
+        """
+        for findex in list(self.index.values()) + list(self.sindex.values()):
+            keys = list(findex)
+            # de self.COMPRESS_BATCH en self.COMPRESS_BATCH, así no están en numpy todos los
+            # gaps de un campo a la vez y las postings sin comprimir se liberan por el camino
+            for i in range(0, len(keys), self.COMPRESS_BATCH):
+                batch = keys[i:i + self.COMPRESS_BATCH]
+                for key, posting in zip(batch, self.compress_postings([findex[key] for key in batch])):
+                    findex[key] = posting
+        for field, findex in self.index.items():
+            if not isinstance(findex, FieldIndex):
+                self.index[field] = FieldIndex(findex.items())
+
+
+    def append_index(self, old_index:Dict):
+        """
+        Mezcla el índice de los artículos nuevos (self.index) con el índice existente
+        "old_index". Los artId nuevos son mayores que los existentes, así que las posting
+        lists se amplían por el final.
+
+        Solo se tocan las postings, stems y permuterms afectados:
+            - las postings de los términos que ya estaban se copian y se amplían, las de los
+              términos nuevos se añaden
+            - a la posting de cada stem se le añaden los artículos nuevos de sus términos
+            - las rotaciones de los términos nuevos se insertan en el permuterm, que ya está
+              ordenado, ver self.merge_permuterms()
+            - los términos nuevos de 'all' se añaden a los grupos del corrector
+
+        """
+        new_index = self.index
+        self.index = old_index
+        # campo -> términos que no estaban en el índice
+        new_terms = {}
+        # campo -> stem -> artIds nuevos
+        new_stems = {}
+        # stem de cada término, se calcula una sola vez aunque el término esté en varios campos
+        term_stems = {}
+
+        for field, terms in new_index.items():
+            findex = self.index.setdefault(field, FieldIndex())
+            new_terms[field] = []
+            new_stems[field] = {}
+            for t, posting in terms.items():
+                old = findex.get(t)
+                if old is not None:
+                    findex[t] = self.extend_posting(old, posting)
+                else:
+                    findex[t] = self.compress_posting(posting)
+                    new_terms[field].append(t)
+                if self.stemming:
+                    if t not in term_stems:
+                        term_stems[t] = self.stemmer.stem(self.term_list[t])
+                    new_stems[field].setdefault(term_stems[t], set()).update(doc_ids(posting))
+
+        if self.stemming:
+            for field, stems in new_stems.items():
+                sfield = self.sindex.setdefault(field, {})
+                for stem, docs in stems.items():
+                    docs = sorted(docs)
+                    old = sfield.get(stem)
+                    if old is not None:
+                        sfield[stem] = self.extend_posting(old, docs)
+                    else:
+                        sfield[stem] = self.compress_posting(docs)
+
+        if self.permuterm:
+            for field, terms in new_terms.items():
+                new = sorted(p for t in terms for p in self.permuterms(self.term_list[t], t))
+                self.ptindex[field] = self.merge_permuterms(self.ptindex.get(field, ([], array('I'))), new)
+
+        if self.spelling:
+            for t in new_terms.get('all', []):
+                bisect.insort(self.spell_buckets.setdefault(len(self.term_list[t]), array('I')), t)
+
+        # un índice guardado por una versión anterior puede tener postings sin comprimir
+        if self.disk is None:
+            self.compress_index()
+
+
+    def extend_posting(self, posting, new):
+        """
+        Devuelve una copia comprimida de "posting" ampliada con la posting "new", cuyos
+        artIds son todos mayores. La copia no comparte datos con el mmap del índice binario,
+        ver CompressedPosting.detach(), y pasa a ser un bitmap si se vuelve densa.
+
+        """
+        if isinstance(posting, CompressedPosting):
+            posting = posting.detach()
+        else:
+            posting = self.compress_posting(posting)
+        posting.extend(new)
+        return self.compress_posting(posting)
+
+
+    def merge_permuterms(self, ptfield:tuple, new:List):
+        """
+        Inserta en el permuterm de un campo, (lista ordenada de permuterms, array de ids), los
+        pares (permuterm, id) ordenados "new". La posición de cada par se busca con búsqueda
+        binaria y lo que hay entre dos pares se copia por trozos, sin volver a ordenar.
+
+        """
+        rots, ids = ptfield
+        res_rots = []
+        res_ids = array('I')
+        lo = 0
+        for rot, tid in new:
+            i = bisect.bisect_left(rots, rot, lo)
+            res_rots += rots[lo:i]
+            res_ids += ids[lo:i]
+            res_rots.append(rot)
+            res_ids.append(tid)
+            lo = i
+        res_rots += rots[lo:]
+        res_ids += ids[lo:]
+        return res_rots, res_ids
+
+
+    def merge_partial(self, articles:List, artpos:array, ntokens:array, index:Dict, sindex:Dict,
+                      ptindex:Dict, term_list:List[str]):
+        """
+
+        Añade al índice un índice parcial construido por index_chunk().
+
+        param:  "articles": lista [url, title] de los artículos del trozo, el artículo i tiene id local i+1
+                "artpos": posición de los artículos del trozo en su fichero, mismo formato que self.artpos
+                "ntokens": número de tokens indexados de cada artículo del trozo
+                "index": índice parcial (mismo formato que self.index) con ids locales y las
+                         postings comprimidas
+                "sindex": índice de stems del trozo, con las postings comprimidas
+                "ptindex": rotaciones de los términos de cada campo, en el orden de "index"
+                "term_list": términos del índice parcial, el id local de term_list[i] es i
+
+        """
+        # traduce los ids locales a artId globales, los artículos ya indexados se descartan
+        # y no se cuentan en las estadísticas
+        base = len(self.articles)
+        local2global = {}
+        for local, (url, title) in enumerate(articles, 1):
+            if url not in self.urls:
+                artId = len(self.articles) + 1
+                self.articles[artId] = [url, title]
+                self.urls.add(url)
+                self.artpos.extend(artpos[3 * (local - 1):3 * local])
+                local2global[local] = artId
+                self.build_stats.count('articles')
+                self.build_stats.count('tokens', ntokens[local - 1])
+        # hasta el primer artículo descartado basta con sumar "base" a los artId locales
+        first_discarded = next((local for local in range(1, len(articles) + 1)
+                                if local not in local2global), len(articles) + 1)
+        gids = self.term_ids(term_list)
+
+        # los artId nuevos son siempre mayores que los existentes, así que basta con
+        # añadir al final de cada posting list para mantenerla ordenada
+        for field, terms in index.items():
+            findex = self.index.setdefault(field, {})
+            rots = ptindex.get(field)
+            if rots is not None:
+                ptfield = self.ptindex.setdefault(field, {})
+            # las rotaciones de cada término ocupan len(término) + 1 posiciones de "rots"
+            start = 0
+            for t, posting in terms.items():
+                end = start + len(term_list[t]) + 1
+                # solo se guardan las rotaciones de los términos nuevos en el campo
+                if self.merge_posting(findex, gids[t], posting, base, first_discarded, local2global) and rots is not None:
+                    ptfield.update(zip(rots[start:end], itertools.repeat(gids[t])))
+                start = end
+        for field, stems in sindex.items():
+            sfield = self.sindex.setdefault(field, {})
+            for stem, posting in stems.items():
+                self.merge_posting(sfield, stem, posting, base, first_discarded, local2global)
+
+
+    def merge_posting(self, findex:Dict, key, posting:CompressedPosting, base:int, first_discarded:int,
+                      local2global:Dict):
+        """
+
+        Añade al final de la posting de "key" en "findex" la posting comprimida de un índice
+        parcial, ver self.merge_partial().
+
+        param:  "base": valor que se suma a los artId locales anteriores a "first_discarded",
+                        el primer artículo descartado del trozo
+                "local2global": artId de cada artículo del trozo que no se ha descartado
+
+        return: True si "key" no estaba en "findex"
+
+        """
+        shift = base
+        if posting.last >= first_discarded:
+            # solo se decodifican las postings en las que hay artículos descartados o posteriores
+            docs = posting.doc_ids()
+            keep = [i for i, doc in enumerate(docs) if doc in local2global]
+            if not keep:
+                return False
+            positions = None if posting.pos is None else [posting.positions_at(i) for i in keep]
+            posting = CompressedPosting([local2global[docs[i]] for i in keep], positions)
+            shift = 0
+        old = findex.get(key)
+        if old is None:
+            findex[key] = posting.rebase(shift)
+            return True
+        old.concat(posting, shift)
+        return False
+
 
 
     def set_stemming(self, v:bool):
@@ -418,7 +1483,8 @@ class SAR_Indexer:
         return: lista de tokens
 
         """
-        return self.tokenizer.sub(' ', text.lower()).split()
+        with self.build_stats.phase('tokenize'):
+            return self.tokenizer.sub(' ', text.lower()).split()
 
 
     def make_stemming(self):
@@ -429,18 +1495,22 @@ class SAR_Indexer:
 
         "self.stemmer.stem(token) devuelve el stem del token"
         """
+        #Stem de cada término, se calcula una sola vez aunque el término esté en varios fields
+        stems = {}
         #Por cada field en index. Esto asegura que funcione con multifield
         for field in self.index:
             self.sindex[field] = {}
             for token in self.index[field]:
                 #Pasamos cada palabra de index por el stemmer
-                stemtoken = self.stemmer.stem(token)
+                stemtoken = stems.get(token)
+                if stemtoken is None:
+                    stemtoken = stems[token] = self.stemmer.stem(self.term_list[token])
                 #Si la palabra no es en el diccionario de stems lo agregamos
                 if stemtoken not in self.sindex[field]:
                     #En un principio usaremos sets para que no hayan docIDs repetidos
-                    self.sindex[field][stemtoken] = set(self.index[field][token])
+                    self.sindex[field][stemtoken] = set(doc_ids(self.index[field][token]))
                 else:
-                    (self.sindex[field][stemtoken]).update(self.index[field][token])
+                    (self.sindex[field][stemtoken]).update(doc_ids(self.index[field][token]))
             #Cuando acabemos con todas las palabras de un field ordenamos cada set y la transformamos en una lista
             for stemtoken in self.sindex[field]:
                 self.sindex[field][stemtoken] = list(sorted(self.sindex[field][stemtoken]))
@@ -449,6 +1519,16 @@ class SAR_Indexer:
 
 
     
+    def make_spelling(self):
+        """
+        Agrupa por longitud los términos de 'all' (self.spell_buckets), que es lo que
+        necesita el corrector ortográfico, para no hacerlo en cada búsqueda con corrección.
+
+        """
+        from spellsuggester import length_buckets
+        self.spell_buckets = length_buckets(self.term_list, self.index['all'])
+
+
     def make_permuterm(self):
         """
 
@@ -459,23 +1539,43 @@ class SAR_Indexer:
         """
         #Por cada field en index. Esto asegura que funcione con multifield
         for field in self.index:
-            self.ptindex[field] = []
+            ptfield = []
             #Generador de permuterms
             for i in self.index[field]:
-                #Añadimos simbolo final de palabra
-                cadena = "".join([i,"$"])
-                #Añadimos par (permuterm, palabra)
-                self.ptindex[field].append((cadena,i))
-                for j in range(len(cadena)-1):
-                    #Generamos siguiente permuterm
-                    cadena = "".join([cadena[-1:],cadena[:-1]])
-                    #Añadimos par (permuterm, palabra)
-                    self.ptindex[field].append((cadena,i))
+                ptfield.extend(self.permuterms(self.term_list[i], i))
             #Ordenamos la lista para facilitar las queries
-            self.ptindex[field].sort()
+            ptfield.sort()
+            self.ptindex[field] = self.split_permuterms(ptfield)
         pass
 
 
+    def split_permuterms(self, ptfield:List):
+        """
+        Separa la lista ordenada de pares (permuterm, id) en la lista de permuterms y un
+        array con los ids, que ocupa mucho menos que las tuplas.
+
+        """
+        return [p for p, _ in ptfield], array('I', [tid for _, tid in ptfield])
+
+
+    def permuterms(self, i:str, tid:int) -> List:
+        """
+        Devuelve los pares (permuterm, id) de todas las rotaciones de la palabra "i", cuyo id es "tid".
+
+        """
+        res = []
+        #Añadimos simbolo final de palabra
+        cadena = "".join([i,"$"])
+        #Añadimos par (permuterm, id de la palabra)
+        res.append((cadena,tid))
+        for j in range(len(cadena)-1):
+            #Generamos siguiente permuterm
+            cadena = "".join([cadena[-1:],cadena[:-1]])
+            #Añadimos par (permuterm, id de la palabra)
+            res.append((cadena,tid))
+        return res
+
+
 
 
 
@@ -510,9 +1610,9 @@ class SAR_Indexer:
             if(self.multifield):
                 for field in self.fields:
                     if field[1]:
-                        print(f'\t# of permuterms in "{field[0]}": {len(self.ptindex[field[0]])}')
+                        print(f'\t# of permuterms in "{field[0]}": {len(self.ptindex[field[0]][0])}')
             else:
-                print(f'\t# of permuterms in "{self.def_field}":, {len(self.ptindex[self.def_field])}')
+                print(f'\t# of permuterms in "{self.def_field}":, {len(self.ptindex[self.def_field][0])}')
 
         #Imprime para los campos seleccionados(en caso de multifield) las estadísticas del índice invertido de stems.
         if(self.stemming):
@@ -525,6 +1625,15 @@ class SAR_Indexer:
             else:
                 print(f'\t# of stems in "{self.def_field}":, {len(self.sindex[self.def_field])}')
 
+        #Imprime el espacio ocupado por las posting lists antes y después de comprimirlas.
+        raw, compressed = self.posting_bytes
+        if raw:
+            print("----------------------------------------")
+            print("POSTINGS:")
+            print(f'\tuncompressed size: {raw} bytes')
+            print(f'\tcompressed size: {compressed} bytes')
+            print(f'\tbytes saved: {raw - compressed} ({raw / compressed:.1f}x smaller)')
+
         #Imprime si las positionals están o no activadas.
         print("----------------------------------------")
         if(self.positional):
@@ -549,64 +1658,6 @@ class SAR_Indexer:
     ###                             ###
     ###################################
 
-    def hashkey(self,query:str,cont:int):
-        key = 0
-        #Suma el valor ascii de cada elemento del string query
-        for c in query:
-            key+=ord(c)
-        #En el caso de que existiese la clave le suma el valor contador, hasta que no exista
-        while(key in self.parpos):
-            key+=cont
-        
-        return f"{key}"
-
-    def solve_parpos(self,ini,cont,query):
-        #Si para la posición del valor del contador hay un '(' ini, toma el valor del contador
-        if(query[cont]=='('):
-            ini = cont
-        #Si hay parentesis desde el valor del contador se incrementa este, y se llama recursivamente al método
-        if('(' in query[cont:]):
-            cont+=1
-            query=self.solve_parpos(ini,cont,query)
-        #Si siguen habiendo ')' a partir del valor actual del contador, y para el valor anterior hay un '('
-        #se incrementa el contador hasta que se encuentra, se obtiene con hashkey() una clave única y se resuelve
-        #la parte de la query entre paréntesis, añadiendo el resultado a un diccionario auxiliar, por último
-        #se devuelve la query, pero intercambiando la parte resuelta, por la clave creada por hashkey(), en otro caso
-        #se devuelve la query como está.
-        if(')' in query[cont:] and query[cont-1]=='('):
-            while(query[cont]!=')'):
-                cont+=1
-            
-            key = self.hashkey(query[ini+1:cont],cont)
-            self.parpos[key]=self.solve_query(query[ini+1:cont])
-
-            return query[:ini]+key+query[cont+1:]
-        else:
-            return query
-
-
-    def calculateposting(self,term:str):
-        #Si hubiese alguna mayuscula se vuelve a minúscula
-        term=term.lower()
-        
-        #Si está ':' en el término significa que tiene un campo indicado, se separa y obtiene la postinglist
-        #para el campo y el término indicado.
-        #Si el término está en self.parpos significa que ya se ha obtenido anteriormente, y se recupera esa postinglist.
-        #En otro caso se recupera la posting del término.
-        if(':' in term):
-                field,name=term.split(':')
-                postinglist = self.get_posting(name,field)
-        else:
-            if(term in self.parpos):
-                postinglist=self.parpos[term]
-            else:
-                postinglist = self.get_posting(term)
-                
-        if(isinstance(postinglist,dict)):
-            return [*postinglist]
-        return postinglist
-
-
     def solve_query(self, query:str, prev:Dict={}):
         """
         NECESARIO PARA TODAS LAS VERSIONES
@@ -623,107 +1674,329 @@ class SAR_Indexer:
 
         """
 
-        if query is None or len(query) == 0:
+        if query is None or len(query.strip()) == 0:
             return []
-        
-        #Se quitan espacios en blanco al principio y al final por si hubiesen.
-        query=query.strip()
-
-        #En caso que hayan paréntesis se resuelven mediante el método solve_parpos
-        #y se recupera la nueva query.
-        if("(" in query):
-            query=self.solve_parpos(None,0,query)
-
-        #Variables para la resolución de las comillas
-        cont = 0; pos=0; ini=0; field=None
-
-        #Comprobación de si hay o no comillas en la query
-        hay='"' in query[cont:]
-
-        #En caso de que hayan "" en la consulta.
-        while(hay and cont<len(query)):
-            #Para los terminos que no empiecen por comillas se toma la posicion de la primera letra,
-            #de forma que se pueda resolver la especificación del campo
-            if(cont == 0 and query[cont]!='"'):
-                field = cont
-            if(query[cont]==' ' and pos==0):
-                field=cont+1
-            
-            #Si se encuentran unas comillas y el auxiliar que nos indica si habiamos encontrado unas anteriormente
-            #sigue igual a 0, se toma la posición inicial y se cambia a 1 el auxiliar.
-            #Además si el valor de field no era None y la posición anterior al contador no era ':', 
-            #se vuelve a poner field como None
-            if(query[cont]=='"' and pos==0):
-                ini=cont
-                pos=1
-                if(field is not None and query[cont-1]!=':'):
-                    field=None
-
-            #Si se encuentran comillas y el auxiliar es 1, se vuelve a poner a 0, se obtiene
-            #una clave única, se obtiene la posting list y se añade a self.parpos y se quita 
-            #de la query las comillas resueltas. Además se reduce la cantidad del contador,
-            #en la longitud de la query anterior menos la actual, de forma que vuelva a la misma posición.
-            elif(query[cont]=='"' and pos==1):
-                pos=0
-                key = self.hashkey(query[ini+1:cont],cont)
-                aux=len(query)
-                if(field is not None):
-                    self.parpos[key]=self.get_posting(query[ini:cont+1],query[field:ini-1])
-                    query=query[:field]+key+query[cont+1:]
-                    field=None
-                else:
-                    self.parpos[key]=self.get_posting(query[ini:cont+1])
-                    query=query[:ini]+key+query[cont+1:]                    
-                cont-=(aux-(len(query)))
 
-                #Una vez retiradas las comillas se vuelve a comprobar si hay o no en la query.
-                hay='"' in query[cont:]
+        # se construye el árbol de la query (ver queryparser), o se usa el de la lista de
+        # queries que se está resolviendo, y se resuelve
+        tree = self.batch.trees.get(query) if self.batch is not None else None
+        res = self.solve_node(tree if tree is not None else parse_query(query))
+        # el resultado de un NOT no se materializa, se recorre al mostrarlo (ver postings.Complement)
+        return res if isinstance(res, Complement) else doc_ids(res)
 
-            cont+=1
 
-        que=query.split(' ')
-        i = 0
+    def doc_freq(self, term:str, field:Optional[str]=None) -> int:
+        """
+        Devuelve el número de artículos en los que aparece un término (o su stem si se
+        usa stemming), sin decodificar su posting list.
 
-        #Calculo de postinglist del primer término en función de si usa NOT o no
-        if(que[i]=='NOT'):
-            postinglist=self.calculateposting(que[i+1])
-            postinglist = self.reverse_posting(postinglist)
-            i+=2
+        """
+        field = field or self.def_field
+        try:
+            if self.use_stemming:
+                return len(self.sindex[field].get(self.stemmer.stem(term), ()))
+            tid = self.terms.get(term)
+            return 0 if tid is None else len(self.index[field].get(tid, ()))
+        except KeyError:
+            return 0
+
+
+    def estimate(self, node:tuple) -> int:
+        """
+        Estima el número de resultados de un nodo del árbol de la query sin resolverlo:
+        la frecuencia de los términos, la menor de los términos de una frase, la menor de los
+        hijos de un AND, la suma de los de un OR y el resto de los artículos para un NOT.
+        Los términos con comodines se estiman con el número total de artículos.
+
+        """
+        kind = node[0]
+        if kind == 'term':
+            _, field, term = node
+            if '*' in term or '?' in term:
+                return len(self.articles)
+            return self.doc_freq(term, field)
+        if kind == 'phrase':
+            return min((self.doc_freq(t, node[1]) for t in node[2].strip('"').split()), default=0)
+        if kind == 'not':
+            return max(0, len(self.articles) - self.estimate(node[1]))
+        estimates = [self.estimate(child) for child in node[1]]
+        if kind == 'and':
+            return min(estimates)
+        return min(len(self.articles), sum(estimates))
+
+
+    def solve_node(self, node:tuple):
+        """
+        Resuelve un nodo del árbol de la query. El resultado de cada nodo (términos,
+        comodines, stems, correcciones y subexpresiones) se guarda en self.cache.
+
+        return: posting list (lista, CompressedPosting o Complement), no se debe modificar
+
+        """
+        batch = self.batch
+        if batch is not None and node in batch.results:
+            batch.reused += 1
+            return batch.results[node]
+        key = (self.use_stemming, node)
+        res = self.cache.get(key)
+        if res is not None:
+            if batch is not None and node in batch.shared:
+                batch.results[node] = res
+            return res
+        kind = node[0]
+        if kind in ('term', 'phrase'):
+            res = self.get_posting(node[2], node[1])
+        elif kind == 'not':
+            res = self.reverse_posting(self.solve_node(node[1]))
+        elif kind == 'and':
+            res = self.solve_and(node[1])
         else:
-            postinglist=self.calculateposting(que[i])
-            i+=1
-
-        while(i<len(que)):
-            #Si las terminos no están separados por AND o OR se calcula la posting list del segundo
-            #y se hace la intersección.
-            if(que[i] not in ['AND','OR']):
-                if(que[i]=='NOT'):
-                    pos2=self.calculateposting(que[i+1])
-                    pos2 = self.reverse_posting(pos2)
-                    i+=2
-                else:
-                    pos2=self.calculateposting(que[i])
-                    i+=1
-                postinglist=self.and_posting(postinglist,pos2)
-            #De otra forma se calcula la posting list del segundo y se hace la intersección
-            #o la unión en función de AND o OR.
-            else:    
-                aux=i
-                if(que[i+1]=='NOT'):
-                    pos2=self.calculateposting(que[i+2])
-                    pos2 = self.reverse_posting(pos2)
-                    i+=3
-                else:
-                    pos2=self.calculateposting(que[i+1])
-                    i+=2
+            res = self.solve_or(node[1])
+        self.cache.put(key, res)
+        # los nodos compartidos de la lista de queries se guardan hasta que termina
+        if batch is not None and node in batch.shared:
+            batch.results[node] = res
+        return res
 
-                if(que[aux]=='AND'):
-                    postinglist=self.and_posting(postinglist,pos2)
 
-                else:
-                    postinglist=self.or_posting(postinglist,pos2)
+    def solve_and(self, children:tuple):
+        """
+        Resuelve el AND de varios nodos:
+            - los nodos positivos se intersecan de menor a mayor número estimado de
+              resultados (ver self.estimate()), y se para en cuanto el resultado es vacío
+            - los NOT no se materializan: se restan del resultado con minus_posting()
+            - si todos son NOT se aplica De Morgan: NOT a AND NOT b = NOT (a OR b), que
+              se devuelve como un Complement
+
+        """
+        positives = sorted((child for child in children if child[0] != 'not'), key=self.estimate)
+        negatives = [child[1] for child in children if child[0] == 'not']
+        if not positives:
+            return self.reverse_posting(self.solve_or(negatives))
+        res = None
+        for child in positives:
+            posting = self.solve_node(child)
+            res = posting if res is None else self.and_posting(res, posting)
+            if len(res) == 0:
+                return []
+        # se resta primero lo que más resultados quita
+        for child in sorted(negatives, key=self.estimate, reverse=True):
+            res = self.minus_posting(res, self.solve_node(child))
+            if len(res) == 0:
+                break
+        return res
+
+
+    def solve_or(self, children:tuple):
+        """
+        Resuelve el OR de varios nodos. Si alguno es un NOT se aplica De Morgan:
+        a OR NOT b OR NOT c = NOT ((b AND c) AND NOT a), y se devuelve un Complement
+
+        """
+        positives = [self.solve_node(child) for child in children if child[0] != 'not']
+        negatives = [child[1] for child in children if child[0] == 'not']
+        # las posting lists se unen de una vez (ver postings.union_postings()), los
+        # Complement de las subexpresiones con NOT se añaden después con or_posting()
+        res = union_postings(p for p in positives if not isinstance(p, Complement))
+        for p in positives:
+            if isinstance(p, Complement):
+                res = self.or_posting(res, p)
+        if negatives:
+            return self.reverse_posting(self.minus_posting(self.solve_and(negatives), res))
+        return res
+
 
-        return postinglist
+    def iter_query(self, query:str):
+        """
+        Devuelve un iterador de los artIds del resultado de una query, en orden, que la
+        resuelve a medida que se recorre: para mostrar los primeros self.SHOW_MAX
+        resultados no hace falta resolverla entera, ver self.iter_node().
+
+        """
+        if query is None or len(query.strip()) == 0:
+            return iter(())
+        tree = self.batch.trees.get(query) if self.batch is not None else None
+        return self.iter_node(tree if tree is not None else parse_query(query))
+
+
+    def iter_node(self, node:tuple):
+        """
+        Iterador de los artIds de un nodo del árbol de la query. Los AND, OR y NOT se
+        combinan en streaming (ver postings.iter_and(), iter_or(), iter_minus() e
+        iter_complement()) en el mismo orden que en self.solve_node(), las posting lists
+        se decodifican a medida que se recorren y las frases se comprueban artículo a
+        artículo. Si el nodo ya está resuelto (en la cache o en la lista de queries) se
+        recorre su resultado.
+
+        """
+        res = None
+        if self.batch is not None:
+            res = self.batch.results.get(node)
+        if res is None:
+            res = self.cache.peek((self.use_stemming, node))
+        if res is not None:
+            return iter_docs(res)
+        kind = node[0]
+        # las frases se comprueban en streaming si el índice es posicional y no hace falta
+        # el corrector, si no se resuelven con self.get_posting()
+        if kind == 'phrase' and self.positional and not self.use_spelling and '*' not in node[2] and '?' not in node[2]:
+            try:
+                postings = self.phrase_postings(node[2], node[1])
+            except KeyError:
+                return iter(())
+            if len(postings) > 1:
+                return self.iter_phrase(postings)
+        if kind in ('term', 'phrase'):
+            return iter_docs(self.get_posting(node[2], node[1]))
+        if kind == 'not':
+            return iter_complement(self.iter_node(node[1]), len(self.articles))
+        positives = [child for child in node[1] if child[0] != 'not']
+        negatives = [child[1] for child in node[1] if child[0] == 'not']
+        if kind == 'and':
+            if not positives:
+                return iter_complement(iter_or([self.iter_node(child) for child in negatives]), len(self.articles))
+            docs = iter_and([self.iter_node(child) for child in sorted(positives, key=self.estimate)])
+            if negatives:
+                docs = iter_minus(docs, iter_or([self.iter_node(child) for child in negatives]))
+            return docs
+        docs = iter_or([self.iter_node(child) for child in positives])
+        if negatives:
+            # a OR NOT b OR NOT c = NOT ((b AND c) AND NOT a)
+            return iter_complement(iter_minus(self.iter_node(('and', tuple(negatives))), docs), len(self.articles))
+        return docs
+
+
+    def count_results(self, query:str) -> int:
+        """
+        Devuelve el número de resultados de una query sin construir la lista de resultados,
+        ver self.count_node().
+
+        """
+        if query is None or len(query.strip()) == 0:
+            return 0
+        tree = self.batch.trees.get(query) if self.batch is not None else None
+        return self.count_node(tree if tree is not None else parse_query(query))
+
+
+    def count_node(self, node:tuple) -> int:
+        """
+        Devuelve el número de resultados de un nodo del árbol de la query. Los hijos se
+        resuelven con self.solve_node() (los términos son sus posting lists sin decodificar)
+        pero la última operación solo se cuenta:
+            - un término: su número de artículos (la longitud de su posting list)
+            - una frase: se cuentan los artículos en los que aparece, ver self.iter_phrase()
+            - NOT a: número de artículos menos los de a
+            - AND: se intersecan los hijos menos el último (el más frecuente) y se cuenta
+              la intersección con él, ver self.count_and(); los NOT se cuentan como
+              |a - b| = |a| - |a AND b|
+            - OR: se unen los hijos menos el último y |a OR b| = |a| + |b| - |a AND b|, o
+              con bitmaps el popcount de su OR (ver postings.bitmap_count_union())
+        El número se guarda en la cache, así como los resultados de los hijos.
+
+        """
+        res = None
+        if self.batch is not None:
+            res = self.batch.results.get(node)
+        if res is None:
+            res = self.cache.peek((self.use_stemming, node))
+        if res is not None:
+            return len(res)
+        key = (self.use_stemming, node, 'count')
+        count = self.cache.get(key)
+        if count is not None:
+            return count
+        kind = node[0]
+        n = len(self.articles)
+        if kind == 'phrase' and self.positional and not self.use_spelling and '*' not in node[2] and '?' not in node[2]:
+            try:
+                postings = self.phrase_postings(node[2], node[1])
+            except KeyError:
+                postings = []
+            count = sum(1 for _ in self.iter_phrase(postings)) if len(postings) > 1 else None
+            if count is None:
+                count = len(self.get_posting(node[2], node[1]))
+        elif kind in ('term', 'phrase'):
+            count = len(self.get_posting(node[2], node[1]))
+        elif kind == 'not':
+            count = n - self.count_node(node[1])
+        elif kind == 'and':
+            positives = sorted((child for child in node[1] if child[0] != 'not'), key=self.estimate)
+            negatives = sorted((child[1] for child in node[1] if child[0] == 'not'), key=self.estimate, reverse=True)
+            if not positives:
+                # NOT a AND NOT b = NOT (a OR b)
+                count = n - self.count_node(normalize(('or', tuple(negatives))))
+            else:
+                # en el orden de self.solve_and(), la última operación solo se cuenta
+                ops = [(True, child) for child in positives[1:]] + [(False, child) for child in negatives]
+                res = self.solve_node(positives[0])
+                for positive, child in ops[:-1]:
+                    if len(res) == 0:
+                        break
+                    posting = self.solve_node(child)
+                    res = self.and_posting(res, posting) if positive else self.minus_posting(res, posting)
+                if not ops or len(res) == 0:
+                    count = len(res)
+                else:
+                    positive, child = ops[-1]
+                    count = self.count_and(res, self.solve_node(child))
+                    if not positive:
+                        count = len(res) - count
+        else:
+            postings = [self.solve_node(child) for child in node[1]]
+            plain = sorted((p for p in postings if not isinstance(p, Complement)), key=len)
+            complements = [p for p in postings if isinstance(p, Complement)]
+            if not complements and any(isinstance(p, BitmapPosting) for p in plain):
+                count = bitmap_count_union(plain)
+            else:
+                # como en self.solve_or(): las posting lists se unen de una vez y los
+                # Complement (los NOT) se añaden después; la última (un Complement o la
+                # posting más larga) solo se cuenta
+                rest = plain + complements
+                last = rest.pop()
+                res = union_postings(p for p in rest if not isinstance(p, Complement))
+                for p in rest:
+                    if isinstance(p, Complement):
+                        res = self.or_posting(res, p)
+                count = len(res) + len(last) - self.count_and(res, last)
+        self.cache.put(key, count)
+        return count
+
+
+    def count_and(self, p1, p2) -> int:
+        """
+        Devuelve el número de artículos del AND de dos posting lists sin construirlo, con
+        las mismas estrategias que self.and_posting(): popcount con bitmaps, búsqueda de
+        la lista corta en la larga si son muy distintas o un recorrido de las dos que solo cuenta.
+
+        """
+        # con un NOT: |a AND NOT b| = |a| - |a AND b|, |NOT a AND NOT b| = n - |a OR b|
+        if isinstance(p1, Complement) or isinstance(p2, Complement):
+            if isinstance(p1, Complement) and isinstance(p2, Complement):
+                a, b = p1.posting, p2.posting
+                return len(self.articles) - (len(a) + len(b) - self.count_and(a, b))
+            if isinstance(p1, Complement):
+                p1, p2 = p2, p1
+            return len(p1) - self.count_and(p1, p2.posting)
+        if isinstance(p1, BitmapPosting) or isinstance(p2, BitmapPosting):
+            return bitmap_count_and(p1, p2)
+        if len(p1) > len(p2):
+            p1, p2 = p2, p1
+        if len(p2) >= self.GALLOP_RATIO * len(p1):
+            # el resultado tiene como mucho len(p1) artIds
+            return len(self.and_posting(p1, p2))
+        p1, p2 = doc_ids(p1), doc_ids(p2)
+        count = 0
+        i = 0
+        j = 0
+        while i < len(p1) and j < len(p2):
+            if p1[i] == p2[j]:
+                count += 1
+                i += 1; j += 1
+            elif p1[i] < p2[j]:
+                i += 1
+            else:
+                j += 1
+        return count
 
 
 
@@ -784,9 +2057,9 @@ class SAR_Indexer:
             elif(self.use_stemming):
                 res = self.get_stemming(term, field)
             elif(field != None):
-                res = self.index[field][term]
+                res = self.term_posting(field, term)
             else:
-                res = self.index['all'][term]
+                res = self.term_posting('all', term)
         except:
             res = []
 
@@ -801,10 +2074,8 @@ class SAR_Indexer:
          """
         if(self.use_spelling and res == []):
             words = self.speller.suggest(term)
-            res = []
-            for word in words:
-                posting = self.get_posting(word,field)
-                res = self.or_posting(res,posting)
+            # las posting lists de todas las sugerencias se unen de una vez
+            res = union_postings(self.get_posting(word, field) for word in words)
 
 
         return [] if res == None else res
@@ -828,38 +2099,59 @@ class SAR_Indexer:
 
         return: posting list
 
+        """
+        postings = self.phrase_postings(terms, field)
+        #Si solo hay un termino en la consulta se devuelve su diccionario.
+        if(len(postings)==1):
+            return doc_ids(postings[0])
+        return list(self.iter_phrase(postings))
+
+
+    def phrase_postings(self, terms:str, field) -> list:
+        """
+        Devuelve las posting lists (sin decodificar) de los términos de una frase.
+        Lanza KeyError si alguno no está en el índice.
+
+        param:  "terms": frase, con las comillas
+                "field": campo, si es None el campo por defecto
+
         """
         #Retiramos las comillas de la consulta y la dividimos.
         t = terms[1:len(terms)-1].split()
-        postinglist=[]
         #Si no hay un campo especificado, se usa el por defecto.
         if(not field):
             field=self.def_field
-        #Si solo hay un termino en la consulta se devuelve su diccionario.
-        if(len(t)==1):
-            return [*self.index[field][t[0]]]
-
-        #Por cada aparición del primer termino en cada articulo se comprueba si cada uno de los términos aparece en el artículo y ocupa 
-        #su posición correspondiente. En caso de que se llegue al último termino de la consulta y cumpla las condiciones se añade la posición 
-        #del primer término de la consulta a la lista del artículo correspondiente en el diccionario que se devolverá cuando acaben las comprobaciones.
-        for url in self.index[field][t[0]]:
-            noturl=True
-            for posicion in self.index[field][t[0]][url]:
-                if(noturl):
-                    for termino in range(1,len(t)):
-                        if(noturl and url in self.index[field][t[termino]]):
-                            if((posicion+termino) in self.index[field][t[termino]][url]):
-                                if(termino==len(t)-1):
-                                    postinglist.append(url)
-                                    noturl=False
-                            else:
-                                break
-                        else:
-                            break
-                else:
+        return [self.term_posting(field, termino) for termino in t]
+
+
+    def iter_phrase(self, postings:list):
+        """
+        Generador de los artIds, en orden, en los que aparecen consecutivos los términos
+        cuyas posting lists posicionales son "postings" (ver self.phrase_postings()).
+
+        """
+        #Los artículos en los que aparecen todos los términos se obtienen con el AND de sus posting lists,
+        #empezando por el término menos frecuente. En cada artículo, las posiciones en las que puede empezar
+        #la frase son las del término menos frecuente menos su desplazamiento en la frase, y se quedan las
+        #que tienen a cada uno de los otros términos en su sitio (ver postings.offset_intersect()).
+        #Las posiciones de cada artículo se decodifican solo cuando se necesitan.
+        order = sorted(range(len(postings)), key=lambda k: len(postings[k]))
+        docs = postings[order[0]]
+        for k in order[1:]:
+            docs = self.and_posting(docs, postings[k])
+            if len(docs) == 0:
+                return
+        for url in doc_ids(docs):
+            starts = None
+            for k in order:
+                posiciones = postings[k].get(url)
+                if posiciones is None:
                     break
-        
-        return postinglist
+                starts = [p - k for p in posiciones] if starts is None else offset_intersect(starts, posiciones, k)
+                if not starts:
+                    break
+            else:
+                yield url
 
 
 
@@ -904,38 +2196,41 @@ class SAR_Indexer:
         simbolo = perm[-1]
         perm = perm[:-1]
 
+        #Lista ordenada de permuterms y array con el id del término de cada uno
+        rots, ids = self.ptindex[field]
+
         #Busqueda binaria
         inicio = 0
-        fin = len(self.ptindex[field])-1
+        fin = len(rots)-1
         while(inicio <= fin):
             medio = int((inicio + fin)/2)
-            if((self.ptindex[field][medio][0] > perm) or (self.ptindex[field][medio][0].startswith(perm))):
+            if((rots[medio] > perm) or (rots[medio].startswith(perm))):
                 fin = medio - 1
             else:
                 inicio = medio + 1
         #Comprobamos si el indice inicio pertenece a la lista
-        if(inicio == len(self.ptindex[field])):
+        if(inicio == len(rots)):
             return []
-        #Variable con el resultado final:
-        aux = {}
+        #Posting lists de los términos que encajan con la query:
+        postings = []
         #Diferenciamos dos casos:
         #En el caso de que la wildcard sea *
         if simbolo == '*':
             #Mientras el permuterm empiece por nuestra query (perm) añadimos la posting list
-            while self.ptindex[field][inicio][0].startswith(perm) and inicio < len(self.ptindex[field]):
-                aux.update(self.index[field][self.ptindex[field][inicio][1]])
+            while inicio < len(rots) and rots[inicio].startswith(perm):
+                postings.append(self.index[field][ids[inicio]])
                 inicio += 1
         #En el caso de que la wildcard sea ?
         else:       
             longitud = len(perm)
             '''Mientras el permuterm empiece por nuestra query y la longitud del permuterm sea 
             1 mas que la query añadimos la posting list'''
-            while self.ptindex[field][inicio][0].startswith(perm) and inicio < len(self.ptindex[field]):
-                if (longitud+1 == len(self.ptindex[field][inicio][0])):
-                    aux.update(self.index[field][self.ptindex[field][inicio][1]])
+            while inicio < len(rots) and rots[inicio].startswith(perm):
+                if (longitud+1 == len(rots[inicio])):
+                    postings.append(self.index[field][ids[inicio]])
                 inicio += 1
-        #Devolvemos el resultado ordenado        
-        return list(sorted(aux))
+        #Devolvemos la unión ordenada, un término puede tener varios permuterms que encajan
+        return union_postings(postings)
 
 
 
@@ -952,41 +2247,33 @@ class SAR_Indexer:
 
         return: posting list con todos los artid exceptos los contenidos en p
 
+        el resultado es un Complement: no se construye la lista de todos los artículos,
+        and_posting(), or_posting() y minus_posting() operan con p y solo se genera la
+        lista (artId a artId) si el NOT es el resultado final de la query
+
         """
         
         ########################################
         ## COMPLETAR PARA TODAS LAS VERSIONES ##
         ########################################
-        notlist=list()
-        #auxiliares para recorrer las listas
-        pcont=0;i=0
-        #articulos indexados
-        articles=[*self.articles]
-
-        #Si el id en p es mayor se añade el valor del id en articles.
-        #Si son iguales no se añade y se sigue a la siguiente iteración.
-        #Si el id en articles es mayor es porque ya se ha acabado los ids de p, por tanto se añade el resto.
-        while(pcont<len(p)):
-            if(p[pcont]>articles[i]):
-                notlist.append(articles[i])
-                i+=1
-            elif(articles[i]==p[pcont]):
-                i+=1
-                pcont+=1
-        while(i<len(articles)):
-            notlist.append(articles[i])
-            i+=1
-
-        return notlist
+
+        # NOT NOT p = p
+        if isinstance(p, Complement):
+            return p.posting
+        return Complement(p, len(self.articles))
 
 
     def and_posting(self, p1:list, p2:list):
         """
         NECESARIO PARA TODAS LAS VERSIONES
         Calcula el AND de dos posting list de forma EFICIENTE
-        param:  "p1", "p2": posting lists sobre las que calcular
+        param:  "p1", "p2": posting lists (listas o CompressedPosting) sobre las que calcular
         return: posting list con los artid incluidos en p1 y p2
 
+        si una lista es mucho más larga que la otra (ver self.GALLOP_RATIO) se busca cada
+        artId de la corta en la larga, con búsqueda exponencial si es una lista o con la
+        tabla de saltos si es una CompressedPosting, que así no se decodifica entera
+
         """
         
         pass
@@ -994,6 +2281,28 @@ class SAR_Indexer:
         ## COMPLETAR PARA TODAS LAS VERSIONES ##
         ########################################
 
+        # con un NOT: a AND NOT b = a - b, y NOT a AND NOT b = NOT (a OR b)
+        if isinstance(p1, Complement) or isinstance(p2, Complement):
+            if isinstance(p1, Complement) and isinstance(p2, Complement):
+                return self.reverse_posting(self.or_posting(p1.posting, p2.posting))
+            if isinstance(p1, Complement):
+                p1, p2 = p2, p1
+            return self.minus_posting(p1, p2.posting)
+
+        # con un bitmap se hace con numpy, ver postings.bitmap_and()
+        if isinstance(p1, BitmapPosting) or isinstance(p2, BitmapPosting):
+            return bitmap_and(p1, p2)
+
+        # el AND es conmutativo, p1 pasa a ser la más corta
+        if len(p1) > len(p2):
+            p1, p2 = p2, p1
+        if len(p2) >= self.GALLOP_RATIO * len(p1):
+            if isinstance(p2, CompressedPosting):
+                return p2.intersect(doc_ids(p1))
+            # p2 puede ser un diccionario del índice posicional de un índice antiguo
+            return gallop_intersect(doc_ids(p1), doc_ids(p2))
+        p1, p2 = doc_ids(p1), doc_ids(p2)
+
         res = []
         i = 0
         j = 0
@@ -1036,6 +2345,19 @@ class SAR_Indexer:
 
         #### SIN PROBAR 
 
+        # con un NOT: a OR NOT b = NOT (b - a), y NOT a OR NOT b = NOT (a AND b)
+        if isinstance(p1, Complement) or isinstance(p2, Complement):
+            if isinstance(p1, Complement) and isinstance(p2, Complement):
+                return self.reverse_posting(self.and_posting(p1.posting, p2.posting))
+            if isinstance(p1, Complement):
+                p1, p2 = p2, p1
+            return self.reverse_posting(self.minus_posting(p2.posting, p1))
+
+        # con un bitmap se hace con numpy, ver postings.bitmap_union()
+        if isinstance(p1, BitmapPosting) or isinstance(p2, BitmapPosting):
+            return bitmap_union([p1, p2])
+
+        p1, p2 = doc_ids(p1), doc_ids(p2)
         res = []
         i = 0
         j = 0
@@ -1085,6 +2407,9 @@ class SAR_Indexer:
 
         return: posting list con los artid incluidos de p1 y no en p2
 
+        si las longitudes son muy distintas (ver self.GALLOP_RATIO) se localizan los
+        artIds de la lista corta en la larga como en self.and_posting()
+
         """
 
         
@@ -1093,6 +2418,25 @@ class SAR_Indexer:
         ## COMPLETAR PARA TODAS LAS VERSIONES SI ES NECESARIO ##
         ########################################################
 
+        # con un NOT: a - NOT b = a AND b, NOT a - b = NOT (a OR b) y NOT a - NOT b = b - a
+        if isinstance(p2, Complement):
+            if isinstance(p1, Complement):
+                return self.minus_posting(p2.posting, p1.posting)
+            return self.and_posting(p1, p2.posting)
+        if isinstance(p1, Complement):
+            return self.reverse_posting(self.or_posting(p1.posting, p2))
+
+        # con un bitmap se hace con numpy, ver postings.bitmap_minus()
+        if isinstance(p1, BitmapPosting) or isinstance(p2, BitmapPosting):
+            return bitmap_minus(p1, p2)
+
+        if len(p2) >= self.GALLOP_RATIO * len(p1):
+            if isinstance(p2, CompressedPosting):
+                return p2.difference(doc_ids(p1))
+            return gallop_difference(doc_ids(p1), doc_ids(p2))
+        p1, p2 = doc_ids(p1), doc_ids(p2)
+        if len(p1) >= self.GALLOP_RATIO * len(p2):
+            return gallop_remove(p1, p2)
 
         #### SIN PROBAR 
 
@@ -1136,35 +2480,316 @@ class SAR_Indexer:
     ###                               ###
     #####################################
 
+    def get_article(self, artId:int) -> Dict[str, str]:
+        """
+        Lee y parsea SOLO la línea del artículo "artId" en su fichero, usando la posición
+        guardada en self.artpos al indexar.
+
+        param:  "artId": id del artículo
+
+        return: diccionario del artículo, ver self.parse_article()
+
+        """
+        if 3 * artId > len(self.artpos):
+            # índice guardado sin posiciones de los artículos: se busca por la url
+            return self.find_article(self.articles[artId][0])
+        docid, offset, length = self.artpos[3 * (artId - 1):3 * artId]
+        fh = self.doc_handles.get(docid)
+        if fh is None:
+            fh = self.doc_handles[docid] = open(self.docs[docid], 'rb')
+        fh.seek(offset)
+        return self.parse_article(fh.read(length))
+
+
+    def find_article(self, url:str) -> Optional[Dict[str, str]]:
+        """
+        Busca el artículo con la url "url" recorriendo todos los ficheros indexados.
+
+        """
+        for z in self.docs:
+            for line in open(self.docs[z], 'rb'):
+                j = self.parse_article(line)
+                if j['url'] == url:
+                    return j
+        return None
+
+
+    def snippet_terms(self, query:str):
+        """
+        Extrae de la query los términos que se buscan en los snippets. El resultado se
+        guarda en self.snippet_cache (una cache LRU de las últimas queries), así se calcula
+        una sola vez por query.
+
+        param:  "query": query que se está mostrando
+
+        return: par (terms, pattern): lista de términos sin comodines y expresión regular
+                compilada que reconoce los términos con comodines (None si no hay ninguno)
+
+        """
+        cached = self.snippet_cache.get(query)
+        if cached is not None:
+            return cached
+        terms = []
+        wildcards = []
+        for word in self.query_words(query):
+            word = word.strip('()"')
+            # se quita el campo: 'title:python' -> 'python'
+            if ':' in word:
+                word = word.split(':', 1)[1]
+            word = word.lower()
+            if '*' in word or '?' in word:
+                wildcards.append(re.escape(word).replace('\\*', '\\w*').replace('\\?', '\\w'))
+            else:
+                terms += [t for t in self.tokenize(word) if t not in terms]
+        pattern = re.compile('(?:' + '|'.join(wildcards) + ')$') if wildcards else None
+        cached = (terms, pattern)
+        self.snippet_cache.put(query, cached)
+        return cached
+
+
+    def snippet_hits(self, artId:int, text:str, terms:List[str], pattern) -> List:
+        """
+        Busca las apariciones de los términos de la query en el texto de un artículo.
+
+        Si el índice es posicional las posiciones de los términos sin comodines se leen de
+        self.index['all'] y no hace falta recorrer el texto. Si no, o si la query tiene
+        comodines, se recorren una sola vez los tokens del texto.
+
+        return: lista ordenada de pares (posición del token, número del término)
+
+        """
+        hits = []
+        if self.positional and pattern is None:
+            field = self.index['all']
+            for k, term in enumerate(terms):
+                tid = self.terms.get(term)
+                posting = field.get(tid) if tid is not None else None
+                positions = posting.get(artId) if posting is not None else None
+                if positions:
+                    hits += [(p, k) for p in positions]
+        else:
+            keys = {term: k for k, term in enumerate(terms)}
+            wild = len(terms)
+            for p, m in enumerate(self.WORD_RE.finditer(text.lower())):
+                token = m.group()
+                k = keys.get(token)
+                if k is not None:
+                    hits.append((p, k))
+                elif pattern is not None and pattern.match(token):
+                    # todos los comodines cuentan como un único término
+                    hits.append((p, wild))
+        hits.sort()
+        return hits
+
+
+    def best_windows(self, hits:List) -> List[int]:
+        """
+        Elige las (como mucho) self.SNIPPET_MAX ventanas de self.SNIPPET_WINDOW tokens, sin
+        solaparse, con más términos distintos de la query (y después con más apariciones).
+
+        param:  "hits": pares (posición, término) ordenados, ver self.snippet_hits()
+
+        return: lista ordenada con la posición inicial de cada ventana
+
+        """
+        candidates = []
+        counts = {}
+        r = 0
+        # ventana deslizante: para cada aparición, la ventana que empieza en ella
+        for l, (start, _) in enumerate(hits):
+            while r < len(hits) and hits[r][0] < start + self.SNIPPET_WINDOW:
+                counts[hits[r][1]] = counts.get(hits[r][1], 0) + 1
+                r += 1
+            candidates.append((-len(counts), l - r, start))
+            k = hits[l][1]
+            counts[k] -= 1
+            if counts[k] == 0:
+                del counts[k]
+        candidates.sort()
+        chosen = []
+        for _, _, start in candidates:
+            if all(abs(start - s) >= self.SNIPPET_WINDOW for s in chosen):
+                chosen.append(start)
+                if len(chosen) == self.SNIPPET_MAX:
+                    break
+        return sorted(chosen)
+
+
+    def make_snippet(self, artId:int, text:str, query:str) -> str:
+        """
+        Construye el snippet de un artículo: las mejores ventanas del texto con los términos
+        de la query separadas por ' [...] '. Si no aparece ningún término se muestra el
+        principio del texto.
+
+        param:  "artId": id del artículo
+                "text": texto completo del artículo (campo 'all')
+                "query": query que se está mostrando
+
+        return: el snippet
+
+        """
+        terms, pattern = self.snippet_terms(query)
+        starts = self.best_windows(self.snippet_hits(artId, text, terms, pattern)) or [0]
+        # posición en caracteres de los tokens, solo hasta el último que se muestra
+        last = starts[-1] + self.SNIPPET_WINDOW
+        spans = []
+        for m in self.WORD_RE.finditer(text.lower()):
+            spans.append(m.span())
+            if len(spans) > last:
+                break
+        if not spans:
+            return ''
+        if len(text.lower()) != len(text):
+            # algún carácter cambia de longitud al pasar a minúsculas
+            text = text.lower()
+        parts = []
+        for start in starts:
+            a = max(0, start - self.SNIPPET_CONTEXT)
+            b = min(len(spans), start + self.SNIPPET_WINDOW)
+            if a >= b:
+                continue
+            fragment = ' '.join(text[spans[a][0]:spans[b - 1][1]].split())
+            if a > 0:
+                fragment = '... ' + fragment
+            if b < len(spans):
+                fragment += ' ...'
+            parts.append(fragment)
+        return ' [...] '.join(parts)
+
+
+    def count_queries(self, queries:List[str]) -> List[int]:
+        """
+        Devuelve el número de resultados de cada query, en el mismo orden (None si tiene un
+        error de sintaxis, ver self.count_valid()).
+
+        Con self.jobs > 1 las queries se reparten entre un pool de procesos creados con fork
+        después de cargar el índice: los procesos heredan el índice (el mmap y lo que ya se
+        ha cargado) de solo lectura, sin copiarlo ni volver a abrirlo.
+
+        Cada proceso tiene su propia copia de self.cache y de los resultados compartidos de
+        la lista de queries (ver self.start_batch()), que empiezan con lo que tenía este
+        proceso al crearlos: lo que resuelve un proceso no lo ven los demás, así que un nodo
+        compartido se resuelve (en paralelo) como mucho una vez en cada proceso que lo usa.
+        Los aciertos y fallos de las caches de los procesos se suman a los de self.cache.
+
+        """
+        if self.jobs > 1 and len(queries) > 1:
+            import multiprocessing
+            # sin fork (Windows) los procesos no pueden heredar el índice
+            if 'fork' in multiprocessing.get_all_start_methods():
+                global pool_searcher
+                pool_searcher = self
+                try:
+                    with multiprocessing.get_context('fork').Pool(self.jobs) as pool:
+                        # trozos de queries consecutivas, que suelen compartir términos en la cache
+                        chunksize = max(1, len(queries) // (4 * self.jobs))
+                        # map devuelve los resultados en el orden de las queries
+                        results = pool.map(count_query, queries, chunksize)
+                finally:
+                    pool_searcher = None
+                if self.batch is not None:
+                    self.batch.reused += sum(reused for _, reused, _ in results)
+                for _, _, counters in results:
+                    self.cache.add_counters(*counters)
+                return [n for n, _, _ in results]
+        return [self.count_valid(query) for query in queries]
+
+
+    def count_valid(self, query:str) -> Optional[int]:
+        """
+        Número de resultados de una query, o None si tiene un error de sintaxis (ver
+        queryparser.QuerySyntaxError): una query mal escrita no para la lista de queries.
+
+        """
+        try:
+            return self.count_results(query)
+        except QuerySyntaxError:
+            return None
+
+
+    def query_error(self, query:str) -> str:
+        """
+        Mensaje del error de sintaxis de una query.
+
+        """
+        if self.batch is not None and query in self.batch.errors:
+            return self.batch.errors[query]
+        try:
+            parse_query(query)
+        except QuerySyntaxError as e:
+            return str(e)
+        return ''
+
+
+    def start_batch(self, queries:List[str]):
+        """
+        Empieza a resolver una lista de queries: se construyen todos sus árboles y se buscan
+        las subexpresiones (y términos) que aparecen más de una vez, que se resuelven una
+        sola vez para toda la lista (ver queryparser.BatchPlan y self.solve_node()).
+
+        """
+        self.batch = BatchPlan(queries)
+
+
+    def end_batch(self):
+        """
+        Termina la lista de queries empezada con self.start_batch(), libera los resultados
+        compartidos y guarda sus estadísticas en self.batch_stats.
+
+        """
+        if self.batch is not None:
+            self.batch_stats = self.batch.stats()
+            self.batch = None
+
+
     def solve_and_count(self, ql:List[str], verbose:bool=True) -> List:
         results = []
-        for query in ql:
-            if len(query) > 0 and query[0] != '#':
-                r = self.solve_query(query)
-                results.append(len(r))
-                if verbose:
-                    print(f'{query}\t{len(r)}')
-            else:
-                results.append(0)
-                if verbose:
-                    print(query)
+        queries = [q for q in ql if len(q) > 0 and q[0] != '#']
+        self.start_batch(queries)
+        try:
+            # con varios procesos se resuelven todas antes de mostrar nada, ver self.count_queries()
+            counts = iter(self.count_queries(queries)) if self.jobs > 1 else None
+            for query in ql:
+                if len(query) > 0 and query[0] != '#':
+                    n = next(counts) if counts else self.count_valid(query)
+                    results.append(n)
+                    if verbose:
+                        if n is None:
+                            print(f'{query}\tmalformed query: {self.query_error(query)}')
+                        else:
+                            print(f'{query}\t{n}')
+                else:
+                    results.append(0)
+                    if verbose:
+                        print(query)
+        finally:
+            self.end_batch()
         return results
 
 
     def solve_and_test(self, ql:List[str]) -> bool:
         errors = False
-        for line in ql:
-            if len(line) > 0 and line[0] != '#':
-                query, ref = line.split('\t')
-                reference = int(ref)
-                result = len(self.solve_query(query))
-                if reference == result:
-                    print(f'{query}\t{result}')
-                else:
-                    print(f'>>>>{query}\t{reference} != {result}<<<<')
-                    errors = True                    
-            # else:
-            #     print(query)
+        queries = [line.split('\t')[0] for line in ql if len(line) > 0 and line[0] != '#']
+        self.start_batch(queries)
+        try:
+            counts = iter(self.count_queries(queries)) if self.jobs > 1 else None
+            for line in ql:
+                if len(line) > 0 and line[0] != '#':
+                    query, ref = line.split('\t')
+                    reference = int(ref)
+                    result = next(counts) if counts else self.count_valid(query)
+                    if result is None:
+                        print(f'>>>>{query}\t{reference} != malformed query: {self.query_error(query)}<<<<')
+                        errors = True
+                    elif reference == result:
+                        print(f'{query}\t{result}')
+                    else:
+                        print(f'>>>>{query}\t{reference} != {result}<<<<')
+                        errors = True                    
+                # else:
+                #     print(query)
+        finally:
+            self.end_batch()
         return not errors
 
 
@@ -1190,67 +2815,53 @@ class SAR_Indexer:
             para mostrarlos todos se debe especificar
         """
 
-        get = 10
-        
         if len(query) > 0 and query[0] != '#':
 
-            # resuelve la query
-            res = self.solve_query(query)
-
-            if(self.show_all):
-                get = len(res)
+            # los resultados se generan a medida que se muestran (ver self.iter_query()):
+            # sin -A solo se resuelve la query hasta encontrar los primeros self.SHOW_MAX
+            try:
+                res = self.iter_query(query)
+            except QuerySyntaxError as e:
+                print(f'malformed query: {e}')
+                return
+            if(not self.show_all):
+                res = itertools.islice(res, self.SHOW_MAX)
+            shown = 0
 
             # se muestran snippets 
             if(self.show_snippet and len(self.query_words(query)) < 5):
                 # recorre los documentos mencionados en la respuesta
                 for i, docId in enumerate(res):
-                    if(i >= get): break
+                    shown = i + 1
 
                     # obtiene los url y los títulos
                     url = self.articles[docId][0]
                     title = self.articles[docId][1]
 
-                    # abre los documentos usados para hacer el índice 
-                    for z in range(1, len(self.docs)):
-                        for line in open(f'{self.docs[z]}'):
-                            # parsea los artículos usados
-                            j = self.parse_article(line)
-                            # si el url del artículo es el que se está buscando
-                            if(j['url']) == url:
-
-                                # muestra su posición de recuperación, el id del artículo y su url
-                                print(f'# {i + 1} ( {docId})\t\u2192 {url}')
-                                # muestra el título
-                                print(f'# Titulo del articulo: {title}')
-                                # para cada palabra de la query
-                                for q in self.query_words(query):
-                                    
-                                    # expresion regular que encuentra una frase con la palabra dada
-                                    frase_regex = re.compile(rf'(^|(?<=\.\s)|(?<=\n))([^\.\n]*\b{q}\b[^\.\n]*)(?=\.?\s|$)', re.IGNORECASE) 
-                                    # saca las frases en las que aparece la palabra
-                                    frases = frase_regex.finditer(j['all'])
-                                    res_snippets = ''
-                                    
-
-                                    # añade reparados entre frases
-                                    for f in frases:
-                                        res_snippets += f.group(0).replace('\n', '') + ' [...] '
-                        
-                                    print(res_snippets)
+                    # lee y parsea solo el artículo recuperado
+                    j = self.get_article(docId)
+
+                    # muestra su posición de recuperación, el id del artículo y su url
+                    print(f'# {i + 1} ( {docId})\t\u2192 {url}')
+                    # muestra el título
+                    print(f'# Titulo del articulo: {title}')
+                    # muestra las mejores ventanas del texto con los términos de la query
+                    print(self.make_snippet(docId, j['all'], query))
 
             # no se muestran snippets
             else: 
                 # para cada documento recuperado
                 for i, artId in enumerate(res):
-                    if(i >= get): break
+                    shown = i + 1
                     # recupera el url y el título
                     url = self.articles[artId][0]
                     title = self.articles[artId][1]
                     # muestra la posición en la recuperación, el id del artíuclo y el título
                     print(f'# {i + 1} ( {artId}) {title}:\t{url}')
 
+            # con -A ya se han recorrido todos, si no se cuentan aparte (ver self.count_results())
             print('=====================================')
-            print('Number of results:', len(res))
+            print('Number of results:', shown if self.show_all else self.count_results(query))
 
 
 
@@ -1260,5 +2871,91 @@ class SAR_Indexer:
         filtered_words = [word for word in words if word not in exclude_words]
         return filtered_words
 
-        
 
+
+# SAR_Indexer que heredan los procesos de SAR_Indexer.count_queries()
+pool_searcher = None
+
+
+def count_query(query:str) -> tuple:
+    """
+    Número de resultados de una query, número de resultados compartidos de la lista de
+    queries que ha usado (ver queryparser.BatchPlan) y aciertos, fallos y entradas
+    descartadas de la cache al resolverla. Se ejecuta en los procesos del pool de
+    SAR_Indexer.count_queries().
+
+    """
+    batch = pool_searcher.batch
+    reused = batch.reused if batch is not None else 0
+    before = pool_searcher.cache.counters()
+    n = pool_searcher.count_valid(query)
+    counters = tuple(after - prev for after, prev in zip(pool_searcher.cache.counters(), before))
+    return n, (batch.reused - reused if batch is not None else 0), counters
+
+
+def index_chunk(task):
+    """
+    Construye el índice parcial de un trozo de fichero. Se ejecuta en los procesos
+    del pool de SAR_Indexer.index_parallel().
+
+    param:  "task": tupla (fichero, docid, byte inicial, byte final, multifield, positional,
+            stemming, permuterm). Se indexan las líneas que EMPIEZAN en [inicio, final).
+
+    return: tupla (articles, artpos, ntokens, index, sindex, ptindex, term_list, raw, stats) con
+            los artículos [url, title] del trozo, su posición en el fichero, sus tokens, su
+            índice y sus stems con las postings comprimidas, las rotaciones de sus términos y
+            sus términos, con ids locales (ver SAR_Indexer.merge_partial()), los bytes de las
+            postings sin comprimir y las medidas de la construcción (BuildStats)
+    """
+    filename, docid, start, end, multifield, positional, stemming, permuterm = task
+    indexer = SAR_Indexer()
+    indexer.multifield = multifield
+    indexer.positional = positional
+    fields_to_tokenize = indexer.fields_to_index()
+    counters = indexer.build_stats.counters
+    ntokens = array('I')
+
+    with open(filename, 'rb') as fh:
+        if start > 0:
+            # la línea que contiene el byte start-1 pertenece al trozo anterior
+            fh.seek(start - 1)
+            fh.readline()
+        while fh.tell() < end:
+            offset = fh.tell()
+            line = fh.readline()
+            if not line:
+                break
+            j = indexer.tokenize_article(line)
+            j['docpos'] = (docid, offset, len(line))
+            narts, tokens = len(indexer.articles), counters.get('tokens', 0)
+            with indexer.build_stats.phase('posting_insertion'):
+                indexer.index_article(j, fields_to_tokenize)
+            if len(indexer.articles) > narts:
+                ntokens.append(counters['tokens'] - tokens)
+
+    if stemming:
+        with indexer.build_stats.phase('make_stemming'):
+            indexer.make_stemming()
+    if permuterm:
+        # las rotaciones no se ordenan: SAR_Indexer.merge_partial() se queda solo con las de
+        # los términos nuevos y las ordena todas al final
+        with indexer.build_stats.phase('make_permuterm'):
+            for field, findex in indexer.index.items():
+                indexer.ptindex[field] = [rot for t in findex
+                                          for rot, _ in indexer.permuterms(indexer.term_list[t], t)]
+    # las postings nunca se comprimen como bitmaps: que una posting sea densa depende del
+    # número total de artículos, lo decide SAR_Indexer.compress_posting() al final
+    with indexer.build_stats.phase('compress'):
+        for findex in [*indexer.index.values(), *indexer.sindex.values()]:
+            keys = list(findex)
+            compressed, raw = compress_postings([findex[key] for key in keys])
+            indexer.posting_bytes[0] += raw
+            for key, posting in zip(keys, compressed):
+                findex[key] = posting
+    # los artículos y los tokens los cuenta SAR_Indexer.merge_partial(), sin los repetidos
+    counters.pop('articles', None)
+    counters.pop('tokens', None)
+
+    return ([indexer.articles[a] for a in sorted(indexer.articles)], indexer.artpos, ntokens,
+            indexer.index, indexer.sindex, indexer.ptindex, indexer.term_list,
+            indexer.posting_bytes[0], indexer.build_stats)
@@ -0,0 +1,101 @@
+"""
+Benchmark del arranque en frío de SAR_Searcher.py para una sola consulta (-Q).
+
+Ejecuta varias veces el buscador como un proceso nuevo y mide su tiempo total, y una vez
+con "python -X importtime" para ver qué módulos se importan y cuánto tardan. Falla (código
+de salida 1) si la mediana supera el presupuesto o si se importa alguno de los módulos
+pesados que solo hacen falta con stemming o corrección ortográfica.
+
+    python bench_startup.py index -Q casa -n 20 --budget 150
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# módulos que no se deben importar en una búsqueda sin -S ni corrección ortográfica; numpy
+# sí se importa si la consulta usa términos muy frecuentes (postings.BitmapPosting), por eso
+# la consulta por defecto es un término poco frecuente
+HEAVY_MODULES = ['nltk', 'numpy', 'distancias', 'spellsuggester', 'multiprocessing']
+
+
+def run(cmd, env, importtime=False):
+    """
+    Ejecuta el buscador y devuelve (segundos, stderr).
+
+    """
+    if importtime:
+        cmd = [cmd[0], '-X', 'importtime'] + cmd[1:]
+    t0 = time.perf_counter()
+    proc = subprocess.run(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                          text=True, check=True)
+    return time.perf_counter() - t0, proc.stderr
+
+
+def parse_importtime(stderr:str):
+    """
+    Devuelve la lista de (módulo, microsegundos acumulados, nivel de anidamiento) de la
+    salida de -X importtime.
+
+    """
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        modules.append((name.strip(), int(cumulative), depth))
+    return modules
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Measure the cold start of a one-shot search.')
+    parser.add_argument('index', metavar='index', type=str,
+                        help='name of the index.')
+    parser.add_argument('-Q', '--query', dest='query', type=str, default='casa',
+                        help='query to solve in each run.')
+    parser.add_argument('-n', '--runs', dest='runs', type=int, default=20,
+                        help='number of timed runs.')
+    parser.add_argument('--budget', dest='budget', type=float, default=150,
+                        help='maximum median wall time (ms) of a run.')
+    parser.add_argument('--script', dest='script', type=str, default='SAR_Searcher.py',
+                        help='searcher script to run.')
+    parser.add_argument('--top', dest='top', type=int, default=10,
+                        help='number of slowest imports to show.')
+    args = parser.parse_args()
+
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), args.script)
+    cmd = [sys.executable, script, args.index, '-Q', args.query]
+    # los .pyc deben poder guardarse, si no cada arranque vuelve a compilar los módulos
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+
+    # la primera ejecución compila los módulos y carga el índice en la cache de páginas
+    run(cmd, env)
+    times = [run(cmd, env)[0] * 1000 for _ in range(args.runs)]
+    median = statistics.median(times)
+
+    modules = parse_importtime(run(cmd, env, importtime=True)[1])
+    imported = {name for name, _, _ in modules}
+    total_imports = sum(cumulative for _, cumulative, depth in modules if depth == 0) / 1000
+
+    print(f'runs: {args.runs}')
+    print(f'wall time (ms): median {median:.1f}, min {min(times):.1f}, max {max(times):.1f}')
+    print(f'import time (ms): {total_imports:.1f}')
+    print(f'slowest top-level imports:')
+    for name, cumulative, _ in sorted((m for m in modules if m[2] == 0), key=lambda m: -m[1])[:args.top]:
+        print(f'\t{cumulative / 1000:8.1f} ms  {name}')
+
+    ok = True
+    heavy = [name for name in HEAVY_MODULES if name in imported]
+    if heavy:
+        print(f'ERROR: heavy modules imported: {", ".join(heavy)}')
+        ok = False
+    if median > args.budget:
+        print(f'ERROR: median wall time {median:.1f} ms is over the budget of {args.budget:.1f} ms')
+        ok = False
+    print('OK' if ok else 'FAIL')
+    sys.exit(0 if ok else 1)
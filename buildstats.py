@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Instrumentación de la construcción del índice (SAR_Indexer).
+
+Para cada fase se acumulan el número de llamadas, el tiempo real (wall), el tiempo de CPU
+y el pico de memoria del proceso al terminar la fase. Las fases se pueden anidar: el tiempo
+de cada fase NO incluye el de las fases que se ejecutan dentro de ella (wall_s / cpu_s),
+el tiempo total con las fases anidadas está en wall_total_s.
+"""
+import json
+import time
+
+try:
+    import resource
+except ImportError:  # no existe en Windows
+    resource = None
+
+
+def peak_rss_kb():
+    """
+    Pico de memoria residente del proceso en KB (None si no se puede medir).
+
+    """
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class Phase:
+    """
+    Context manager que mide una fase, ver BuildStats.phase()
+    """
+
+    __slots__ = ('stats', 'name')
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.stats.start(self.name)
+        return self
+
+    def __exit__(self, *exc):
+        self.stats.stop()
+        return False
+
+
+class BuildStats:
+    """
+    Tiempos, memoria y contadores de la construcción de un índice.
+    """
+
+    def __init__(self):
+        self.phases = {} # nombre -> {'calls', 'wall_s', 'cpu_s', 'wall_total_s', 'peak_rss_kb'}
+        self.counters = {} # nombre -> entero
+        self.stack = [] # fases en curso: [nombre, wall inicial, cpu inicial, wall hijas, cpu hijas]
+
+    def phase(self, name:str) -> Phase:
+        """
+        Devuelve un context manager que mide la fase "name":
+
+            with self.stats.phase('tokenize'):
+                ...
+        """
+        return Phase(self, name)
+
+    def start(self, name:str):
+        self.stack.append([name, time.perf_counter(), time.process_time(), 0.0, 0.0])
+
+    def stop(self):
+        name, wall0, cpu0, child_wall, child_cpu = self.stack.pop()
+        wall = time.perf_counter() - wall0
+        cpu = time.process_time() - cpu0
+        if self.stack:
+            self.stack[-1][3] += wall
+            self.stack[-1][4] += cpu
+        self.add(name, wall - child_wall, cpu - child_cpu, wall, peak_rss_kb())
+
+    def add(self, name:str, wall:float, cpu:float, wall_total:float, rss, calls:int=1):
+        """
+        Acumula una medida en la fase "name".
+
+        """
+        ph = self.phases.setdefault(name, {'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0,
+                                           'wall_total_s': 0.0, 'peak_rss_kb': None})
+        ph['calls'] += calls
+        ph['wall_s'] += wall
+        ph['cpu_s'] += cpu
+        ph['wall_total_s'] += wall_total
+        if rss is not None and (ph['peak_rss_kb'] is None or rss > ph['peak_rss_kb']):
+            ph['peak_rss_kb'] = rss
+
+    def count(self, name:str, n:int=1):
+        """
+        Suma "n" al contador "name" (artículos, tokens...).
+
+        """
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def merge(self, other:'BuildStats'):
+        """
+        Acumula las medidas de otro BuildStats, p.ej. el de un proceso del pool.
+
+        """
+        for name, ph in other.phases.items():
+            self.add(name, ph['wall_s'], ph['cpu_s'], ph['wall_total_s'], ph['peak_rss_kb'], ph['calls'])
+        for name, n in other.counters.items():
+            self.count(name, n)
+
+    def report(self) -> dict:
+        """
+        Devuelve el informe como un diccionario serializable a JSON.
+        El throughput se calcula sobre el tiempo total de la fase 'index_dir'.
+
+        """
+        total = self.phases.get('index_dir', {}).get('wall_total_s', 0.0)
+        throughput = {}
+        if total > 0:
+            for name in ('articles', 'tokens'):
+                if name in self.counters:
+                    throughput[f'{name}_per_s'] = self.counters[name] / total
+        return {'phases': self.phases, 'counters': self.counters,
+                'throughput': throughput, 'peak_rss_kb': peak_rss_kb()}
+
+    def save(self, filename:str):
+        """
+        Guarda el informe en formato JSON.
+
+        """
+        with open(filename, 'w', encoding='utf-8') as fh:
+            json.dump(self.report(), fh, indent=2, sort_keys=True)
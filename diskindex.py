@@ -0,0 +1,685 @@
+# -*- coding: utf-8 -*-
+"""
+Formato binario del índice de SAR_Indexer, leído con mmap.
+
+El fichero empieza por MAGIC y dos enteros de 8 bytes con la posición y la longitud de la
+cabecera, que está al final del fichero y es un pickle pequeño con las opciones del índice
+y la posición de cada sección. Las secciones son:
+
+    - tablas de cadenas: los textos en UTF-8 uno detrás de otro y un array con el byte
+      en el que empieza cada uno (n+1 elementos). El diccionario de términos y los de stems
+      están ordenados, así que se buscan con búsqueda binaria sin cargarlos.
+    - tablas de postings: un array con una fila (n, último artId, inicio, bytes de los
+      artIds, bytes de las posiciones) por posting y los datos de las CompressedPosting: los
+      artIds, la tabla de saltos (un bloque cada postings.SKIP artIds) y, si es posicional,
+      los offsets y las posiciones. Si no todas las claves tienen posting (los ids de los
+      términos son globales y cada campo solo tiene algunos) hay además un array('I')
+      ordenado con la clave de cada fila, que se busca con búsqueda binaria. Si alguna es un
+      BitmapPosting hay un byte por fila que vale 1 para los bitmaps, que empiezan en un
+      múltiplo de 8 y no tienen tabla de saltos.
+
+Los arrays de posiciones (offsets de las cadenas, filas de las postings...) son de 4 bytes
+('I') si todos sus valores caben en 32 bits y de 8 ('Q') si no, su tipo va en la cabecera.
+
+Al abrir el índice solo se deserializa la cabecera: las postings y los términos se leen
+bajo demanda del mmap, que comparten todos los procesos a través de la cache de páginas.
+Además cada sección (el índice de cada campo, su índice de stems y su permuterm, los
+artículos...) se abre la primera vez que se usa, ver LazyMap y SAR_Indexer.__getattr__().
+"""
+import mmap
+import pickle
+import struct
+from array import array
+from bisect import bisect_left
+
+from postings import BitmapPosting, CompressedPosting, SKIP
+
+MAGIC = b'SARIDX1\n'
+HEADER = struct.Struct('<QQ')
+ROW = 5 # elementos de cada fila de una tabla de postings
+
+
+def narrow(values:array) -> array:
+    """
+    Devuelve "values" (array('Q')) como array('I') si todos sus valores caben en 32 bits.
+
+    """
+    if max(values, default=0) < 1 << 32:
+        return array('I', values)
+    return values
+
+
+def is_disk_index(filename:str) -> bool:
+    """
+    True si el fichero tiene el formato binario, False si es un pickle de una versión anterior.
+
+    """
+    with open(filename, 'rb') as fh:
+        return fh.read(len(MAGIC)) == MAGIC
+
+
+class StringTable:
+    """
+    Secuencia de cadenas guardada en el mmap.
+    """
+
+    __slots__ = ('offsets', 'blob')
+
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def raw(self, i:int) -> bytes:
+        return bytes(self.blob[self.offsets[i]:self.offsets[i + 1]])
+
+    def __getitem__(self, i:int) -> str:
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return str(self.blob[self.offsets[i]:self.offsets[i + 1]], 'utf-8')
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+class SortedDict:
+    """
+    Diccionario cadena -> posición de una StringTable ordenada. Los ids de los términos
+    del índice binario son su posición en el orden alfabético.
+    """
+
+    __slots__ = ('table',)
+
+    def __init__(self, table:StringTable):
+        self.table = table
+
+    def get(self, key:str, default=None):
+        # el orden de los bytes en UTF-8 es el mismo que el de las cadenas
+        target = key.encode('utf-8')
+        lo, hi = 0, len(self.table)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.table.raw(mid) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.table) and self.table.raw(lo) == target:
+            return lo
+        return default
+
+    def __getitem__(self, key:str) -> int:
+        i = self.get(key)
+        if i is None:
+            raise KeyError(key)
+        return i
+
+    def __contains__(self, key:str):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self.table)
+
+    def __iter__(self):
+        return iter(self.table)
+
+    def keys(self):
+        return iter(self.table)
+
+    def items(self):
+        return ((key, i) for i, key in enumerate(self.table))
+
+
+class PostingTable:
+    """
+    Posting lists de un campo guardadas en el mmap. Se comporta como FieldIndex, un
+    diccionario id -> CompressedPosting, las postings se construyen en cada acceso sobre
+    memoryviews del mmap sin copiar los datos.
+    """
+
+    __slots__ = ('rows', 'data', 'positional', 'n', 'bitmaps', 'tids')
+
+    def __init__(self, rows, data, positional:bool, n:int, bitmaps=None, tids=None):
+        """
+        "bitmaps" tiene un byte por fila, 1 si su posting es un BitmapPosting (None si no hay).
+        "tids" es la clave de cada fila, en orden, o None si la fila i-ésima es la de la clave i.
+        """
+        self.rows = rows
+        self.data = data
+        self.positional = positional
+        self.n = n
+        self.bitmaps = bitmaps
+        self.tids = tids
+
+    def row(self, tid:int):
+        """
+        Devuelve el número de fila de la clave "tid", o None si no tiene posting.
+
+        """
+        if self.tids is None:
+            if 0 <= tid < len(self.rows) // ROW and self.rows[ROW * tid] != 0:
+                return tid
+            return None
+        i = bisect_left(self.tids, tid)
+        if i < len(self.tids) and self.tids[i] == tid:
+            return i
+        return None
+
+    def get(self, tid:int, default=None):
+        i = self.row(tid)
+        if i is None:
+            return default
+        return self.posting(i)
+
+    def posting(self, i:int) -> CompressedPosting:
+        """
+        Construye la posting de la fila i-ésima.
+
+        """
+        n, last, start, docs_len, pos_len = self.rows[ROW * i:ROW * (i + 1)]
+        docs = self.data[start:start + docs_len]
+        start += docs_len
+        skips = None
+        cls = CompressedPosting
+        if self.bitmaps is not None and self.bitmaps[i]:
+            cls = BitmapPosting
+        else:
+            start += -start % 4
+            size = 8 * (n // SKIP)
+            skips = self.data[start:start + size].cast('I')
+            start += size
+        if not self.positional:
+            return cls.from_buffers(n, last, docs, skips=skips)
+        start += -start % 4
+        offsets = self.data[start:start + 4 * (n + 1)].cast('I')
+        start += 4 * (n + 1)
+        return cls.from_buffers(n, last, docs, self.data[start:start + pos_len], offsets, skips)
+
+    def __getitem__(self, tid:int):
+        posting = self.get(tid)
+        if posting is None:
+            raise KeyError(tid)
+        return posting
+
+    def __contains__(self, tid:int):
+        return self.row(tid) is not None
+
+    def __len__(self):
+        return self.n
+
+    def __iter__(self):
+        if self.tids is not None:
+            return iter(self.tids)
+        rows = self.rows
+        return (tid for tid in range(len(rows) // ROW) if rows[ROW * tid] != 0)
+
+    def keys(self):
+        return iter(self)
+
+    def items(self):
+        if self.tids is not None:
+            return ((tid, self.posting(i)) for i, tid in enumerate(self.tids))
+        return ((tid, self.posting(tid)) for tid in self)
+
+    def raw(self, i:int) -> 'RawPosting':
+        """
+        Devuelve la fila i-ésima con sus datos sin construir la posting, ver RawPosting.
+
+        """
+        n, last, start, docs_len, pos_len = self.rows[ROW * i:ROW * (i + 1)]
+        bitmap = self.bitmaps is not None and self.bitmaps[i] == 1
+        end = start + docs_len
+        if not bitmap:
+            end += -end % 4 + 8 * (n // SKIP)
+        if self.positional:
+            end += -end % 4 + 4 * (n + 1) + pos_len
+        return RawPosting(n, last, self.data[start:end], start, docs_len, pos_len, bitmap, self.positional)
+
+    def raw_items(self):
+        """
+        Como items() pero con las filas sin construir, para copiarlas a otro índice con
+        Writer.postings().
+
+        """
+        if self.tids is not None:
+            return ((tid, self.raw(i)) for i, tid in enumerate(self.tids))
+        return ((tid, self.raw(tid)) for tid in self)
+
+
+class RawPosting:
+    """
+    Fila de una PostingTable con los bytes de su posting (bloque de documentos, saltos,
+    offsets y posiciones) tal y como están en el mmap. Writer.postings() la copia sin
+    decodificarla manteniendo la alineación de "start" módulo 8.
+    """
+
+    __slots__ = ('n', 'last', 'data', 'start', 'docs_len', 'pos_len', 'bitmap', 'positional')
+
+    def __init__(self, n:int, last:int, data, start:int, docs_len:int, pos_len:int, bitmap:bool,
+                 positional:bool):
+        self.n = n
+        self.last = last
+        self.data = data
+        self.start = start
+        self.docs_len = docs_len
+        self.pos_len = pos_len
+        self.bitmap = bitmap
+        self.positional = positional
+
+
+class StemTable:
+    """
+    Índice de stems de un campo: diccionario stem -> CompressedPosting.
+    """
+
+    __slots__ = ('stems', 'postings')
+
+    def __init__(self, stems:SortedDict, postings:PostingTable):
+        self.stems = stems
+        self.postings = postings
+
+    def get(self, stem:str, default=None):
+        i = self.stems.get(stem)
+        return default if i is None else self.postings.get(i, default)
+
+    def __getitem__(self, stem:str):
+        return self.postings[self.stems[stem]]
+
+    def __contains__(self, stem:str):
+        return stem in self.stems
+
+    def __len__(self):
+        return len(self.stems)
+
+    def __iter__(self):
+        return iter(self.stems)
+
+    def keys(self):
+        return iter(self.stems)
+
+    def items(self):
+        return ((stem, self.postings.get(i)) for stem, i in self.stems.items())
+
+    def raw_items(self):
+        """
+        Como items() pero con las filas sin construir, ver PostingTable.raw_items().
+
+        """
+        return ((stem, self.postings.raw(i)) for stem, i in self.stems.items())
+
+
+class ArticleTable:
+    """
+    Artículos del índice: diccionario artId -> [url, título], con los artId consecutivos
+    empezando en 1.
+    """
+
+    __slots__ = ('urls', 'titles')
+
+    def __init__(self, urls:StringTable, titles:StringTable):
+        self.urls = urls
+        self.titles = titles
+
+    def __getitem__(self, artId:int) -> list:
+        if not 1 <= artId <= len(self.urls):
+            raise KeyError(artId)
+        return [self.urls[artId - 1], self.titles[artId - 1]]
+
+    def get(self, artId:int, default=None):
+        try:
+            return self[artId]
+        except KeyError:
+            return default
+
+    def __contains__(self, artId:int):
+        return 1 <= artId <= len(self.urls)
+
+    def __len__(self):
+        return len(self.urls)
+
+    def __iter__(self):
+        return iter(range(1, len(self.urls) + 1))
+
+    def keys(self):
+        return iter(self)
+
+    def items(self):
+        return ((artId, self[artId]) for artId in self)
+
+
+class LazyMap:
+    """
+    Diccionario de solo lectura cuyos valores se construyen la primera vez que se piden.
+    """
+
+    __slots__ = ('loaders', 'loaded')
+
+    def __init__(self, loaders:dict):
+        """
+        param:  "loaders": diccionario clave -> función sin argumentos que construye el valor
+        """
+        self.loaders = loaders
+        self.loaded = {}
+
+    def __getitem__(self, key):
+        if key not in self.loaded:
+            self.loaded[key] = self.loaders[key]()
+        return self.loaded[key]
+
+    def get(self, key, default=None):
+        return self[key] if key in self.loaders else default
+
+    def __contains__(self, key):
+        return key in self.loaders
+
+    def __len__(self):
+        return len(self.loaders)
+
+    def __iter__(self):
+        return iter(self.loaders)
+
+    def keys(self):
+        return iter(self.loaders)
+
+    def values(self):
+        return (self[key] for key in self.loaders)
+
+    def items(self):
+        return ((key, self[key]) for key in self.loaders)
+
+
+class Overlay:
+    """
+    Diccionario de solo lectura (PostingTable, StemTable, ArticleTable) con cambios encima:
+    los valores que se asignan se guardan en memoria y el resto se lee del original. Así se
+    pueden añadir artículos a un índice abierto con mmap copiando solo las postings que
+    cambian, ver SAR_Indexer.make_writable().
+    """
+
+    __slots__ = ('base', 'changes')
+
+    def __init__(self, base):
+        self.base = base
+        self.changes = {}
+
+    def get(self, key, default=None):
+        value = self.changes.get(key)
+        if value is None:
+            return self.base.get(key, default)
+        return value
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.changes[key] = value
+
+    def __contains__(self, key):
+        return key in self.changes or key in self.base
+
+    def __len__(self):
+        return len(self.base) + sum(1 for key in self.changes if key not in self.base)
+
+    def __iter__(self):
+        yield from self.base
+        for key in self.changes:
+            if key not in self.base:
+                yield key
+
+    def keys(self):
+        return iter(self)
+
+    def items(self):
+        for key, value in self.base.items():
+            yield key, self.changes.get(key, value)
+        for key, value in self.changes.items():
+            if key not in self.base:
+                yield key, value
+
+    def raw_items(self):
+        """
+        Como items() pero con los valores sin cambios sin construir, para que
+        Writer.postings() los copie tal cual (ver PostingTable.raw_items()).
+
+        """
+        for key, value in self.base.raw_items():
+            yield key, self.changes.get(key, value)
+        for key, value in self.changes.items():
+            if key not in self.base:
+                yield key, value
+
+
+class Writer:
+    """
+    Escribe las secciones del índice binario. Cada sección empieza en un múltiplo de 8 para
+    que los arrays se puedan leer del mmap con memoryview.cast().
+    """
+
+    def __init__(self, fh):
+        self.fh = fh
+        fh.write(MAGIC)
+        fh.write(HEADER.pack(0, 0))
+
+    @classmethod
+    def resume(cls, fh):
+        """
+        Sigue escribiendo al final de un fichero que se empezó con otro Writer y todavía no
+        tiene cabecera, p.ej. el índice que escribe SAR_Indexer.merge_runs().
+
+        """
+        out = cls.__new__(cls)
+        out.fh = fh
+        fh.seek(0, 2)
+        return out
+
+    def section(self, data) -> tuple:
+        """
+        Escribe un bloque de bytes (o un array) y devuelve su (posición, longitud).
+
+        """
+        pad = -self.fh.tell() % 8
+        if pad:
+            self.fh.write(b'\0' * pad)
+        start = self.fh.tell()
+        self.fh.write(data)
+        return start, self.fh.tell() - start
+
+    def strings(self, strings) -> tuple:
+        """
+        Escribe una tabla de cadenas, ver StringTable.
+
+        """
+        blob = bytearray()
+        offsets = array('Q', [0])
+        for s in strings:
+            blob += s.encode('utf-8')
+            offsets.append(len(blob))
+        offsets = narrow(offsets)
+        return ('strings', self.section(offsets), self.section(blob), offsets.typecode)
+
+    def postings(self, postings:list) -> tuple:
+        """
+        Escribe una tabla de postings, ver PostingTable.
+
+        param:  "postings": lista con la CompressedPosting (o RawPosting) de cada id, en
+                orden (None si la clave no tiene posting)
+        """
+        table = self.posting_table()
+        for tid, posting in enumerate(postings):
+            if posting is not None:
+                table.add(tid, posting)
+        return table.close()
+
+    def posting_table(self) -> 'PostingWriter':
+        """
+        Empieza una tabla de postings que se escribe posting a posting, ver PostingWriter.
+        Hasta cerrarla no se puede escribir ninguna otra sección.
+
+        """
+        return PostingWriter(self)
+
+    def groups(self, groups:dict) -> tuple:
+        """
+        Escribe un diccionario entero -> array('I') ordenado, p.ej. los términos agrupados
+        por longitud para la corrección ortográfica (ver spellsuggester.length_buckets()).
+
+        """
+        keys = sorted(groups)
+        offsets = array('Q', [0])
+        ids = array('I')
+        for key in keys:
+            ids.extend(groups[key])
+            offsets.append(len(ids))
+        offsets = narrow(offsets)
+        return ('groups', self.section(array('I', keys)), self.section(offsets), self.section(ids),
+                offsets.typecode)
+
+    def close(self, header:dict):
+        """
+        Escribe la cabecera al final del fichero y su posición al principio.
+
+        """
+        start, length = self.section(pickle.dumps(header))
+        self.fh.seek(len(MAGIC))
+        self.fh.write(HEADER.pack(start, length))
+
+
+class PostingWriter:
+    """
+    Tabla de postings que se escribe en orden de clave sin tenerla entera en memoria: los
+    datos de cada posting van directamente al fichero y al cerrarla se escriben las filas,
+    las claves y los bitmaps (lo único que se guarda en memoria). Se crea con
+    Writer.posting_table().
+    """
+
+    def __init__(self, out:Writer):
+        self.out = out
+        # los datos empiezan en un múltiplo de 8, como cualquier sección
+        self.start, _ = out.section(b'')
+        self.size = 0
+        self.rows = array('Q')
+        self.tids = array('I')
+        self.bitmaps = bytearray()
+        self.positional = None
+
+    def write(self, data):
+        self.size += self.out.fh.write(data)
+
+    def pad(self, n:int):
+        """
+        Rellena con ceros hasta que los datos ocupan un múltiplo de "n" bytes.
+
+        """
+        if self.size % n:
+            self.write(b'\0' * (-self.size % n))
+
+    def add(self, tid:int, posting):
+        """
+        Escribe la CompressedPosting (o RawPosting) de la clave "tid", mayor que las anteriores.
+
+        """
+        # las postings de un campo tienen todas posiciones o ninguna
+        if self.positional is None:
+            self.positional = posting.positional if isinstance(posting, RawPosting) else posting.pos is not None
+        self.tids.append(tid)
+        if isinstance(posting, RawPosting):
+            # se copia con el mismo desplazamiento módulo 8 para que sus arrays queden
+            # alineados igual que en el índice del que viene
+            self.write(b'\0' * ((posting.start - self.size) % (8 if posting.bitmap else 4)))
+            self.bitmaps.append(posting.bitmap)
+            self.rows.extend((posting.n, posting.last, self.size, posting.docs_len, posting.pos_len))
+            self.write(posting.data)
+            return
+        bitmap = isinstance(posting, BitmapPosting)
+        if bitmap:
+            # los bitmaps se leen como palabras de 8 bytes
+            self.pad(8)
+        self.bitmaps.append(bitmap)
+        start = self.size
+        self.write(posting.docs)
+        # los arrays empiezan en un múltiplo de 4
+        self.pad(4)
+        self.write(posting.skips)
+        pos_len = 0
+        if self.positional:
+            self.write(posting.offsets)
+            self.write(posting.pos)
+            pos_len = len(posting.pos)
+        self.rows.extend((posting.n, posting.last, start, len(posting.docs), pos_len))
+
+    def close(self) -> tuple:
+        """
+        Escribe las filas y devuelve la descripción de la tabla para la cabecera.
+
+        """
+        data = (self.start, self.size)
+        rows = narrow(self.rows)
+        tids = self.tids
+        # si las claves son 0, 1, 2... la fila i-ésima es la de la clave i y no se guardan
+        dense = not tids or tids[-1] == len(tids) - 1
+        return ('postings', self.out.section(rows), data, bool(self.positional), len(tids),
+                self.out.section(self.bitmaps) if any(self.bitmaps) else None,
+                None if dense else self.out.section(tids), rows.typecode)
+
+
+class Reader:
+    """
+    Abre un índice binario con mmap y construye los objetos de sus secciones.
+    """
+
+    def __init__(self, filename:str, header:dict=None):
+        """
+        Si se da "header" no se lee la del fichero, p.ej. para abrir las secciones ya
+        escritas de un índice que todavía no tiene cabecera (ver Writer.resume()).
+        """
+        with open(filename, 'rb') as fh:
+            self.mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mm)
+        if header is None:
+            start, length = HEADER.unpack_from(self.mm, len(MAGIC))
+            header = pickle.loads(self.view[start:start + length])
+        self.header = header
+
+    def block(self, section:tuple):
+        start, length = section
+        return self.view[start:start + length]
+
+    def open(self, desc:tuple):
+        """
+        Devuelve el objeto que corresponde a la descripción de una sección, ver Writer.
+
+        """
+        if desc[0] == 'strings':
+            _, offsets, blob, code = desc
+            return StringTable(self.block(offsets).cast(code), self.block(blob))
+        _, rows, data, positional, n, bitmaps, tids, code = desc
+        return PostingTable(self.block(rows).cast(code), self.block(data), positional, n,
+                            None if bitmaps is None else self.block(bitmaps),
+                            None if tids is None else self.block(tids).cast('I'))
+
+    def stems(self, desc:tuple) -> StemTable:
+        stems, postings = desc
+        return StemTable(SortedDict(self.open(stems)), self.open(postings))
+
+    def permuterm(self, desc:tuple) -> tuple:
+        rots, ids = desc
+        return self.open(rots), self.block(ids).cast('I')
+
+    def articles(self, desc:tuple) -> ArticleTable:
+        urls, titles = desc
+        return ArticleTable(self.open(urls), self.open(titles))
+
+    def groups(self, desc:tuple) -> dict:
+        _, keys, offsets, ids, code = desc
+        offsets = self.block(offsets).cast(code)
+        ids = self.block(ids).cast('I')
+        return {key: ids[offsets[k]:offsets[k + 1]] for k, key in enumerate(self.block(keys).cast('I'))}
+
+    def pickled(self, section:tuple):
+        return pickle.loads(self.block(section))
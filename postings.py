@@ -0,0 +1,1097 @@
+# -*- coding: utf-8 -*-
+"""
+Posting lists comprimidas para SAR_Indexer.
+
+Los artId (y las posiciones) se guardan como diferencias (gaps) con el anterior
+codificadas en variable byte: 7 bits por byte, el bit alto marca el último byte
+de cada número. Todo se guarda en objetos bytes / array, sin enteros de Python.
+
+Los artIds se agrupan en bloques de SKIP con una tabla de saltos (el último artId y el
+byte en el que termina cada bloque), así se puede buscar un artId o intersecar con una
+lista corta decodificando solo los bloques necesarios.
+
+Las postings de los términos muy frecuentes se guardan como bitmaps (BitmapPosting) y
+los AND, OR y NOT en los que participan se calculan con numpy palabra a palabra, ver
+bitmap_and(), bitmap_union() y bitmap_minus(). numpy solo se importa al usar un bitmap.
+
+Para mostrar los primeros resultados de una query sin resolverla entera las postings se
+pueden recorrer con iteradores (iter_docs()) que se combinan en streaming con iter_and(),
+iter_or(), iter_minus() e iter_complement().
+"""
+import heapq
+import sys
+from array import array
+from bisect import bisect_left
+from itertools import chain
+
+# artIds de cada bloque de la tabla de saltos de CompressedPosting
+SKIP = 128
+# tabla de saltos vacía, compartida por todas las postings con menos de SKIP artIds
+NO_SKIPS = array('I')
+
+
+def skip_table(maxima:array, ends:array) -> array:
+    """
+    Junta los últimos artIds y los finales de los bloques en una tabla de saltos.
+
+    """
+    return maxima + ends if maxima else NO_SKIPS
+
+
+def vb_encode(numbers, out:bytearray=None, prev:int=0) -> bytearray:
+    """
+    Codifica una secuencia creciente de enteros como gaps en variable byte.
+
+    param:  "numbers": enteros ordenados de menor a mayor
+            "out": bytearray al que se añade el resultado, si es None se crea uno nuevo
+            "prev": valor respecto al que se calcula el primer gap
+
+    return: el bytearray con el resultado
+    """
+    if out is None:
+        out = bytearray()
+    for n in numbers:
+        gap = n - prev
+        prev = n
+        while gap >= 128:
+            out.append(gap & 127)
+            gap >>= 7
+        out.append(gap | 128)
+    return out
+
+
+def vb_decode(data, start:int=0, end:int=None, prev:int=0) -> list:
+    """
+    Decodifica los gaps en variable byte de data[start:end] y devuelve la lista de enteros.
+    "prev" es el valor respecto al que está calculado el primer gap.
+
+    """
+    if end is None:
+        end = len(data)
+    res = []
+    n = 0; shift = 0
+    for i in range(start, end):
+        b = data[i]
+        if b & 128:
+            prev += n | ((b & 127) << shift)
+            res.append(prev)
+            n = 0; shift = 0
+        else:
+            n |= b << shift
+            shift += 7
+    return res
+
+
+def vb_first(data) -> tuple:
+    """
+    Decodifica el primer número en variable byte de "data".
+
+    return: par (número, bytes que ocupa)
+    """
+    n = 0; shift = 0
+    for i, b in enumerate(data):
+        if b & 128:
+            return n | ((b & 127) << shift), i + 1
+        n |= b << shift
+        shift += 7
+    raise ValueError('truncated variable byte number')
+
+
+def vb_encode_array(gaps) -> tuple:
+    """
+    Codifica en variable byte, como vb_encode(), un array de numpy de gaps ya calculados,
+    todos a la vez: se cuenta cuántos bytes ocupa cada número y se escribe el byte k-ésimo
+    de todos los que tienen al menos k+1 bytes en una sola operación.
+
+    return: par (bytes codificados, array de numpy con el byte en el que empieza cada
+            número y al final la longitud total, len(gaps)+1 elementos)
+    """
+    import numpy as np
+    nbytes = np.ones(len(gaps), dtype=np.int64)
+    shift = 7
+    while True:
+        big = (gaps >> shift) != 0
+        if not big.any():
+            break
+        nbytes += big
+        shift += 7
+    ends = np.zeros(len(gaps) + 1, dtype=np.int64)
+    np.cumsum(nbytes, out=ends[1:])
+    out = np.empty(int(ends[-1]), dtype=np.uint8)
+    starts = ends[:-1]
+    out[starts] = gaps & 127
+    for k in range(1, shift // 7):
+        sel = nbytes > k
+        out[starts[sel] + k] = (gaps[sel] >> (7 * k)) & 127
+    # el bit alto marca el último byte de cada número
+    out[ends[1:] - 1] |= 128
+    return out.tobytes(), ends
+
+
+def gallop_intersect(short:list, long:list) -> list:
+    """
+    Intersección de dos listas ordenadas de longitudes muy distintas: cada elemento de
+    "short" se busca en "long" con búsqueda exponencial (galloping) desde la posición del
+    anterior, en tiempo O(len(short) * log(len(long) / len(short))).
+
+    """
+    res = []
+    lo = 0
+    n = len(long)
+    for doc in short:
+        bound = 1
+        while lo + bound < n and long[lo + bound] < doc:
+            bound *= 2
+        lo = bisect_left(long, doc, lo, min(lo + bound + 1, n))
+        if lo == n:
+            break
+        if long[lo] == doc:
+            res.append(doc)
+    return res
+
+
+def offset_intersect(starts:list, positions:list, offset:int) -> list:
+    """
+    Devuelve los elementos s de la lista ordenada "starts" tales que s + offset está en la
+    lista ordenada "positions": las dos listas se recorren a la vez (merge), buscando cada
+    elemento con búsqueda binaria desde la posición del anterior.
+
+    """
+    res = []
+    lo = 0
+    n = len(positions)
+    for start in starts:
+        lo = bisect_left(positions, start + offset, lo)
+        if lo == n:
+            break
+        if positions[lo] == start + offset:
+            res.append(start)
+    return res
+
+
+def gallop_difference(short:list, long:list) -> list:
+    """
+    Elementos de "short" que no están en "long", con búsqueda exponencial como en
+    gallop_intersect().
+
+    """
+    res = []
+    lo = 0
+    n = len(long)
+    for k, doc in enumerate(short):
+        bound = 1
+        while lo + bound < n and long[lo + bound] < doc:
+            bound *= 2
+        lo = bisect_left(long, doc, lo, min(lo + bound + 1, n))
+        if lo == n:
+            res.extend(short[k:])
+            break
+        if long[lo] != doc:
+            res.append(doc)
+    return res
+
+
+def gallop_remove(long:list, short:list) -> list:
+    """
+    Elementos de "long" que no están en "short": se copian los trozos de "long" entre los
+    elementos de "short", que se localizan con búsqueda exponencial.
+
+    """
+    res = []
+    lo = 0
+    n = len(long)
+    for doc in short:
+        bound = 1
+        while lo + bound < n and long[lo + bound] < doc:
+            bound *= 2
+        i = bisect_left(long, doc, lo, min(lo + bound + 1, n))
+        res.extend(long[lo:i])
+        if i == n:
+            return res
+        lo = i + 1 if long[i] == doc else i
+    res.extend(long[lo:])
+    return res
+
+
+class CompressedPosting:
+    """
+    Posting list comprimida.
+
+        docs: artIds codificados con vb_encode()
+        pos: posiciones de cada artículo codificadas con vb_encode(), una detrás de otra
+             (None si el índice no es posicional)
+        offsets: offsets[i] es el byte de self.pos en el que empiezan las posiciones del
+             artículo i-ésimo, tiene n+1 elementos
+        skips: tabla de saltos de los B = n // SKIP bloques completos de artIds: skips[b]
+             es el último artId del bloque b y skips[B + b] el byte de self.docs en el que
+             termina. Los artIds que quedan después del último bloque completo forman el
+             bloque B, que no está en la tabla
+
+    Los artIds se decodifican la primera vez que se necesitan y se guardan en una cache
+    que no se serializa.
+    """
+
+    __slots__ = ('n', 'last', 'docs', 'pos', 'offsets', 'skips', '_cache')
+
+    def __init__(self, docs:list, positions:list=None):
+        """
+        param:  "docs": lista ordenada de artIds
+                "positions": lista con la lista de posiciones de cada artId, o None
+        """
+        self.n = len(docs)
+        self.last = docs[-1] if docs else 0
+        out = bytearray()
+        maxima = array('I')
+        ends = array('I')
+        # se codifica bloque a bloque para anotar dónde termina cada uno
+        for b in range(SKIP, len(docs) + 1, SKIP):
+            vb_encode(docs[b - SKIP:b], out, docs[b - SKIP - 1] if b > SKIP else 0)
+            maxima.append(docs[b - 1])
+            ends.append(len(out))
+        b = len(maxima) * SKIP
+        vb_encode(docs[b:], out, docs[b - 1] if b else 0)
+        self.docs = bytes(out)
+        self.skips = skip_table(maxima, ends)
+        self._cache = None
+        if positions is None:
+            self.pos = None
+            self.offsets = None
+        else:
+            pos = bytearray()
+            offsets = array('I', [0])
+            for p in positions:
+                vb_encode(p, pos)
+                offsets.append(len(pos))
+            self.pos = bytes(pos)
+            self.offsets = offsets
+
+    @classmethod
+    def from_posting(cls, posting):
+        """
+        Crea la posting comprimida a partir de una lista de artIds o de un diccionario
+        artId -> lista de posiciones (índice posicional).
+
+        """
+        if isinstance(posting, dict):
+            docs = sorted(posting)
+            return cls(docs, [posting[d] for d in docs])
+        return cls(posting)
+
+    @classmethod
+    def from_buffers(cls, n:int, last:int, docs, pos=None, offsets=None, skips=None):
+        """
+        Crea la posting sobre datos ya codificados, p.ej. memoryviews de un índice abierto
+        con mmap (ver diskindex.PostingTable), sin copiarlos. Si no se da la tabla de
+        saltos se calcula recorriendo self.docs.
+
+        """
+        posting = cls.__new__(cls)
+        posting.n = n
+        posting.last = last
+        posting.docs = docs
+        posting.pos = pos
+        posting.offsets = offsets
+        posting._cache = None
+        posting.skips = skips if skips is not None else posting.build_skips()
+        return posting
+
+    def build_skips(self, skips:array=NO_SKIPS) -> array:
+        """
+        Calcula la tabla de saltos recorriendo los artIds codificados. Si se da "skips", la
+        tabla de saltos de un prefijo de self.docs, solo se recorre lo que hay después del
+        último bloque de esa tabla.
+
+        """
+        nblocks = len(skips) // 2
+        maxima = array('I', skips[:nblocks])
+        ends = array('I', skips[nblocks:])
+        start = ends[-1] if nblocks else 0
+        prev = maxima[-1] if nblocks else 0
+        count = nblocks * SKIP; n = 0; shift = 0
+        for i, b in enumerate(self.docs[start:], start):
+            if b & 128:
+                prev += n | ((b & 127) << shift)
+                n = 0; shift = 0
+                count += 1
+                if count % SKIP == 0:
+                    maxima.append(prev)
+                    ends.append(i + 1)
+            else:
+                n |= b << shift
+                shift += 7
+        return skip_table(maxima, ends)
+
+    def detach(self):
+        """
+        Devuelve una copia de la posting con sus propios bytes y array, que se puede ampliar
+        con self.extend() y serializar aunque los datos originales estén en un mmap.
+
+        """
+        skips = array('I', self.skips) if len(self.skips) else NO_SKIPS
+        cls = type(self)
+        if self.pos is None:
+            return cls.from_buffers(self.n, self.last, bytes(self.docs), skips=skips)
+        return cls.from_buffers(self.n, self.last, bytes(self.docs), bytes(self.pos),
+                                array('I', self.offsets), skips)
+
+    def extend(self, posting):
+        """
+        Añade al final una posting (lista, diccionario posicional o CompressedPosting) cuyos
+        artIds son todos mayores que self.last. Se usa al añadir artículos a un índice existente.
+
+        """
+        docs = doc_ids(posting)
+        if not docs:
+            return
+        self.append_docs(docs)
+        if self.pos is not None:
+            pos = bytearray(self.pos)
+            for doc in docs:
+                vb_encode(posting.get(doc), pos)
+                self.offsets.append(len(pos))
+            self.pos = bytes(pos)
+        self.n += len(docs)
+        self.last = docs[-1]
+        self._cache = None
+        self.skips = self.build_skips(self.skips)
+
+    def append_docs(self, docs:list):
+        """
+        Codifica al final de self.docs los artIds "docs", mayores que self.last.
+
+        """
+        self.docs += vb_encode(docs, prev=self.last)
+
+    def rebase(self, shift:int):
+        """
+        Suma "shift" a todos los artIds de la posting sin decodificarla: solo cambia el
+        primer gap (y la tabla de saltos). Devuelve la propia posting.
+
+        """
+        if shift and self.n:
+            first, size = vb_first(self.docs)
+            head = vb_encode([first + shift])
+            self.docs = b''.join([head, self.docs[size:]])
+            self.last += shift
+            self._cache = None
+            if len(self.skips):
+                nblocks = len(self.skips) // 2
+                delta = len(head) - size
+                self.skips = array('I', [m + shift for m in self.skips[:nblocks]] +
+                                   [e + delta for e in self.skips[nblocks:]])
+        return self
+
+    def concat(self, posting, shift:int=0):
+        """
+        Añade al final una CompressedPosting cuyos artIds, sumándoles "shift", son todos
+        mayores que self.last, sin decodificarla: solo se recodifica su primer artId, que
+        pasa a ser el gap respecto a self.last, y sus posiciones se copian tal cual. Se usa
+        al juntar los índices parciales comprimidos de SAR_Indexer.index_parallel().
+
+        """
+        if not posting.n:
+            return
+        first, size = vb_first(posting.docs)
+        self.docs = b''.join([self.docs, vb_encode([first + shift], prev=self.last), posting.docs[size:]])
+        if self.pos is not None:
+            self.offsets.extend(map(len(self.pos).__add__, posting.offsets[1:]))
+            self.pos = b''.join([self.pos, posting.pos])
+        n = self.n
+        self.n += posting.n
+        self.last = posting.last + shift
+        self._cache = None
+        # la tabla de saltos solo cambia si se completa algún bloque
+        if self.n // SKIP > n // SKIP:
+            self.skips = self.build_skips(self.skips)
+
+    def __getstate__(self):
+        # los arrays se serializan como bytes, pickle los guardaría como listas de enteros
+        offsets = None if self.offsets is None else self.offsets.tobytes()
+        return (self.n, self.last, self.docs, self.pos, offsets, self.skips.tobytes())
+
+    def __setstate__(self, state):
+        self.n, self.last, self.docs, self.pos, offsets, skips = state
+        if offsets is not None:
+            self.offsets = array('I')
+            self.offsets.frombytes(offsets)
+        else:
+            self.offsets = None
+        self._cache = None
+        self.skips = NO_SKIPS
+        if skips:
+            self.skips = array('I')
+            self.skips.frombytes(skips)
+
+    def __len__(self):
+        return self.n
+
+    def __iter__(self):
+        return iter(self.doc_ids())
+
+    def __contains__(self, doc):
+        return self.index_of(doc) is not None
+
+    def doc_ids(self) -> list:
+        """
+        Devuelve la lista ordenada de artIds. No se debe modificar.
+
+        """
+        if self._cache is None:
+            self._cache = vb_decode(self.docs)
+        return self._cache
+
+    def iter_docs(self):
+        """
+        Generador de los artIds en orden que decodifica un bloque (ver self.skips) cada vez.
+
+        """
+        if self._cache is not None:
+            yield from self._cache
+            return
+        for b in range(len(self.skips) // 2 + 1):
+            yield from self.block(b)
+
+    def block(self, b:int) -> list:
+        """
+        Decodifica los artIds del bloque b-ésimo, ver self.skips.
+
+        """
+        nblocks = len(self.skips) // 2
+        start = self.skips[nblocks + b - 1] if b else 0
+        end = self.skips[nblocks + b] if b < nblocks else len(self.docs)
+        return vb_decode(self.docs, start, end, self.skips[b - 1] if b else 0)
+
+    def index_of(self, doc):
+        """
+        Devuelve la posición del artId "doc" dentro de la posting, o None si no está.
+        Si los artIds no están decodificados solo se decodifica su bloque.
+
+        """
+        if self._cache is not None:
+            docs = self._cache
+            i = bisect_left(docs, doc)
+            if i < len(docs) and docs[i] == doc:
+                return i
+            return None
+        if doc > self.last:
+            return None
+        b = bisect_left(self.skips, doc, 0, len(self.skips) // 2)
+        block = self.block(b)
+        i = bisect_left(block, doc)
+        if i < len(block) and block[i] == doc:
+            return b * SKIP + i
+        return None
+
+    def intersect(self, docs:list) -> list:
+        """
+        Devuelve los artIds de la lista ordenada "docs" que están en la posting. Solo se
+        decodifican los bloques en los que puede estar algún artId de "docs", el coste es
+        proporcional a len(docs) si la lista es corta.
+
+        """
+        if self._cache is not None:
+            return gallop_intersect(docs, self._cache)
+        res = []
+        nblocks = len(self.skips) // 2
+        b = -1
+        for doc in docs:
+            if doc > self.last:
+                break
+            nb = bisect_left(self.skips, doc, max(b, 0), nblocks)
+            if nb != b:
+                b = nb
+                block = self.block(b)
+                lo = 0
+            lo = bisect_left(block, doc, lo)
+            if lo < len(block) and block[lo] == doc:
+                res.append(doc)
+        return res
+
+    def difference(self, docs:list) -> list:
+        """
+        Devuelve los artIds de la lista ordenada "docs" que NO están en la posting,
+        decodificando solo los bloques necesarios como self.intersect().
+
+        """
+        if self._cache is not None:
+            return gallop_difference(docs, self._cache)
+        found = set(self.intersect(docs))
+        return [doc for doc in docs if doc not in found]
+
+    def positions_at(self, i:int) -> list:
+        """
+        Devuelve las posiciones del artículo i-ésimo de la posting.
+
+        """
+        return vb_decode(self.pos, self.offsets[i], self.offsets[i + 1])
+
+    def get(self, doc, default=None):
+        """
+        Devuelve la lista de posiciones del artId "doc", o default si no aparece.
+
+        """
+        i = self.index_of(doc)
+        if i is None or self.pos is None:
+            return default
+        return self.positions_at(i)
+
+    def items(self):
+        """
+        Generador de pares (artId, posiciones), las posiciones se decodifican bajo demanda.
+
+        """
+        for i, doc in enumerate(self.doc_ids()):
+            yield doc, self.positions_at(i)
+
+    def nbytes(self) -> int:
+        """
+        Tamaño en bytes de los datos de la posting.
+
+        """
+        size = sys.getsizeof(self.docs)
+        if self.skips is not NO_SKIPS:
+            size += sys.getsizeof(self.skips)
+        if self.pos is not None:
+            size += sys.getsizeof(self.pos) + sys.getsizeof(self.offsets)
+        return size
+
+
+def bitmap_of(docs:list, size:int=0) -> bytearray:
+    """
+    Bitmap de una lista de artIds: el bit d (little-endian dentro de cada byte) está a 1 si
+    el artId d está en la lista. Ocupa un múltiplo de 8 bytes, como mínimo "size".
+
+    """
+    bits = bytearray(max(size, ((docs[-1] >> 6) + 1) * 8 if docs else 0))
+    for doc in docs:
+        bits[doc >> 3] |= 1 << (doc & 7)
+    return bits
+
+
+class BitmapPosting(CompressedPosting):
+    """
+    Posting list comprimida de un término muy frecuente, con los artIds en un bitmap (ver
+    bitmap_of()) en vez de codificados con vb_encode(): ocupa menos si el término aparece
+    en al menos 1 de cada 8 artículos, y los AND, OR y NOT con otras postings se hacen con
+    numpy sobre palabras de 64 bits. La elige SAR_Indexer.compress_posting() según el
+    número de artículos en los que aparece el término.
+
+    Las posiciones se guardan como en CompressedPosting, en el orden de los artIds. No
+    tiene tabla de saltos: para saber si un artId está basta con mirar su bit.
+    """
+
+    __slots__ = ()
+
+    def __init__(self, docs:list, positions:list=None):
+        CompressedPosting.__init__(self, [], positions)
+        self.n = len(docs)
+        self.last = docs[-1] if docs else 0
+        self.docs = bytes(bitmap_of(docs))
+
+    @classmethod
+    def from_compressed(cls, posting:CompressedPosting):
+        """
+        La CompressedPosting "posting" guardada como bitmap, con las mismas posiciones.
+
+        """
+        return cls.from_buffers(posting.n, posting.last, bytes(bitmap_of(posting.doc_ids())),
+                                posting.pos, posting.offsets, NO_SKIPS)
+
+    def build_skips(self, skips:array=NO_SKIPS) -> array:
+        return NO_SKIPS
+
+    def append_docs(self, docs:list):
+        bits = bitmap_of(docs, len(self.docs))
+        for i, byte in enumerate(self.docs):
+            bits[i] |= byte
+        self.docs = bytes(bits)
+
+    def words(self):
+        """
+        El bitmap como array de numpy de palabras de 64 bits, sin copiarlo.
+
+        """
+        import numpy as np
+        return np.frombuffer(self.docs, dtype='<u8')
+
+    def test(self, ids):
+        """
+        Devuelve un array de booleanos: si cada artId del array de numpy "ids" está en la posting.
+
+        """
+        import numpy as np
+        bits = np.frombuffer(self.docs, dtype=np.uint8)
+        idx = ids >> 3
+        inside = idx < len(bits)
+        res = np.zeros(len(ids), dtype=bool)
+        res[inside] = (bits[idx[inside]] >> (ids[inside] & 7)) & 1
+        return res
+
+    def __contains__(self, doc):
+        return 0 <= doc >> 3 < len(self.docs) and bool(self.docs[doc >> 3] >> (doc & 7) & 1)
+
+    def doc_ids(self) -> list:
+        """
+        Devuelve la lista ordenada de artIds. No se debe modificar.
+
+        """
+        if self._cache is None:
+            self._cache = bitmap_ids(self.words())
+        return self._cache
+
+    def iter_docs(self):
+        """
+        Generador de los artIds en orden que recorre el bitmap byte a byte, sin numpy.
+
+        """
+        if self._cache is not None:
+            yield from self._cache
+            return
+        for i, byte in enumerate(self.docs):
+            if byte:
+                for bit in range(8):
+                    if byte >> bit & 1:
+                        yield (i << 3) | bit
+
+    def index_of(self, doc):
+        if doc not in self:
+            return None
+        return bisect_left(self.doc_ids(), doc)
+
+    def intersect(self, docs:list) -> list:
+        return bitmap_and(self, docs)
+
+    def difference(self, docs:list) -> list:
+        return bitmap_minus(docs, self)
+
+
+def bitmap_ids(words) -> list:
+    """
+    Devuelve la lista ordenada de los artIds de un bitmap (array de numpy de palabras de 64 bits).
+
+    """
+    import numpy as np
+    return np.flatnonzero(np.unpackbits(words.view(np.uint8), bitorder='little')).tolist()
+
+
+def id_array(posting):
+    """
+    Los artIds de una posting que no es un bitmap como array de numpy.
+
+    """
+    import numpy as np
+    return np.array(doc_ids(posting), dtype=np.int64)
+
+
+def bitmap_and(p1, p2) -> list:
+    """
+    AND de dos postings si al menos una es un BitmapPosting: AND palabra a palabra de los
+    dos bitmaps, o los artIds de la otra posting cuyo bit está en el bitmap.
+
+    """
+    if not isinstance(p1, BitmapPosting):
+        p1, p2 = p2, p1
+    if isinstance(p2, BitmapPosting):
+        w1, w2 = p1.words(), p2.words()
+        n = min(len(w1), len(w2))
+        return bitmap_ids(w1[:n] & w2[:n])
+    ids = id_array(p2)
+    return ids[p1.test(ids)].tolist()
+
+
+def popcount(words) -> int:
+    """
+    Número de bits a 1 de un bitmap (array de numpy de palabras de 64 bits).
+
+    """
+    import numpy as np
+    if hasattr(np, 'bitwise_count'): # numpy >= 2.0
+        return int(np.bitwise_count(words).sum(dtype=np.int64))
+    return int.from_bytes(words.tobytes(), 'little').bit_count()
+
+
+def bitmap_count_and(p1, p2) -> int:
+    """
+    Número de artículos del AND de dos postings si al menos una es un BitmapPosting, sin
+    construir el resultado: popcount del AND de los dos bitmaps, o número de artIds de la
+    otra posting cuyo bit está en el bitmap.
+
+    """
+    if not isinstance(p1, BitmapPosting):
+        p1, p2 = p2, p1
+    if isinstance(p2, BitmapPosting):
+        w1, w2 = p1.words(), p2.words()
+        n = min(len(w1), len(w2))
+        return popcount(w1[:n] & w2[:n])
+    return int(p1.test(id_array(p2)).sum())
+
+
+def bitmap_minus(p1, p2) -> list:
+    """
+    Artículos de p1 que no están en p2, si al menos una es un BitmapPosting.
+
+    """
+    import numpy as np
+    if not isinstance(p1, BitmapPosting):
+        ids = id_array(p1)
+        return ids[~p2.test(ids)].tolist()
+    words = p1.words().copy()
+    if isinstance(p2, BitmapPosting):
+        w2 = p2.words()[:len(words)]
+        words[:len(w2)] &= ~w2
+        return bitmap_ids(words)
+    bits = np.unpackbits(words.view(np.uint8), bitorder='little')
+    ids = id_array(p2)
+    bits[ids[ids < len(bits)]] = 0
+    return np.flatnonzero(bits).tolist()
+
+
+def bitmap_union(postings:list) -> list:
+    """
+    OR de varias postings si al menos una es un BitmapPosting: OR palabra a palabra de los
+    bitmaps y después se marcan los artIds de las demás.
+
+    """
+    import numpy as np
+    bitmaps = [p for p in postings if isinstance(p, BitmapPosting)]
+    others = [id_array(p) for p in postings if not isinstance(p, BitmapPosting)]
+    nwords = max([len(p.docs) // 8 for p in bitmaps] + [(int(ids[-1]) >> 6) + 1 for ids in others if len(ids)])
+    words = np.zeros(nwords, dtype='<u8')
+    for p in bitmaps:
+        w = p.words()
+        words[:len(w)] |= w
+    if not others:
+        return bitmap_ids(words)
+    bits = np.unpackbits(words.view(np.uint8), bitorder='little')
+    for ids in others:
+        bits[ids] = 1
+    return np.flatnonzero(bits).tolist()
+
+
+def bitmap_count_union(postings:list) -> int:
+    """
+    Número de artículos del OR de varias postings si al menos una es un BitmapPosting, sin
+    construir el resultado: popcount del OR de los bitmaps y de los artIds de las demás.
+
+    """
+    import numpy as np
+    bitmaps = [p for p in postings if isinstance(p, BitmapPosting)]
+    others = [id_array(p) for p in postings if not isinstance(p, BitmapPosting)]
+    nwords = max([len(p.docs) // 8 for p in bitmaps] + [(int(ids[-1]) >> 6) + 1 for ids in others if len(ids)])
+    words = np.zeros(nwords, dtype='<u8')
+    for p in bitmaps:
+        w = p.words()
+        words[:len(w)] |= w
+    if others:
+        bits = np.unpackbits(words.view(np.uint8), bitorder='little')
+        for ids in others:
+            bits[ids] = 1
+        return int(np.count_nonzero(bits))
+    return popcount(words)
+
+
+class Complement:
+    """
+    Complemento de una posting list sin materializar: los artIds de 1 a n (los artIds son
+    consecutivos) que NO están en "posting". Es el resultado de un NOT, ver
+    SAR_Indexer.reverse_posting().
+
+    Su longitud se conoce sin recorrerla y al iterar se generan los artIds uno a uno, sin
+    construir la lista. Las operaciones con complementos se reescriben con la posting
+    original (p.ej. a AND NOT b = a - b), ver SAR_Indexer.and_posting().
+    """
+
+    __slots__ = ('posting', 'n')
+
+    def __init__(self, posting, n:int):
+        """
+        param:  "posting": posting list excluida (lista o CompressedPosting)
+                "n": número de artículos del índice
+        """
+        self.posting = posting
+        self.n = n
+
+    def __len__(self):
+        return self.n - len(self.posting)
+
+    def __iter__(self):
+        return iter_complement(iter_docs(self.posting), self.n)
+
+
+def doc_ids(posting) -> list:
+    """
+    Devuelve la lista ordenada de artIds de una posting, sea una lista, un diccionario
+    del índice posicional, una CompressedPosting o un Complement (que así se materializa).
+
+    """
+    if isinstance(posting, CompressedPosting):
+        return posting.doc_ids()
+    if isinstance(posting, Complement):
+        return list(posting)
+    if isinstance(posting, dict):
+        return [*posting]
+    return posting
+
+
+def iter_docs(posting):
+    """
+    Iterador de los artIds de una posting en orden. Las CompressedPosting se decodifican
+    a medida que se recorren, ver CompressedPosting.iter_docs().
+
+    """
+    if isinstance(posting, CompressedPosting):
+        return posting.iter_docs()
+    return iter(posting)
+
+
+def iter_and(iterators:list):
+    """
+    Intersección en streaming de iteradores ordenados de artIds. El primero debe ser el más
+    corto: se recorre entero y los demás solo se avanzan hasta su artId actual.
+
+    """
+    if not iterators:
+        return
+    first, rest = iterators[0], iterators[1:]
+    try:
+        heads = [next(it) for it in rest]
+        for doc in first:
+            for k, it in enumerate(rest):
+                while heads[k] < doc:
+                    heads[k] = next(it)
+                if heads[k] != doc:
+                    break
+            else:
+                yield doc
+    except StopIteration:
+        # se ha terminado alguno de los iteradores
+        return
+
+
+def iter_or(iterators:list):
+    """
+    Unión en streaming de iteradores ordenados de artIds, con una mezcla de k vías (heapq.merge).
+
+    """
+    last = 0 # los artIds empiezan en 1
+    for doc in heapq.merge(*iterators):
+        if doc != last:
+            yield doc
+            last = doc
+
+
+def iter_minus(docs, excluded):
+    """
+    Artículos del iterador ordenado "docs" que no están en el iterador ordenado "excluded".
+
+    """
+    excluded = iter(excluded)
+    skip = next(excluded, None)
+    for doc in docs:
+        while skip is not None and skip < doc:
+            skip = next(excluded, None)
+        if skip != doc:
+            yield doc
+
+
+def iter_complement(excluded, n:int):
+    """
+    Artículos de 1 a n que no están en el iterador ordenado "excluded".
+
+    """
+    prev = 0
+    for doc in excluded:
+        yield from range(prev + 1, doc)
+        prev = doc
+    yield from range(prev + 1, n + 1)
+
+
+def union_postings(postings) -> list:
+    """
+    Unión (OR) de varias posting lists de una sola vez, en tiempo O(N + U log U) siendo N
+    la suma de sus longitudes y U el tamaño del resultado, en vez de copiar el resultado
+    acumulado con cada posting como los OR de dos en dos (O(N k) con k postings).
+
+    Los artIds se juntan en un set y se ordenan, todo en C: es más rápido que una mezcla
+    de k vías con heapq.merge, que recorre en Python cada artId de cada posting.
+
+    """
+    postings = [p for p in postings if len(p)]
+    if any(isinstance(p, BitmapPosting) for p in postings):
+        return bitmap_union(postings)
+    lists = [doc_ids(p) for p in postings]
+    if len(lists) <= 1:
+        return lists[0] if lists else []
+    return sorted(set().union(*lists))
+
+
+def raw_size(posting) -> int:
+    """
+    Tamaño aproximado en bytes de una posting sin comprimir (lista o diccionario de listas
+    de enteros de Python), contando los contenedores y los enteros.
+
+    """
+    if isinstance(posting, dict):
+        size = sys.getsizeof(posting)
+        for doc, positions in posting.items():
+            size += sys.getsizeof(doc) + raw_size(positions)
+        return size
+    return sys.getsizeof(posting) + sum(sys.getsizeof(n) for n in posting)
+
+
+def int_sizes(numbers) -> int:
+    """
+    Suma de sys.getsizeof() de los enteros de Python con los valores del array de numpy de
+    enteros no negativos "numbers", según el número de dígitos de cada uno.
+
+    """
+    getsizeof = sys.getsizeof
+    bits = sys.int_info.bits_per_digit
+    size = len(numbers) * getsizeof(1) + int((numbers == 0).sum()) * (getsizeof(0) - getsizeof(1))
+    k = 1
+    while True:
+        big = int(((numbers >> (bits * k)) != 0).sum())
+        if not big:
+            return size
+        size += big * (getsizeof(1 << (bits * k)) - getsizeof(1 << (bits * (k - 1))))
+        k += 1
+
+
+def gaps_of(lists:list, lens):
+    """
+    Junta las listas ordenadas de enteros "lists" (de longitudes "lens") en un array de
+    numpy con el gap de cada número respecto al anterior de su lista (el primero de cada
+    lista respecto a 0), y devuelve (números, gaps, posición en la que empieza cada lista
+    y al final el total).
+
+    """
+    import numpy as np
+    bounds = np.zeros(len(lens) + 1, dtype=np.int64)
+    np.cumsum(lens, out=bounds[1:])
+    numbers = np.fromiter(chain.from_iterable(lists), dtype=np.int64, count=int(bounds[-1]))
+    gaps = np.diff(numbers, prepend=0)
+    firsts = bounds[:-1][lens > 0]
+    gaps[firsts] = numbers[firsts]
+    return numbers, gaps, bounds
+
+
+def compress_postings(postings:list) -> tuple:
+    """
+    Comprime una lista de postings sin comprimir (listas ordenadas de artIds o, todas,
+    diccionarios artId -> posiciones con los artIds en orden) con el mismo resultado que
+    CompressedPosting.from_posting() con cada una, pero codificando todos los gaps a la vez
+    con vb_encode_array(): para cada posting solo se cortan sus trozos de los bytes, de los
+    offsets y de la tabla de saltos.
+
+    return: par (lista con las CompressedPosting, suma de raw_size() de las postings)
+    """
+    import numpy as np
+    if not postings:
+        return [], 0
+    lens = np.fromiter(map(len, postings), dtype=np.int64, count=len(postings))
+    docs, gaps, bounds = gaps_of(postings, lens)
+    if (gaps < 0).any():
+        # algún diccionario no tiene los artIds en orden
+        return ([CompressedPosting.from_posting(posting) for posting in postings],
+                sum(map(raw_size, postings)))
+    raw = sum(map(sys.getsizeof, postings)) + int_sizes(docs)
+    docs_data, docs_ends = vb_encode_array(gaps)
+    lasts = np.where(lens > 0, docs[np.maximum(bounds[1:] - 1, 0)], 0).tolist()
+    positional = isinstance(postings[0], dict)
+    if positional:
+        positions = list(chain.from_iterable(map(dict.values, postings)))
+        numbers, pos_gaps, pos_bounds = gaps_of(positions, np.fromiter(map(len, positions), dtype=np.int64,
+                                                                        count=len(positions)))
+        raw += sum(map(sys.getsizeof, positions)) + int_sizes(numbers)
+        pos_data, pos_ends = vb_encode_array(pos_gaps)
+        # byte de pos_data en el que empiezan las posiciones de cada artId
+        doc_pos = pos_ends[pos_bounds]
+        # offsets de cada artId respecto al principio de las posiciones de su posting
+        owner = np.repeat(bounds[:-1], lens)
+        offsets = (doc_pos[1:] - doc_pos[owner]).astype(np.uint32).tobytes()
+        doc_pos = doc_pos.tolist()
+    docs_ends_list = docs_ends.tolist()
+    res = []
+    for i, (a, b) in enumerate(zip(bounds[:-1].tolist(), bounds[1:].tolist())):
+        skips = NO_SKIPS
+        if b - a >= SKIP:
+            blocks = np.arange(a + SKIP, b + 1, SKIP)
+            skips = array('I', docs[blocks - 1].astype(np.uint32).tobytes())
+            skips.frombytes((docs_ends[blocks] - docs_ends[a]).astype(np.uint32).tobytes())
+        data = docs_data[docs_ends_list[a]:docs_ends_list[b]]
+        if positional:
+            posting_offsets = array('I', [0])
+            posting_offsets.frombytes(offsets[4 * a:4 * b])
+            res.append(CompressedPosting.from_buffers(b - a, lasts[i], data, pos_data[doc_pos[a]:doc_pos[b]],
+                                                      posting_offsets, skips))
+        else:
+            res.append(CompressedPosting.from_buffers(b - a, lasts[i], data, skips=skips))
+    return res, raw
+
+
+class FieldIndex:
+    """
+    Índice invertido de un campo: la posting list de cada término se guarda en la posición
+    de su id (ver SAR_Indexer.term_id()) de una lista, None si el término no aparece en el campo.
+
+    Se comporta como un diccionario id -> posting list.
+    """
+
+    __slots__ = ('postings', 'n')
+
+    def __init__(self, items=()):
+        """
+        param:  "items": pares (id, posting) iniciales
+        """
+        self.postings = []
+        self.n = 0
+        for tid, posting in items:
+            self[tid] = posting
+
+    def __getstate__(self):
+        return self.postings
+
+    def __setstate__(self, postings):
+        self.postings = postings
+        self.n = len(postings) - postings.count(None)
+
+    def get(self, tid:int, default=None):
+        if 0 <= tid < len(self.postings):
+            posting = self.postings[tid]
+            if posting is not None:
+                return posting
+        return default
+
+    def __getitem__(self, tid:int):
+        posting = self.get(tid)
+        if posting is None:
+            raise KeyError(tid)
+        return posting
+
+    def __setitem__(self, tid:int, posting):
+        if tid >= len(self.postings):
+            self.postings.extend([None] * (tid + 1 - len(self.postings)))
+        if self.postings[tid] is None:
+            self.n += 1
+        self.postings[tid] = posting
+
+    def setdefault(self, tid:int, default):
+        posting = self.get(tid)
+        if posting is None:
+            self[tid] = posting = default
+        return posting
+
+    def __contains__(self, tid:int):
+        return self.get(tid) is not None
+
+    def __len__(self):
+        return self.n
+
+    def __iter__(self):
+        return (tid for tid, posting in enumerate(self.postings) if posting is not None)
+
+    def keys(self):
+        return iter(self)
+
+    def items(self):
+        return ((tid, posting) for tid, posting in enumerate(self.postings) if posting is not None)
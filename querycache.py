@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Cache LRU de los resultados de las consultas (SAR_Indexer).
+
+Guarda como mucho "size" entradas; al llenarse se descarta la que lleva más tiempo sin
+usarse. Las claves son los nodos del árbol de la query (ver queryparser), así la cache
+sirve tanto para consultas enteras como para sus subexpresiones, los términos, los
+comodines, los stems y las correcciones ortográficas. Los valores no se copian: las posting
+lists que devuelve la cache no se deben modificar.
+"""
+from collections import OrderedDict
+
+
+class QueryCache:
+    """
+    Cache LRU con contadores de aciertos y fallos.
+    """
+
+    def __init__(self, size:int):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """
+        Devuelve el valor de "key" (y lo marca como el último usado) o None si no está.
+
+        """
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return value
+
+    def peek(self, key):
+        """
+        Devuelve el valor de "key" o None, sin contarlo como acierto o fallo ni marcarlo como usado.
+
+        """
+        return self.entries.get(key)
+
+    def put(self, key, value):
+        """
+        Guarda el valor de "key", descartando las entradas más antiguas si no cabe.
+
+        """
+        if self.size <= 0:
+            return
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def resize(self, size:int):
+        """
+        Cambia el número máximo de entradas.
+
+        """
+        self.size = size
+        while len(self.entries) > max(size, 0):
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        """
+        Vacía la cache, p.ej. cuando cambia el índice. Los contadores no se reinician.
+
+        """
+        self.entries.clear()
+
+    def counters(self) -> tuple:
+        """
+        Aciertos, fallos y entradas descartadas hasta ahora.
+
+        """
+        return self.hits, self.misses, self.evictions
+
+    def add_counters(self, hits:int, misses:int, evictions:int):
+        """
+        Suma a los contadores los de otra cache, p.ej. los de las caches de los procesos que
+        resuelven una lista de queries (ver SAR_Indexer.count_queries()).
+
+        """
+        self.hits += hits
+        self.misses += misses
+        self.evictions += evictions
+
+    def stats(self) -> dict:
+        """
+        Tamaño, aciertos, fallos, entradas descartadas y tasa de aciertos.
+
+        """
+        lookups = self.hits + self.misses
+        return {'size': self.size, 'entries': len(self.entries), 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0}
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+Análisis de las consultas de SAR_Indexer.
+
+La consulta se divide en tokens y se construye su árbol (AST). Los nodos son tuplas:
+
+    ('term', campo, término)        término (en minúsculas), puede tener comodines * y ?
+    ('phrase', campo, '"a b c"')    términos consecutivos, con las comillas
+    ('not', nodo)
+    ('and', (nodo, nodo, ...))
+    ('or', (nodo, nodo, ...))
+
+campo es None si no se indica. Los operadores AND y OR tienen la misma precedencia y se
+aplican de izquierda a derecha, dos operandos seguidos sin operador son un AND y NOT se
+aplica al operando que le sigue:
+
+    a AND b OR c   ->  (a AND b) OR c
+    a OR b c       ->  (a OR b) AND c
+
+Los AND (y los OR) encadenados se juntan en un solo nodo, el orden en el que se resuelven
+sus hijos lo decide SAR_Indexer.solve_node(). Como son conmutativos, parse_query() ordena
+sus hijos (ver normalize()) y dos consultas equivalentes como "a AND b" y "b AND a" tienen
+el mismo árbol, que es la clave de la cache de resultados (ver querycache).
+"""
+from collections import Counter
+from typing import List
+
+OPERATORS = ('AND', 'OR', 'NOT')
+
+
+class QuerySyntaxError(ValueError):
+    """
+    Error de sintaxis de una consulta: paréntesis sin cerrar, un operador sin operando,
+    un campo sin término...
+    """
+
+
+def tokenize_query(query:str) -> List[str]:
+    """
+    Divide la consulta en paréntesis, operadores y términos. Lo que hay entre comillas
+    (p.ej. 'title:"a b"') forma parte de un solo término aunque tenga espacios o paréntesis.
+
+    """
+    tokens = []
+    i = 0
+    n = len(query)
+    while i < n:
+        c = query[i]
+        if c.isspace():
+            i += 1
+        elif c in '()':
+            tokens.append(c)
+            i += 1
+        else:
+            start = i
+            while i < n and not query[i].isspace() and query[i] not in '()':
+                if query[i] == '"':
+                    end = query.find('"', i + 1)
+                    i = n if end < 0 else end + 1
+                else:
+                    i += 1
+            tokens.append(query[start:i])
+    return tokens
+
+
+def make_leaf(token:str) -> tuple:
+    """
+    Construye el nodo de un término, con su campo si lo tiene ('title:python').
+
+    """
+    field = None
+    if ':' in token and token[0] != '"':
+        field, token = token.split(':', 1)
+        field = field.lower()
+    if not token:
+        raise QuerySyntaxError(f'empty term in field {field!r}')
+    if token[0] == '"':
+        return ('phrase', field, token)
+    return ('term', field, token.lower())
+
+
+def combine(op:str, left:tuple, right:tuple) -> tuple:
+    """
+    Une dos nodos con el operador "op" ('and' u 'or'), juntando las cadenas del mismo operador.
+
+    """
+    children = left[1] if left[0] == op else (left,)
+    children += right[1] if right[0] == op else (right,)
+    return (op, children)
+
+
+class Parser:
+    """
+    Parser descendente de la gramática:
+
+        expr  := unary ( [AND | OR] unary )*
+        unary := NOT unary | '(' expr ')' | término
+    """
+
+    def __init__(self, tokens:List[str]):
+        self.tokens = tokens
+        self.i = 0
+
+    def peek(self):
+        return self.tokens[self.i] if self.i < len(self.tokens) else None
+
+    def next(self):
+        token = self.peek()
+        if token is None:
+            raise QuerySyntaxError('unexpected end of query')
+        self.i += 1
+        return token
+
+    def parse(self) -> tuple:
+        node = self.expr()
+        if self.peek() is not None:
+            raise QuerySyntaxError(f'unexpected {self.peek()!r} in query')
+        return node
+
+    def expr(self) -> tuple:
+        node = self.unary()
+        while self.peek() not in (None, ')'):
+            op = 'and'
+            if self.peek() in ('AND', 'OR'):
+                op = self.next().lower()
+            node = combine(op, node, self.unary())
+        return node
+
+    def unary(self) -> tuple:
+        token = self.next()
+        if token == 'NOT':
+            return ('not', self.unary())
+        if token == '(':
+            node = self.expr()
+            if self.next() != ')':
+                raise QuerySyntaxError('unbalanced parenthesis in query')
+            return node
+        if token in OPERATORS or token == ')':
+            raise QuerySyntaxError(f'unexpected {token!r} in query')
+        return make_leaf(token)
+
+
+def normalize(node:tuple) -> tuple:
+    """
+    Ordena recursivamente los hijos de los nodos AND y OR, y quita los duplicados.
+
+    """
+    if node[0] == 'not':
+        return ('not', normalize(node[1]))
+    if node[0] in ('and', 'or'):
+        children = sorted({normalize(child) for child in node[1]}, key=repr)
+        return children[0] if len(children) == 1 else (node[0], tuple(children))
+    return node
+
+
+def parse_query(query:str) -> tuple:
+    """
+    Devuelve el AST normalizado de la consulta, ver el principio del módulo.
+
+    """
+    return normalize(Parser(tokenize_query(query)).parse())
+
+
+class BatchPlan:
+    """
+    Árboles de una lista de queries (ver SAR_Indexer.solve_and_count()) y las subexpresiones
+    que comparten. Cada nodo que aparece más de una vez en la lista (en la misma query o en
+    varias, términos incluidos) es compartido: se resuelve una vez y su resultado se guarda
+    en self.results mientras dura la lista, ver SAR_Indexer.solve_node().
+    """
+
+    def __init__(self, queries:List[str]):
+        self.trees = {} # query -> árbol, None si tiene un error de sintaxis
+        self.errors = {} # query -> mensaje de su error de sintaxis
+        self.uses = Counter() # nodo -> número de veces que aparece en la lista
+        for query in queries:
+            if query not in self.trees:
+                try:
+                    self.trees[query] = parse_query(query)
+                except QuerySyntaxError as e:
+                    # el error se muestra al llegar a la query, en su orden
+                    self.trees[query] = None
+                    self.errors[query] = str(e)
+            if self.trees[query] is not None:
+                self.count(self.trees[query])
+        self.shared = {node for node, n in self.uses.items() if n > 1}
+        self.results = {} # nodo compartido -> posting list
+        self.queries = len(queries)
+        self.reused = 0 # resultados de self.results usados en vez de resolver el nodo
+
+    def count(self, node:tuple):
+        self.uses[node] += 1
+        if node[0] == 'not':
+            self.count(node[1])
+        elif node[0] in ('and', 'or'):
+            for child in node[1]:
+                self.count(child)
+
+    def stats(self) -> dict:
+        """
+        Queries, nodos de sus árboles (en total y distintos), nodos compartidos y número de
+        veces que se ha usado el resultado de un nodo compartido en vez de resolverlo.
+
+        """
+        return {'queries': self.queries, 'nodes': sum(self.uses.values()), 'distinct': len(self.uses),
+                'shared': len(self.shared), 'reused': self.reused}
@@ -1,7 +1,28 @@
 # -*- coding: utf-8 -*-
 import re
+import heapq
+from array import array
 from distancias import *
 
+
+def length_buckets(vocabulary, ids=None) -> dict:
+    """
+    Agrupa las palabras del vocabulario por longitud.
+
+    Args:
+        vocabulary: secuencia de palabras
+        ids: posiciones del vocabulario que se agrupan, todas si es None
+
+    Returns:
+        dict: longitud -> array ordenado con las posiciones de las palabras de esa longitud
+    """
+    buckets = {}
+    for i in (range(len(vocabulary)) if ids is None else ids):
+        buckets.setdefault(len(vocabulary[i]), array('I')).append(i)
+    if ids is not None:
+        buckets = {n: array('I', sorted(bucket)) for n, bucket in buckets.items()}
+    return buckets
+
 class SpellSuggester:
 
     """
@@ -12,7 +33,8 @@ class SpellSuggester:
                  dist_functions,
                  vocab = [],
                  default_distance = None,
-                 default_threshold = None):
+                 default_threshold = None,
+                 buckets = None):
         
         """Método constructor de la clase SpellSuggester
 
@@ -20,13 +42,15 @@ class SpellSuggester:
 
         Args:
            dist_functions es un diccionario nombre->funcion_distancia
-           vocab es una lista de palabras o la ruta de un fichero
+           vocab es una lista (o secuencia) de palabras o la ruta de un fichero
            default_distance debe ser una clave de dist_functions
            default_threshold un entero positivo
+           buckets las palabras del vocabulario agrupadas por longitud (ver length_buckets()),
+               si es None se calculan a partir del vocabulario
 
         """
         self.distance_functions = dist_functions
-        self.set_vocabulary(vocab)
+        self.set_vocabulary(vocab, buckets)
         if default_distance is None:
             default_distance = 'levenshtein'
         if default_threshold is None:
@@ -51,13 +75,14 @@ class SpellSuggester:
             vocab.discard("")  # por si acaso
             return sorted(vocab)
 
-    def set_vocabulary(self, vocabulary):
-        if isinstance(vocabulary,list):
-            self.vocabulary = vocabulary # atención! nos quedamos una referencia, a tener en cuenta
-        elif isinstance(vocabulary,str):
+    def set_vocabulary(self, vocabulary, buckets=None):
+        if isinstance(vocabulary,str):
             self.vocabulary = self.build_vocabulary(vocabulary)
+        elif hasattr(vocabulary, '__getitem__') and hasattr(vocabulary, '__len__'):
+            self.vocabulary = vocabulary # atención! nos quedamos una referencia, a tener en cuenta
         else:
             raise Exception("SpellSuggester incorrect vocabulary value")
+        self.buckets = length_buckets(self.vocabulary) if buckets is None else buckets
 
     def suggest(self, term, distance=None, threshold=None, flatten=True):
         """
@@ -78,7 +103,12 @@ class SpellSuggester:
         
         resul = [[] for list in range(threshold+1)]
 
-        for voc in self.vocabulary:
+        # la distancia es al menos la diferencia de longitudes: solo se comparan las palabras
+        # cuya longitud difiere como mucho en threshold, en el orden del vocabulario
+        candidates = [self.buckets[n] for n in range(len(term) - threshold, len(term) + threshold + 1)
+                      if n in self.buckets]
+        for i in heapq.merge(*candidates):
+            voc = self.vocabulary[i]
             distancia = self.distance_functions[distance](term,voc,threshold)
             if(distancia<=threshold):
                     resul[distancia].append(voc)    
@@ -0,0 +1,210 @@
+"""
+Pruebas de SAR_Indexer con índices pequeños construidos en la propia prueba.
+
+    python test_SAR_lib_plantilla.py
+"""
+import contextlib
+import io
+import json
+import os
+import pickle
+import random
+import re
+import tempfile
+
+from SAR_lib_plantilla import SAR_Indexer
+
+# artículos del índice de prueba, 'de' aparece en todos y 'salton' en pocos, así las
+# posting lists tienen longitudes muy distintas (ver SAR_Indexer.GALLOP_RATIO)
+NARTS = 40
+SALTON = [3, 17]
+
+
+def guardar_indice_antiguo(filename:str):
+    """
+    Guarda con pickle un índice posicional con el formato de la versión inicial: los
+    términos son las claves de self.index, las posting lists diccionarios artId -> posiciones
+    y el permuterm una lista ordenada de pares (permuterm, término).
+
+    """
+    index = {'all': {'de': {art: [0, 5] for art in range(1, NARTS + 1)},
+                     'salton': {art: [4] for art in SALTON},
+                     'python': {17: [1]}}}
+    ptindex = {'all': []}
+    for term in index['all']:
+        word = term + '$'
+        ptindex['all'] += [(word[i:] + word[:i], term) for i in range(len(word))]
+    ptindex['all'].sort()
+    articles = {art: [f'https://es.wikipedia.org/wiki/{art}', str(art)] for art in range(1, NARTS + 1)}
+    atribs = {'urls': {url for url, _ in articles.values()}, 'index': index, 'sindex': {'all': {}},
+              'ptindex': ptindex, 'docs': {1: 'corpus.json'}, 'weight': {}, 'articles': articles,
+              'tokenizer': re.compile(r"\W+"), 'stemmer': None, 'show_all': False, 'use_stemming': False}
+    with open(filename, 'wb') as fh:
+        pickle.dump([list(atribs)] + list(atribs.values()), fh)
+
+
+def testear_indice_antiguo():
+    """
+    Un índice posicional guardado con pickle por la versión inicial se carga y se consulta,
+    también con AND y AND NOT entre una posting list corta y otra mucho más larga.
+
+    """
+    todos = list(range(1, NARTS + 1))
+    esperado = {
+        'salton AND de': SALTON,
+        'de AND salton': SALTON,
+        'salton AND NOT de': [],
+        'de AND NOT salton': [art for art in todos if art not in SALTON],
+        'python AND de': [17],
+        'python AND NOT de': [],
+        'NOT salton AND NOT python': [art for art in todos if art not in SALTON],
+        'salt*': SALTON,
+        '"salton de"': SALTON,
+        '"de salton"': [],
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, 'index')
+        guardar_indice_antiguo(filename)
+        searcher = SAR_Indexer()
+        searcher.load_info(filename)
+        for query, arts in esperado.items():
+            assert list(searcher.solve_query(query)) == arts, query
+            assert list(searcher.iter_query(query)) == arts, query
+            assert searcher.count_results(query) == len(arts), query
+
+
+def testear_consultas_mal_escritas():
+    """
+    Las queries con errores de sintaxis en medio de una lista (-L y -T) se muestran como
+    mal escritas y se siguen resolviendo las demás, también con varios procesos.
+
+    """
+    consultas = ['salton', '(salton', 'de)', 'AND de', 'title:', 'python AND de']
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, 'index')
+        guardar_indice_antiguo(filename)
+        searcher = SAR_Indexer()
+        searcher.load_info(filename)
+        for jobs in (1, 2):
+            searcher.set_jobs(jobs)
+            salida = io.StringIO()
+            with contextlib.redirect_stdout(salida):
+                resultados = searcher.solve_and_count(consultas)
+                correcto = searcher.solve_and_test([f'{q}\t{len(SALTON)}' for q in consultas])
+                searcher.solve_and_show('(salton')
+            assert resultados == [len(SALTON), None, None, None, None, 1]
+            assert not correcto
+            lineas = salida.getvalue().splitlines()
+            assert lineas[:6] == ['salton\t2', "(salton\tmalformed query: unexpected end of query",
+                                  "de)\tmalformed query: unexpected ')' in query",
+                                  "AND de\tmalformed query: unexpected 'AND' in query",
+                                  "title:\tmalformed query: empty term in field 'title'",
+                                  'python AND de\t1']
+            # -T marca las queries mal escritas como fallos y sigue con las siguientes
+            assert lineas[6] == 'salton\t2' and lineas[11] == '>>>>python AND de\t2 != 1<<<<'
+            assert lineas[-1] == 'malformed query: unexpected end of query'
+
+
+def escribir_corpus(filename:str, n:int):
+    """
+    Escribe "n" artículos con el formato del crawler con palabras al azar de un vocabulario
+    pequeño, con varias palabras con el mismo stem.
+
+    """
+    rnd = random.Random(n)
+    palabras = ['casa', 'casas', 'casero', 'perro', 'perros', 'python', 'programa', 'programas',
+                'programación', 'índice', 'índices', 'búsqueda', 'búsquedas', 'de', 'la', 'el']
+    texto = lambda k: ' '.join(rnd.choice(palabras) for _ in range(k))
+    with open(filename, 'w') as fh:
+        for art in range(n):
+            sections = [{'name': texto(2), 'text': texto(40),
+                         'subsections': [{'name': texto(2), 'text': texto(30)}]} for _ in range(2)]
+            fh.write(json.dumps({'url': f'https://es.wikipedia.org/wiki/{art}', 'title': texto(3),
+                                 'summary': texto(20), 'sections': sections}) + '\n')
+
+
+def contenido(indexer:SAR_Indexer) -> tuple:
+    """
+    Devuelve los términos, las postings (con posiciones), los stems y el permuterm de un
+    índice para compararlos.
+
+    """
+    return ([*indexer.term_list],
+            {field: [(t, [(doc, list(pos)) for doc, pos in posting.items()]) for t, posting in findex.items()]
+             for field, findex in indexer.index.items()},
+            {field: [(stem, posting.doc_ids()) for stem, posting in sfield.items()]
+             for field, sfield in indexer.sindex.items()},
+            {field: (list(rots), list(ids)) for field, (rots, ids) in indexer.ptindex.items()})
+
+
+def testear_diccionario_de_terminos():
+    """
+    Todos los campos comparten el diccionario global de términos: cada término tiene un
+    único id y las postings y el permuterm de cada campo usan esos ids, también al guardar
+    y cargar el índice.
+
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        corpus = os.path.join(tmp, 'corpus.json')
+        escribir_corpus(corpus, 20)
+        indexer = SAR_Indexer()
+        with contextlib.redirect_stdout(io.StringIO()):
+            indexer.index_dir(corpus, multifield=True, positional=True, stem=False, permuterm=True)
+        filename = os.path.join(tmp, 'index')
+        indexer.save_info(filename)
+        searcher = SAR_Indexer()
+        searcher.load_info(filename)
+        for sar in (indexer, searcher):
+            term_list = list(sar.term_list)
+            assert len(set(term_list)) == len(term_list)
+            assert all(sar.terms[term] == tid for tid, term in enumerate(term_list))
+            # 'python' es el mismo id en todos los campos en los que aparece
+            assert sum(sar.terms['python'] in findex for findex in sar.index.values()) > 1
+            for field, findex in sar.index.items():
+                for tid in findex:
+                    assert sar.term_posting(field, term_list[tid]).doc_ids() == findex[tid].doc_ids()
+                rots, ids = sar.ptindex[field]
+                esperado = sorted(p for tid in findex for p in sar.permuterms(term_list[tid], tid))
+                assert list(zip(rots, ids)) == esperado
+        # al guardar se renumeran los términos en orden, pero cada uno tiene las mismas postings
+        for field, findex in indexer.index.items():
+            assert ({indexer.term_list[tid]: posting.doc_ids() for tid, posting in findex.items()}
+                    == {searcher.term_list[tid]: posting.doc_ids() for tid, posting in searcher.index[field].items()})
+
+
+def testear_presupuesto_memoria():
+    """
+    Con un presupuesto de memoria tan pequeño que el índice se vuelca a disco cada pocos
+    artículos (y los stems al mezclarlo), el índice mezclado directamente en el fichero es
+    igual que el construido en memoria, también con varios procesos.
+
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        corpus = os.path.join(tmp, 'corpus.json')
+        escribir_corpus(corpus, 60)
+        indices = []
+        for memory, workers in ((None, 1), (0.01, 1), (0.01, 2)):
+            indexer = SAR_Indexer()
+            with contextlib.redirect_stdout(io.StringIO()):
+                indexer.index_dir(corpus, multifield=True, positional=True, stem=True, permuterm=True,
+                                  memory=memory, workers=workers)
+            assert (indexer.merged is None) == (memory is None)
+            filename = os.path.join(tmp, f'index_{len(indices)}')
+            indexer.save_info(filename)
+            assert indexer.run_dir is None
+            searcher = SAR_Indexer()
+            searcher.load_info(filename)
+            indices.append(searcher)
+        esperado = contenido(indices[0])
+        for searcher in indices[1:]:
+            assert contenido(searcher) == esperado
+            for query in ['casa AND perros', 'title:python OR NOT de', 'program*', '"la casa"']:
+                assert list(searcher.solve_query(query)) == list(indices[0].solve_query(query)), query
+
+
+if __name__ == "__main__":
+    testear_indice_antiguo()
+    testear_consultas_mal_escritas()
+    testear_diccionario_de_terminos()
+    testear_presupuesto_memoria()
+    print('OK')
@@ -0,0 +1,151 @@
+"""
+Pruebas del formato binario del índice (diskindex.py): lo que se escribe con Writer se lee
+igual con Reader.
+
+    python test_diskindex.py
+"""
+import os
+import random
+import tempfile
+
+import diskindex
+from postings import SKIP, BitmapPosting, CompressedPosting
+
+
+def escribir(filename:str, secciones) -> diskindex.Reader:
+    """
+    Escribe un índice binario cuya cabecera es un diccionario nombre -> descripción de la
+    sección que devuelve secciones(writer), y lo abre con Reader.
+
+    """
+    with open(filename, 'wb') as fh:
+        out = diskindex.Writer(fh)
+        header = secciones(out)
+        out.close(header)
+    return diskindex.Reader(filename)
+
+
+def postings_de_prueba(rnd:random.Random, n:int, positional:bool) -> list:
+    """
+    Devuelve "n" postings para los ids 0..n-1, sin posting (None) en uno de cada tres ids:
+    CompressedPosting de distintas longitudes (con y sin tabla de saltos) y algún
+    BitmapPosting.
+
+    """
+    postings = []
+    for tid in range(n):
+        if tid % 3 == 1:
+            postings.append(None)
+            continue
+        docs = sorted(rnd.sample(range(1, 4000), rnd.choice([1, 7, SKIP, 3 * SKIP + 11])))
+        pos = [sorted(rnd.sample(range(500), rnd.randint(1, 3))) for _ in docs] if positional else None
+        cls = BitmapPosting if tid % 5 == 0 else CompressedPosting
+        postings.append(cls(docs, pos))
+    return postings
+
+
+def iguales(leida, original) -> bool:
+    """
+    True si una posting leída del índice es igual que la que se escribió.
+
+    """
+    return (type(leida) is type(original) and (leida.n, leida.last) == (original.n, original.last)
+            and bytes(leida.docs) == original.docs and list(leida.skips) == list(original.skips)
+            and leida.doc_ids() == original.doc_ids()
+            and (original.pos is None or [p for _, p in leida.items()] == [p for _, p in original.items()]))
+
+
+def testear_postings():
+    """
+    Una tabla de postings con filas dispersas (ids sin posting) y otra densa se leen con
+    las mismas postings, posicionales o no.
+
+    """
+    rnd = random.Random(1)
+    with tempfile.TemporaryDirectory() as tmp:
+        for positional in (False, True):
+            dispersas = postings_de_prueba(rnd, 40, positional)
+            densas = [p for p in dispersas if p is not None]
+            disk = escribir(os.path.join(tmp, f'idx{positional}'),
+                            lambda out: {'dispersas': out.postings(dispersas), 'densas': out.postings(densas)})
+            for name, postings in (('dispersas', dispersas), ('densas', densas)):
+                table = disk.open(disk.header[name])
+                assert table.positional == positional
+                assert len(table) == len(densas)
+                assert list(table) == [tid for tid, p in enumerate(postings) if p is not None]
+                for tid, posting in enumerate(postings):
+                    if posting is None:
+                        assert tid not in table and table.get(tid) is None
+                    else:
+                        assert tid in table and iguales(table[tid], posting)
+                assert all(iguales(p, postings[tid]) for tid, p in table.items())
+                assert table.get(len(postings)) is None
+
+
+def testear_copia_sin_decodificar():
+    """
+    Las filas copiadas tal cual de una tabla abierta (PostingTable.raw_items()), junto con
+    postings nuevas o cambiadas de un Overlay, se leen igual que escribiendo las postings.
+
+    """
+    rnd = random.Random(2)
+    with tempfile.TemporaryDirectory() as tmp:
+        postings = postings_de_prueba(rnd, 60, True)
+        disk = escribir(os.path.join(tmp, 'idx'), lambda out: {'postings': out.postings(postings)})
+        overlay = diskindex.Overlay(disk.open(disk.header['postings']))
+        # una posting cambia, otra es de un id que no tenía y se añade uno nuevo al final
+        overlay[3] = postings[3] = CompressedPosting([1, 5, 9], [[0], [2, 4], [1]])
+        overlay[4] = postings[4] = CompressedPosting([2], [[7]])
+        overlay[60] = CompressedPosting(list(range(1, 2 * SKIP)), [[i] for i in range(1, 2 * SKIP)])
+        postings.append(overlay[60])
+        copia = [None] * len(postings)
+        for tid, posting in overlay.raw_items():
+            copia[tid] = posting
+        assert sum(isinstance(p, diskindex.RawPosting) for p in copia) == len(overlay) - 3
+        disk = escribir(os.path.join(tmp, 'copia'), lambda out: {'postings': out.postings(copia)})
+        table = disk.open(disk.header['postings'])
+        assert len(table) == len(overlay)
+        for tid, posting in enumerate(postings):
+            assert (posting is None and tid not in table) or iguales(table[tid], posting)
+
+
+def testear_cadenas():
+    """
+    Las tablas de cadenas (con caracteres que no son ASCII), los diccionarios ordenados y
+    los artículos se leen igual que se escribieron.
+
+    """
+    palabras = sorted(['árbol', 'casa', 'cosa', 'niño', 'python', 'zeta', 'ñandú'])
+    urls = [f'https://es.wikipedia.org/wiki/{p}' for p in palabras]
+    with tempfile.TemporaryDirectory() as tmp:
+        disk = escribir(os.path.join(tmp, 'idx'), lambda out: {
+            'palabras': out.strings(palabras),
+            'articulos': (out.strings(urls), out.strings(p.upper() for p in palabras))})
+        table = disk.open(disk.header['palabras'])
+        assert list(table) == palabras and table[-1] == palabras[-1]
+        sorted_dict = diskindex.SortedDict(table)
+        assert all(sorted_dict[p] == i for i, p in enumerate(palabras))
+        assert 'perro' not in sorted_dict and sorted_dict.get('a') is None
+        articles = disk.articles(disk.header['articulos'])
+        assert len(articles) == len(palabras)
+        assert articles[1] == [urls[0], palabras[0].upper()] and len(palabras) + 1 not in articles
+
+
+def testear_grupos():
+    """
+    Los grupos de ids (p.ej. los buckets de longitudes del corrector) se leen igual que se
+    escribieron, también un grupo vacío.
+
+    """
+    grupos = {4: [1, 2, 5], 5: [3, 4], 6: [0], 9: []}
+    with tempfile.TemporaryDirectory() as tmp:
+        disk = escribir(os.path.join(tmp, 'idx'), lambda out: {'grupos': out.groups(grupos)})
+        assert {n: list(ids) for n, ids in disk.groups(disk.header['grupos']).items()} == grupos
+
+
+if __name__ == "__main__":
+    testear_postings()
+    testear_copia_sin_decodificar()
+    testear_cadenas()
+    testear_grupos()
+    print('OK')
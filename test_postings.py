@@ -0,0 +1,272 @@
+"""
+Pruebas de las posting lists comprimidas y de las operaciones sobre listas ordenadas de
+postings.py, comparando con las mismas operaciones hechas con listas y sets.
+
+    python test_postings.py
+"""
+import pickle
+import random
+
+from postings import (SKIP, BitmapPosting, CompressedPosting, FieldIndex, compress_postings,
+                      gallop_difference, gallop_intersect, gallop_remove, offset_intersect,
+                      raw_size, union_postings, vb_decode, vb_encode)
+
+# longitudes de las postings de prueba: vacía, un bloque incompleto, bloques completos justos
+# y bloques completos con un resto (ver CompressedPosting.skips)
+LONGITUDES = [0, 1, SKIP - 1, SKIP, 3 * SKIP, 3 * SKIP + 5]
+
+
+def lista_ordenada(rnd:random.Random, n:int, maximo:int) -> list:
+    """
+    Devuelve "n" artIds distintos entre 1 y "maximo" ordenados.
+
+    """
+    return sorted(rnd.sample(range(1, maximo + 1), n))
+
+
+def posiciones(rnd:random.Random, docs:list) -> list:
+    """
+    Devuelve una lista de posiciones ordenadas para cada artId de "docs".
+
+    """
+    return [lista_ordenada(rnd, rnd.randint(1, 4), 1000) for _ in docs]
+
+
+def testear_field_index():
+    """
+    Un FieldIndex se comporta como un diccionario id de término -> posting en el que solo
+    están los ids con posting, también después de serializarlo con pickle.
+
+    """
+    findex = FieldIndex([(3, [1, 2]), (0, [5])])
+    findex[7] = [4]
+    assert len(findex) == 3 and list(findex) == [0, 3, 7]
+    assert findex[3] == [1, 2] and findex.get(5) is None and findex.get(50, []) == []
+    assert 5 not in findex and 7 in findex and 50 not in findex
+    try:
+        findex[5]
+        assert False
+    except KeyError:
+        pass
+    assert findex.setdefault(3, []) == [1, 2] and findex.setdefault(9, [8]) == [8]
+    assert list(findex.items()) == [(0, [5]), (3, [1, 2]), (7, [4]), (9, [8])]
+    copia = pickle.loads(pickle.dumps(findex))
+    assert len(copia) == 4 and list(copia.items()) == list(findex.items())
+
+
+def testear_concat_rebase():
+    """
+    Juntar con concat() y rebase() las postings de trozos consecutivos de una lista de
+    artIds (numerados desde 1 en cada trozo, como los índices parciales de
+    SAR_Indexer.index_parallel()) da los mismos bytes que comprimir la lista entera.
+
+    """
+    rnd = random.Random(4)
+    docs = lista_ordenada(rnd, 5 * SKIP + 17, 4000)
+    pos = posiciones(rnd, docs)
+    entera = CompressedPosting(docs, pos)
+    cortes = [0, 10, SKIP - 3, SKIP + 2, 3 * SKIP, 3 * SKIP + 1, len(docs)]
+    juntas = None
+    for a, b in zip(cortes, cortes[1:]):
+        base = docs[a - 1] if a else 0
+        trozo = CompressedPosting([d - base for d in docs[a:b]], pos[a:b])
+        if juntas is None:
+            juntas = trozo.rebase(base)
+        else:
+            juntas.concat(trozo, base)
+    assert juntas.doc_ids() == docs
+    assert (juntas.n, juntas.last, juntas.docs, juntas.skips) == (entera.n, entera.last, entera.docs, entera.skips)
+    assert (juntas.pos, juntas.offsets) == (entera.pos, entera.offsets)
+
+
+def testear_vb():
+    """
+    vb_encode() y vb_decode() recuperan los números, también a partir de un valor previo.
+
+    """
+    rnd = random.Random(1)
+    numeros = lista_ordenada(rnd, 500, 10**7)
+    assert vb_decode(vb_encode(numeros)) == numeros
+    assert vb_decode(vb_encode(numeros[1:], prev=numeros[0]), prev=numeros[0]) == numeros[1:]
+    assert vb_decode(vb_encode([])) == []
+
+
+def testear_compressed_posting():
+    """
+    Una CompressedPosting devuelve los artIds y posiciones con los que se creó, busca cada
+    artId sin decodificarlos todos y se recupera igual después de serializarla con pickle.
+
+    """
+    rnd = random.Random(2)
+    for n in LONGITUDES:
+        docs = lista_ordenada(rnd, n, 20 * n + 10)
+        pos = posiciones(rnd, docs)
+        posting = CompressedPosting(docs, pos)
+        assert len(posting) == n and posting.doc_ids() == docs
+        assert posting.last == (docs[-1] if docs else 0)
+        assert list(CompressedPosting(docs, pos).iter_docs()) == docs
+        assert [p for _, p in posting.items()] == pos
+        todos = set(docs)
+        for doc in rnd.sample(range(0, 20 * n + 12), 12) + docs[::SKIP // 4] + docs[-1:]:
+            fresca = CompressedPosting(docs, pos)
+            i = fresca.index_of(doc)
+            if doc in todos:
+                assert docs[i] == doc and fresca.get(doc) == pos[i]
+            else:
+                assert i is None and fresca.get(doc) is None
+        copia = pickle.loads(pickle.dumps(posting))
+        assert copia.doc_ids() == docs and copia.skips == posting.skips
+        assert [p for _, p in copia.items()] == pos
+
+
+def testear_compress_postings():
+    """
+    compress_postings() da las mismas postings que CompressedPosting.from_posting() con
+    cada una, con listas de artIds y con diccionarios artId -> posiciones (también si
+    alguno no tiene los artIds en orden), y suma el raw_size() de todas.
+
+    """
+    rnd = random.Random(3)
+    listas = [lista_ordenada(rnd, n, 20 * n + 10) for n in LONGITUDES * 3]
+    rnd.shuffle(listas)
+    dicts = [dict(zip(docs, posiciones(rnd, docs))) for docs in listas]
+    desordenados = dicts + [dict(reversed(max(dicts, key=len).items()))]
+    assert compress_postings([]) == ([], 0)
+    for postings in (listas, dicts, desordenados):
+        comprimidas, raw = compress_postings(postings)
+        assert raw == sum(map(raw_size, postings))
+        for comprimida, posting in zip(comprimidas, postings):
+            esperada = CompressedPosting.from_posting(posting)
+            assert (comprimida.n, comprimida.last, bytes(comprimida.docs), list(comprimida.skips)) == \
+                   (esperada.n, esperada.last, esperada.docs, list(esperada.skips))
+            assert comprimida.doc_ids() == esperada.doc_ids()
+            assert (comprimida.pos is None) == (esperada.pos is None)
+            if esperada.pos is not None:
+                assert (bytes(comprimida.pos), comprimida.offsets) == (esperada.pos, esperada.offsets)
+                assert list(comprimida.items()) == list(esperada.items())
+
+
+def testear_extend():
+    """
+    extend() añade los artIds de otra posting sin comprimir de nuevo los anteriores y da
+    los mismos bytes que comprimir la lista entera.
+
+    """
+    rnd = random.Random(5)
+    docs = lista_ordenada(rnd, 3 * SKIP + 40, 4000)
+    pos = posiciones(rnd, docs)
+    entera = CompressedPosting(docs, pos)
+    for corte in (0, 1, SKIP - 1, SKIP, 2 * SKIP + 7):
+        ampliada = CompressedPosting(docs[:corte], pos[:corte])
+        ampliada.extend(dict(zip(docs[corte:], pos[corte:])))
+        assert (ampliada.n, ampliada.last, ampliada.docs, ampliada.skips) == \
+               (entera.n, entera.last, entera.docs, entera.skips)
+        assert (ampliada.pos, ampliada.offsets) == (entera.pos, entera.offsets)
+
+
+def testear_skips():
+    """
+    La tabla de saltos tiene una entrada por bloque completo y es la misma que la que se
+    calcula recorriendo los bytes, también con build_skips() desde la tabla de un prefijo.
+    intersect() y difference() con ella dan lo mismo que con sets.
+
+    """
+    rnd = random.Random(6)
+    for n in LONGITUDES:
+        docs = lista_ordenada(rnd, n, 20 * n + 10)
+        posting = CompressedPosting(docs)
+        assert len(posting.skips) == 2 * (n // SKIP)
+        assert CompressedPosting.from_buffers(n, posting.last, posting.docs).skips == posting.skips
+        todos = set(docs)
+        consulta = lista_ordenada(rnd, 10, 20 * n + 10) + docs[::SKIP // 2]
+        consulta = sorted(set(consulta))
+        assert CompressedPosting(docs).intersect(consulta) == [d for d in consulta if d in todos]
+        assert CompressedPosting(docs).difference(consulta) == [d for d in consulta if d not in todos]
+    docs = lista_ordenada(rnd, 4 * SKIP + 9, 5000)
+    entera = CompressedPosting(docs)
+    for k in [0, 5, SKIP, SKIP + 1, 3 * SKIP - 1, len(docs)]:
+        prefijo = CompressedPosting(docs[:k])
+        assert entera.build_skips(prefijo.skips) == entera.skips
+
+
+def testear_gallop():
+    """
+    gallop_intersect(), gallop_difference() y gallop_remove() dan lo mismo que las
+    operaciones con sets, con listas de longitudes parecidas y muy distintas.
+
+    """
+    rnd = random.Random(7)
+    for corta, larga in [(0, 50), (5, 0), (5, 5000), (100, 3000), (800, 1000)]:
+        for _ in range(20):
+            short = lista_ordenada(rnd, corta, 8000)
+            long = lista_ordenada(rnd, larga, 8000)
+            en_long = set(long)
+            en_short = set(short)
+            assert gallop_intersect(short, long) == [d for d in short if d in en_long]
+            assert gallop_difference(short, long) == [d for d in short if d not in en_long]
+            assert gallop_remove(long, short) == [d for d in long if d not in en_short]
+
+
+def testear_union_postings():
+    """
+    union_postings() de listas y de CompressedPosting da la unión ordenada.
+
+    """
+    rnd = random.Random(8)
+    for k in range(0, 6):
+        listas = [lista_ordenada(rnd, rnd.randint(0, 400), 3000) for _ in range(k)]
+        esperado = sorted(set().union(*listas))
+        assert list(union_postings(listas)) == esperado
+        assert list(union_postings([CompressedPosting(docs) for docs in listas])) == esperado
+
+
+def testear_bitmap_posting():
+    """
+    Un BitmapPosting tiene los mismos artIds y posiciones que la CompressedPosting de la
+    que se crea, y union_postings() con bitmaps y postings comprimidas da la unión ordenada.
+
+    """
+    rnd = random.Random(9)
+    docs = lista_ordenada(rnd, 300, 1000)
+    pos = posiciones(rnd, docs)
+    for posting in (BitmapPosting(docs, pos), BitmapPosting.from_compressed(CompressedPosting(docs, pos))):
+        assert posting.doc_ids() == docs and len(posting) == len(docs)
+        assert [p for _, p in posting.items()] == pos
+        assert all(doc in posting for doc in docs)
+        assert not any(doc in posting for doc in set(range(1, 1001)) - set(docs))
+    for k in range(1, 6):
+        listas = [lista_ordenada(rnd, rnd.randint(0, 400), 3000) for _ in range(k)]
+        mezcla = [BitmapPosting(listas[0])] + [CompressedPosting(docs) for docs in listas[1:]]
+        assert list(union_postings(mezcla)) == sorted(set().union(*listas))
+
+
+def testear_offset_intersect():
+    """
+    offset_intersect() da las posiciones de inicio de una frase cuyo siguiente término
+    está "offset" posiciones más allá, igual que con sets.
+
+    """
+    rnd = random.Random(10)
+    for corta, larga in [(0, 50), (5, 0), (5, 5000), (100, 3000), (800, 1000)]:
+        for _ in range(20):
+            starts = lista_ordenada(rnd, corta, 8000)
+            positions = lista_ordenada(rnd, larga, 8000)
+            en_positions = set(positions)
+            for offset in (1, 2, 5):
+                esperado = [s for s in starts if s + offset in en_positions]
+                assert offset_intersect(starts, positions, offset) == esperado
+
+
+if __name__ == "__main__":
+    testear_field_index()
+    testear_concat_rebase()
+    testear_vb()
+    testear_compressed_posting()
+    testear_compress_postings()
+    testear_extend()
+    testear_skips()
+    testear_gallop()
+    testear_union_postings()
+    testear_bitmap_posting()
+    testear_offset_intersect()
+    print('OK')